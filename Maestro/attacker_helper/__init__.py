@@ -1 +1,2 @@
-from Maestro.attacker_helper.attacker_request_helper import virtual_model
+from Maestro.attacker_helper.attacker_request_helper import virtual_model, async_virtual_model
+from Maestro.attacker_helper.hotflip import HotFlipCandidateSearch
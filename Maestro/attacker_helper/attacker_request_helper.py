@@ -3,7 +3,53 @@ import requests
 import json
 import pickle
 import os
+import base64
+import hashlib
 from typing import List, Iterator, Dict, Tuple, Any, Type
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from Maestro.utils import (
+    TENSOR_CONTENT_TYPE,
+    encode_tensors,
+    decode_tensors,
+    ResponseCache,
+    cache_key,
+)
+
+
+def _make_session(pool_size, retries, backoff_factor) -> requests.Session:
+    # queries are POSTs and not idempotent (they are charged to the budget), so
+    # they are only retried when the connection failed before anything was
+    # sent; read errors and 502/503/504 responses are retried for GETs only
+    retry_options = dict(
+        total=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=(502, 503, 504),
+        raise_on_status=False,
+    )
+    try:
+        retry = Retry(allowed_methods=frozenset(["GET"]), **retry_options)
+    except TypeError:
+        # urllib3 < 1.26
+        retry = Retry(method_whitelist=frozenset(["GET"]), **retry_options)
+    adapter = HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry
+    )
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def _atomic_write(path, data: bytes):
+    # concurrent attack scripts must never see a half written cache file
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
 
 
 class virtual_model:
@@ -11,9 +57,61 @@ class virtual_model:
     model_wraper is an object that only contains method/data that are allowed to the users.
     """
 
-    def __init__(self, request_url, application_name) -> None:
+    def __init__(
+        self,
+        request_url,
+        application_name,
+        binary=True,
+        dtype=None,
+        pool_size=10,
+        retries=3,
+        backoff_factor=0.5,
+        timeout=300,
+        cache_dir=None,
+        local_vocab=True,
+        cache_size=0,
+        attacker=None,
+    ) -> None:
+        """
+        binary: exchange batches with the server as raw tensors instead of JSON.
+        dtype: precision the server should use for floating point outputs, e.g.
+            "float16" or "float32". Defaults to the model's own precision.
+        pool_size: keep-alive connections kept open to the server.
+        retries, backoff_factor: failed connections (and, for GETs, read errors
+            and 502/503/504 responses) are retried, waiting backoff_factor * 2^n
+            seconds in between. Queries are never sent twice.
+        timeout: seconds to wait for a response.
+        cache_dir: where downloaded vocabularies are kept, per application and
+            model fingerprint. Defaults to ~/.cache/maestro.
+        local_vocab: answer token/id conversions from the cached vocabulary
+            instead of asking the server every time.
+        cache_size: MB of model query responses kept in memory, so repeated
+            identical queries (same route, batch and labels) are answered
+            without a round trip; 0 disables it. The served model is assumed
+            not to change while this virtual_model is in use.
+        attacker: name the queries are accounted to (query budgets, rate limits
+            and fair scheduling) when the server is reached through a proxy it
+            trusts; otherwise the server goes by the client address.
+        """
         self.request_url = request_url
         self.application_name = application_name
+        self.binary = binary
+        self.dtype = dtype
+        self.timeout = timeout
+        self.session = _make_session(pool_size, retries, backoff_factor)
+        if attacker is not None:
+            self.session.headers["X-Maestro-Attacker"] = attacker
+        # budget status reported with the last model query, see get_budget
+        self.budget = None
+        if cache_dir is None:
+            cache_dir = os.path.join(os.path.expanduser("~"), ".cache", "maestro")
+        self.cache_dir = cache_dir
+        self.local_vocab = local_vocab
+        self._model_info = None
+        self._vocab = None
+        self.response_cache = None
+        if cache_size > 0:
+            self.response_cache = ResponseCache(int(cache_size * 1024 ** 2))
 
     def get_batch_output(self, perturbed_tokens, labels):
         return self._process_batch(
@@ -25,79 +123,397 @@ class virtual_model:
             self.request_url, perturbed_tokens, labels, gradient=True,
         )
 
-    def get_embedding(self):
-        embedding_file = "./embedding.pkl"
-        if os.path.isfile(embedding_file):
-            embedding = pickle.load(open(embedding_file, "rb"))
-        else:
+    def get_batch_output_and_gradient(self, perturbed_tokens, labels):
+        """
+        Returns (per-example loss, logits, input gradient) computed by the server
+        in a single forward/backward pass.
+        """
+        return self._process_batch(
+            self.request_url,
+            perturbed_tokens,
+            labels,
+            route="get_batch_output_and_gradient",
+        )
 
-            data = {"Application_Name": self.application_name}
-            final_url = "{0}/get_model_embedding".format(self.request_url)
-            response = requests.post(final_url, data=data)
-            retruned_json = json.loads(response.json()["data"])
-            embedding = retruned_json
-            print("embedding", len(embedding))
-            with open(embedding_file, mode="wb") as f:
-                pickle.dump(
-                    embedding, f,
+    def score_candidates(self, batch, labels, candidates, position=1, max_rows=256):
+        """
+        Returns the mean loss of the batch for every candidate trigger (rows of
+        candidates), inserted at `position` (1: right after [CLS]). The server
+        builds and runs all perturbed inputs, max_rows examples per forward pass.
+        """
+        final_url = self.request_url + "/score_candidates"
+        batch = np.asarray(batch)
+        labels = np.asarray(labels)
+        candidates = np.asarray(candidates, dtype=np.int64).reshape(len(candidates), -1)
+        params = {"position": position, "max_rows": max_rows}
+        if self.binary:
+            return self._post_tensors(final_url, [batch, labels, candidates], params)
+        payload = {
+            "Application_Name": self.application_name,
+            "data": batch.tolist(),
+            "labels": labels.tolist(),
+            "candidates": candidates.tolist(),
+        }
+        payload.update(params)
+        content = self._query(final_url, json=payload)
+        return json.loads(json.loads(content)["outputs"])
+
+    def run_iterative_attack(self, batch, labels=None, callback=print, **recipe):
+        """
+        Runs a PGD/BIM attack on the server in a single request, see
+        IterativeAttackRecipe for the accepted recipe arguments (epsilon,
+        step_size, steps, norm, random_start, clip_min, clip_max, report_every).
+        callback receives every progress report and finally the summary of the
+        result (violations: examples outside the epsilon ball, max_distance);
+        the adversarial batch is returned.
+        """
+        final_url = self.request_url + "/run_iterative_attack"
+        if labels is None:
+            labels = np.array([], dtype=np.int64)
+        params = {"Application_Name": self.application_name}
+        params.update(recipe)
+        headers = {
+            "Content-Type": TENSOR_CONTENT_TYPE,
+            "Accept": TENSOR_CONTENT_TYPE,
+        }
+        batch = np.asarray(batch, dtype=np.float32)
+        response = self._post(
+            final_url,
+            data=encode_tensors([batch, np.asarray(labels)]),
+            params=params,
+            headers=headers,
+            stream=True,
+        )
+        response.raise_for_status()
+        for line in response.iter_lines():
+            if not line:
+                continue
+            progress = json.loads(line)
+            if progress.get("done"):
+                adversarial = progress.pop("adversarial")
+                if callback is not None:
+                    callback(progress)
+                return decode_tensors(bytearray(base64.b64decode(adversarial)))
+            if callback is not None:
+                callback(progress)
+        raise RuntimeError("iterative attack stream ended without a result")
+
+    def get_embedding(self, dtype=None, chunk_rows=4096):
+        """
+        Returns the model's embedding matrix as a read-only, memory-mapped float32
+        array. It is downloaded once, in chunks of chunk_rows rows sent in the
+        model's own dtype (or as dtype, e.g. "float16" to halve the download at
+        the cost of precision), verified against the server's content hash and
+        cached under cache_dir/<application>/<model fingerprint>/embedding-<dtype>.npy.
+        """
+        embedding_file = os.path.join(
+            self._model_cache_dir(), "embedding-{}.npy".format(dtype or "model")
+        )
+        if not os.path.isfile(embedding_file):
+            self._download_embedding(embedding_file, dtype, chunk_rows)
+        return np.load(embedding_file, mmap_mode="r")
+
+    def _download_embedding(self, embedding_file, dtype, chunk_rows):
+        final_url = "{0}/get_model_embedding".format(self.request_url)
+        headers = {"Accept": TENSOR_CONTENT_TYPE}
+        tmp_file = "{}.{}.tmp".format(embedding_file, os.getpid())
+        digest = hashlib.sha256()
+        embedding = None
+        offset, rows = 0, None
+        while rows is None or offset < rows:
+            data = {
+                "Application_Name": self.application_name,
+                "offset": offset,
+                "limit": chunk_rows,
+            }
+            if dtype is not None:
+                data["dtype"] = dtype
+            response = self._post(final_url, data=data, headers=headers)
+            response.raise_for_status()
+            chunk = decode_tensors(response.content)
+            if embedding is None:
+                rows = int(response.headers["X-Maestro-Embedding-Rows"])
+                content_hash = response.headers["X-Maestro-Content-Hash"]
+                embedding = np.lib.format.open_memmap(
+                    tmp_file, mode="w+", dtype=np.float32, shape=(rows, chunk.shape[1])
                 )
-        return embedding
+            if len(chunk) == 0:
+                raise IOError("server returned no embedding rows at offset {}".format(offset))
+            digest.update(chunk.tobytes())
+            embedding[offset : offset + len(chunk)] = chunk
+            offset += len(chunk)
+        embedding.flush()
+        del embedding
+        if digest.hexdigest() != content_hash:
+            os.remove(tmp_file)
+            raise IOError("embedding download does not match the server's content hash")
+        os.replace(tmp_file, embedding_file)
 
     def convert_tokens_to_ids(self, text):
+        """ text can be a single token or a list of tokens """
+        if self.local_vocab:
+            vocab = self.get_vocab()
+            unk_id = vocab.get(self._unk_token)
+            if isinstance(text, str):
+                return vocab.get(text, unk_id)
+            return [vocab.get(token, unk_id) for token in text]
         data = {"Application_Name": self.application_name, "text": text}
         final_url = "{0}/convert_tokens_to_ids".format(self.request_url)
-        response = requests.post(final_url, data=data)
+        response = self._post(final_url, json=data)
         retruned_json = response.json()
         return retruned_json["data"]
 
     def convert_ids_to_tokens(self, id):
+        """ id can be a single id or a list of ids """
+        if self.local_vocab:
+            self.get_vocab()
+            if isinstance(id, (list, tuple, np.ndarray)):
+                return [self._ids_to_tokens[int(x)] for x in id]
+            return self._ids_to_tokens[int(id)]
+        if isinstance(id, np.ndarray):
+            id = id.tolist()
         data = {"Application_Name": self.application_name, "text": id}
         final_url = "{0}/convert_ids_to_tokens".format(self.request_url)
-        response = requests.post(final_url, data=data)
+        response = self._post(final_url, json=data)
         retruned_json = response.json()
         return retruned_json["data"]
 
-    def get_data(self, data_type="validation"):
-        data_file = "./data_" + self.application_name + ".pkl"
-        dev_data = []
-        print("getting data", data_file, os.path.isfile(data_file))
-        if os.path.isfile(data_file):
-            print("found local data, loading...")
-            dev_data = pickle.load(open(data_file, "rb"))
-        else:
-            data = {
-                "Application_Name": self.application_name,
-                "data_type": data_type,
+    def get_model_info(self):
+        """
+        {"fingerprint": hash of the served model, "vocab_size": ...}, fetched once.
+        """
+        if self._model_info is None:
+            data = {"Application_Name": self.application_name}
+            final_url = "{0}/get_model_info".format(self.request_url)
+            response = self._post(final_url, data=data)
+            response.raise_for_status()
+            self._model_info = response.json()
+        return self._model_info
+
+    def get_vocab(self):
+        """
+        Downloads the tokenizer vocabulary once and caches it on disk under
+        cache_dir/<application>/<model fingerprint>/vocab.json.
+        """
+        if self._vocab is None:
+            vocab_file = os.path.join(self._model_cache_dir(), "vocab.json")
+            if os.path.isfile(vocab_file):
+                with open(vocab_file) as f:
+                    retruned_json = json.load(f)
+            else:
+                data = {"Application_Name": self.application_name}
+                final_url = "{0}/get_vocab".format(self.request_url)
+                response = self._post(final_url, data=data)
+                response.raise_for_status()
+                retruned_json = response.json()
+                _atomic_write(vocab_file, json.dumps(retruned_json).encode())
+            self._unk_token = retruned_json["unk_token"]
+            self._ids_to_tokens = {
+                idx: token for token, idx in retruned_json["vocab"].items()
             }
-            final_url = "{0}/get_data".format(self.request_url)
-            response = requests.post(final_url, data=data)
-            retruned_json = response.json()
-            for instance in retruned_json["data"]:
-                new_instance = {}
-                for field in instance:
-                    if isinstance(instance[field], List):
-                        new_instance[field] = instance[field]
-                    else:
-                        new_instance[field] = instance[field]
-                dev_data.append(new_instance)
-            with open(data_file, mode="wb") as f:
-                pickle.dump(
-                    dev_data, f,
-                )
-        return dev_data
+            self._vocab = retruned_json["vocab"]
+        return self._vocab
 
-    def _process_batch(self, url, batch, labels, gradient=False):
+    def _model_cache_dir(self):
+        path = os.path.join(
+            self.cache_dir, self.application_name, self.get_model_info()["fingerprint"]
+        )
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def get_data(
+        self, data_type="validation", offset=0, limit=5, label=None, uids=None
+    ) -> List[Dict[str, Any]]:
+        """
+        Returns the examples of a split as a list of {"image", "label", "uid"}
+        dicts, see iter_data for the arguments. Only the first 5 are fetched by
+        default like the server always did, pass limit=None for the whole split.
+        """
+        return list(self.iter_data(data_type, offset, limit, label, uids))
+
+    def iter_data(
+        self, data_type="validation", offset=0, limit=None, label=None, uids=None
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        Lazily yields the examples of a split. The server only converts the
+        examples that match `label`/`uids`, skipping `offset` of them and
+        stopping after `limit`, and streams them one record at a time.
+        """
+        data = {
+            "Application_Name": self.application_name,
+            "data_type": data_type,
+            "offset": offset,
+        }
+        if limit is not None:
+            data["limit"] = limit
+        if label is not None:
+            data["label"] = label
+        if uids is not None:
+            data["uids"] = list(uids)
+        final_url = "{0}/get_data".format(self.request_url)
+        accept = TENSOR_CONTENT_TYPE if self.binary else "application/x-ndjson"
+        response = self._post(
+            final_url, data=data, headers={"Accept": accept}, stream=True
+        )
+        response.raise_for_status()
+        with response:
+            if not self.binary:
+                for line in response.iter_lines():
+                    if line:
+                        yield json.loads(line)
+                return
+            buffer = bytearray()
+            for chunk in response.iter_content(chunk_size=1 << 16):
+                buffer += chunk
+                while len(buffer) >= 8:
+                    size = int.from_bytes(buffer[:8], "little")
+                    if len(buffer) < 8 + size:
+                        break
+                    image, instance_label, uid = decode_tensors(buffer[8 : 8 + size])
+                    del buffer[: 8 + size]
+                    yield {"image": image, "label": int(instance_label), "uid": int(uid)}
+            if buffer:
+                raise ValueError("truncated /get_data stream")
+
+    def _process_batch(self, url, batch, labels, gradient=False, route=None):
         # if labels == None:
         #     labels = np.array([])
+        final_url = url + "/get_batch_output"
+        if gradient:
+            final_url = url + "/get_batch_input_gradient"
+        if route is not None:
+            final_url = url + "/" + route
+        if self.binary:
+            return self._post_tensors(final_url, [batch, labels])
         payload = {
             "Application_Name": self.application_name,
             "data": batch.tolist(),
             "labels": labels.tolist(),
         }
-        final_url = url + "/get_batch_output"
-        if gradient:
-            final_url = url + "/get_batch_input_gradient"
-        response = requests.post(final_url, json=payload)
+        content = self._query(final_url, json=payload)
 
-        outputs = json.loads(response.json()["outputs"])
+        outputs = json.loads(json.loads(content)["outputs"])
         return outputs
+
+    def _post(self, final_url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        response = self.session.post(final_url, **kwargs)
+        if "X-Maestro-Budget" in response.headers:
+            self.budget = json.loads(response.headers["X-Maestro-Budget"])
+        elif response.status_code == 429:
+            # over budget or rate limited, the error carries the status
+            self.budget = response.json().get("budget", self.budget)
+        return response
+
+    def get_budget(self):
+        """
+        Returns the queries used and left on this application, per kind
+        (forward_queries, gradient_queries, examples): {"used", "limit",
+        "remaining"}, limit and remaining are None when unlimited.
+        """
+        final_url = self.request_url + "/budget"
+        response = self._post(final_url, data={"Application_Name": self.application_name})
+        response.raise_for_status()
+        self.budget = response.json()
+        return self.budget
+
+    def _query(self, final_url, **kwargs) -> bytes:
+        """
+        Posts a model query and returns the raw response body, answering
+        repeated identical queries from the response cache when it is enabled.
+        """
+        if self.response_cache is None:
+            response = self._post(final_url, **kwargs)
+            response.raise_for_status()
+            return response.content
+        key = cache_key(
+            final_url,
+            json.dumps(sorted(kwargs.get("params", {}).items())),
+            json.dumps(sorted(kwargs.get("headers", {}).items())),
+            kwargs["data"] if "data" in kwargs else json.dumps(kwargs["json"]),
+        )
+        content = self.response_cache.get(key)
+        if content is None:
+            response = self._post(final_url, **kwargs)
+            response.raise_for_status()
+            content = response.content
+            self.response_cache.put(key, content, len(content))
+        return content
+
+    def _post_tensors(self, final_url, tensors, params=None):
+        batch = np.asarray(tensors[0])
+        if batch.dtype == np.float64:
+            # the models compute in float32, sending doubles only doubles the payload
+            tensors = [batch.astype(np.float32)] + list(tensors[1:])
+        params = dict(params or {}, Application_Name=self.application_name)
+        if self.dtype is not None:
+            params["dtype"] = self.dtype
+        headers = {
+            "Content-Type": TENSOR_CONTENT_TYPE,
+            "Accept": TENSOR_CONTENT_TYPE,
+        }
+        content = self._query(
+            final_url, data=encode_tensors(tensors), params=params, headers=headers
+        )
+        return decode_tensors(bytearray(content))
+
+
+class async_virtual_model(virtual_model):
+    """
+    asyncio flavour of virtual_model: the same methods as coroutines, sharing one
+    pooled session, so many queries (e.g. the candidates of a beam search) can
+    be in flight at once with asyncio.gather.
+    """
+
+    def __init__(self, request_url, application_name, max_concurrency=10, **kwargs) -> None:
+        kwargs.setdefault("pool_size", max_concurrency)
+        super(async_virtual_model, self).__init__(request_url, application_name, **kwargs)
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency)
+
+    def _run(self, method, *args, **kwargs):
+        loop = asyncio.get_event_loop()
+        return loop.run_in_executor(
+            self._executor, functools.partial(method, self, *args, **kwargs)
+        )
+
+    async def get_batch_output(self, perturbed_tokens, labels):
+        return await self._run(virtual_model.get_batch_output, perturbed_tokens, labels)
+
+    async def get_batch_input_gradient(self, perturbed_tokens, labels):
+        return await self._run(
+            virtual_model.get_batch_input_gradient, perturbed_tokens, labels
+        )
+
+    async def get_batch_output_and_gradient(self, perturbed_tokens, labels):
+        return await self._run(
+            virtual_model.get_batch_output_and_gradient, perturbed_tokens, labels
+        )
+
+    async def score_candidates(self, batch, labels, candidates, position=1, max_rows=256):
+        return await self._run(
+            virtual_model.score_candidates, batch, labels, candidates, position, max_rows
+        )
+
+    async def run_iterative_attack(self, batch, labels=None, callback=print, **recipe):
+        return await self._run(
+            virtual_model.run_iterative_attack, batch, labels, callback, **recipe
+        )
+
+    async def get_budget(self):
+        return await self._run(virtual_model.get_budget)
+
+    async def get_embedding(self, dtype=None, chunk_rows=4096):
+        return await self._run(virtual_model.get_embedding, dtype, chunk_rows)
+
+    async def convert_tokens_to_ids(self, text):
+        return await self._run(virtual_model.convert_tokens_to_ids, text)
+
+    async def convert_ids_to_tokens(self, id):
+        return await self._run(virtual_model.convert_ids_to_tokens, id)
+
+    async def get_data(
+        self, data_type="validation", offset=0, limit=5, label=None, uids=None
+    ):
+        return await self._run(
+            virtual_model.get_data, data_type, offset, limit, label, uids
+        )
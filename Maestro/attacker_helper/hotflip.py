@@ -0,0 +1,159 @@
+from typing import List, Iterable, Tuple, Union
+import numpy as np
+import torch
+
+
+class HotFlipCandidateSearch:
+    """
+    First order (HotFlip) search for token replacements. The embedding matrix is
+    kept resident on `device`, and the gradients of every position of a batch
+    are scored against the whole vocabulary with one matmul per vocabulary chunk,
+    keeping a running top-k so memory stays bounded by batch * length * chunk_size.
+    """
+
+    def __init__(
+        self,
+        embedding_matrix,
+        device: Union[str, torch.device] = "cpu",
+        chunk_size: int = 8192,
+        excluded_ids: Iterable[int] = (),
+    ) -> None:
+        """
+        embedding_matrix: [V, D] array, e.g. virtual_model.get_embedding().
+        chunk_size: number of vocabulary rows scored at once.
+        excluded_ids: ids that are never proposed (e.g. [CLS], [SEP], [PAD]).
+        """
+        self.device = torch.device(device)
+        self.embedding = torch.tensor(
+            np.asarray(embedding_matrix), dtype=torch.float32, device=self.device
+        )
+        self.chunk_size = chunk_size
+        self.excluded = self._id_mask(excluded_ids)
+
+    @classmethod
+    def from_virtual_model(
+        cls, vm, excluded_tokens: List[str] = None, **kwargs
+    ) -> "HotFlipCandidateSearch":
+        """
+        Builds the search from the (client side cached) embedding of a
+        virtual_model, excluding the given tokens, e.g. ["[CLS]", "[SEP]"].
+        """
+        excluded_ids = list(kwargs.pop("excluded_ids", ()))
+        if excluded_tokens:
+            excluded_ids.extend(vm.convert_tokens_to_ids(list(excluded_tokens)))
+        return cls(vm.get_embedding(), excluded_ids=excluded_ids, **kwargs)
+
+    def _id_mask(self, ids: Iterable[int]) -> torch.Tensor:
+        mask = torch.zeros(self.embedding.shape[0], dtype=torch.bool, device=self.device)
+        ids = list(ids)
+        if ids:
+            mask[torch.as_tensor(ids, dtype=torch.long, device=self.device)] = True
+        return mask
+
+    def topk(
+        self,
+        grad,
+        num_candidates: int = 1,
+        increase_loss: bool = True,
+        input_ids=None,
+        excluded_ids: Iterable[int] = (),
+        excluded_positions=None,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns (scores, ids) of the best num_candidates replacements for every
+        position, both of shape [B, T, k] ([T, k] for a single [T, D] gradient).
+
+        grad: gradient of the loss w.r.t. the input embeddings, [B, T, D] or [T, D].
+        input_ids: current tokens [B, T]; when given the score is the first order
+            change of the loss (e_new - e_old) . grad, which makes scores of
+            different positions comparable, and the current token is excluded.
+        excluded_ids: extra ids excluded for this call only.
+        excluded_positions: [B, T] boolean mask (or a list of positions shared by
+            the whole batch), e.g. already flipped tokens; their scores are -inf.
+        """
+        grad = torch.as_tensor(np.asarray(grad), dtype=torch.float32, device=self.device)
+        single = grad.dim() == 2
+        if single:
+            grad = grad.unsqueeze(0)
+        if not increase_loss:
+            # lower versus increase the class probability.
+            grad = -grad
+        batch_size, length, _ = grad.shape
+        excluded = self.excluded | self._id_mask(excluded_ids)
+
+        if input_ids is not None:
+            input_ids = torch.as_tensor(np.asarray(input_ids), device=self.device).long()
+            input_ids = input_ids.reshape(batch_size, length)
+            offset = torch.einsum("btd,btd->bt", grad, self.embedding[input_ids])
+        else:
+            offset = torch.zeros(batch_size, length, device=self.device)
+
+        best_scores = torch.full(
+            (batch_size, length, 0), -float("inf"), device=self.device
+        )
+        best_ids = torch.zeros(batch_size, length, 0, dtype=torch.long, device=self.device)
+        vocab_size = self.embedding.shape[0]
+        for start in range(0, vocab_size, self.chunk_size):
+            chunk = self.embedding[start : start + self.chunk_size]
+            # [B, T, D] x [D, C] -> [B, T, C], all positions in one matmul
+            scores = torch.matmul(grad, chunk.t()) - offset.unsqueeze(-1)
+            scores.masked_fill_(excluded[start : start + self.chunk_size], -float("inf"))
+            ids = torch.arange(start, start + chunk.shape[0], device=self.device)
+            if input_ids is not None:
+                # replacing a token with itself is not a flip
+                scores.masked_fill_(ids == input_ids.unsqueeze(-1), -float("inf"))
+            merged_scores = torch.cat([best_scores, scores], dim=2)
+            merged_ids = torch.cat([best_ids, ids.expand(batch_size, length, -1)], dim=2)
+            k = min(num_candidates, merged_scores.shape[2])
+            best_scores, index = merged_scores.topk(k, dim=2)
+            best_ids = merged_ids.gather(2, index)
+
+        if excluded_positions is not None:
+            position_mask = self._position_mask(excluded_positions, batch_size, length)
+            best_scores.masked_fill_(position_mask.unsqueeze(-1), -float("inf"))
+
+        best_scores = best_scores.cpu().numpy()
+        best_ids = best_ids.cpu().numpy()
+        if single:
+            return best_scores[0], best_ids[0]
+        return best_scores, best_ids
+
+    def _position_mask(self, excluded_positions, batch_size, length) -> torch.Tensor:
+        positions = np.asarray(excluded_positions)
+        if positions.dtype == np.bool_:
+            return torch.as_tensor(positions, device=self.device).reshape(batch_size, length)
+        mask = torch.zeros(batch_size, length, dtype=torch.bool, device=self.device)
+        if positions.size:
+            mask[:, torch.as_tensor(positions, dtype=torch.long)] = True
+        return mask
+
+    def best_flip(
+        self,
+        grad,
+        input_ids,
+        increase_loss: bool = True,
+        excluded_ids: Iterable[int] = (),
+        excluded_positions=None,
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Returns (positions, ids, scores), one entry per example: the single
+        (position, token) replacement with the best first order score across all
+        positions. An example without any allowed flip (every position or
+        candidate excluded) gets position and id -1 and a score of -inf.
+        """
+        scores, ids = self.topk(
+            np.asarray(grad).reshape(len(input_ids), -1, self.embedding.shape[1]),
+            1,
+            increase_loss,
+            input_ids,
+            excluded_ids,
+            excluded_positions,
+        )
+        positions = scores[:, :, 0].argmax(axis=1)
+        rows = np.arange(len(positions))
+        best_ids, best_scores = ids[rows, positions, 0], scores[rows, positions, 0]
+        # argmax of an all -inf row is an arbitrary position, not a flip
+        no_flip = np.isneginf(best_scores)
+        positions[no_flip] = -1
+        best_ids[no_flip] = -1
+        return positions, best_ids, best_scores
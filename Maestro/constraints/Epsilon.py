@@ -1,24 +1,72 @@
 import numpy as np
+import torch
+
+DISTANCES = ["l1", "linf", "l2"]
+
+
 class Epsilon:
     '''
-    Constraint that limits contiuous epsilon ball around each pixel
+    Constraint that limits contiuous epsilon ball around each example
     Commonlhy used for attacks such as FGSM.
+    distance: "l1" (the default) bounds the absolute change of every pixel,
+    "linf" is the same ball under its usual name; "l2" bounds the norm of the
+    whole perturbation of an example.
+    The checks work on batches of numpy arrays or (device) torch tensors, the
+    first dimension is the batch.
     '''
     def __init__(self,epsilon:float,distance="l1"):
+        if distance not in DISTANCES:
+            raise ValueError(
+                "unknown distance {}, expected one of {}".format(distance, DISTANCES)
+            )
         self.epsilon = epsilon
         self.distance = distance
-    def violate(self,original_input, perturbed_input):
-        print(original_input.shape,perturbed_input.shape)
+
+    def distances(self, original_input, perturbed_input):
+        '''
+        Per-example distance between the batches, of the same type as the inputs.
+        '''
+        original_input, perturbed_input = _same_type(original_input, perturbed_input)
         assert original_input.shape == perturbed_input.shape
-        
-        diff = original_input - perturbed_input
-        if self.distance == "l1":
-            diff = np.abs(diff)
-        violated_pixels = np.sum(diff > (self.epsilon+1e-5))
+        diff = abs(_flatten(perturbed_input) - _flatten(original_input))
+        if isinstance(diff, torch.Tensor):
+            diff = diff.float()
+            if self.distance == "l2":
+                return diff.norm(p=2, dim=1)
+            # Tensor.amax needs torch >= 1.7
+            return diff.max(1)[0] if diff.shape[1] else diff.sum(1)
+        if self.distance == "l2":
+            return np.sqrt((diff.astype(np.float64) ** 2).sum(1))
+        return diff.max(1, initial=0)
+
+    def violations(self, original_input, perturbed_input):
+        '''
+        Per-example boolean mask of the examples outside the epsilon ball.
+        '''
+        return self.distances(original_input, perturbed_input) > (self.epsilon + 1e-5)
+
+    def check(self, original_input, perturbed_input):
+        '''
+        Returns (violations, distances), see violations and distances.
+        '''
+        distances = self.distances(original_input, perturbed_input)
+        return distances > (self.epsilon + 1e-5), distances
+
+    def violate(self,original_input, perturbed_input):
+        return bool(self.violations(original_input, perturbed_input).any())
+
 
-        if violated_pixels:
-            return True
-        return False
-        
+def _same_type(original_input, perturbed_input):
+    # compare on the device of whichever input is a tensor
+    if isinstance(perturbed_input, torch.Tensor):
+        return torch.as_tensor(original_input, device=perturbed_input.device), perturbed_input
+    if isinstance(original_input, torch.Tensor):
+        return original_input, torch.as_tensor(perturbed_input, device=original_input.device)
+    return np.asarray(original_input), np.asarray(perturbed_input)
 
 
+def _flatten(x):
+    # a single example (e.g. one sentence) counts as a batch of one
+    if x.ndim <= 1:
+        return x.reshape(1, -1)
+    return x.reshape(x.shape[0], -1)
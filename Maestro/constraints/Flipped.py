@@ -1,16 +1,37 @@
 import numpy as np
+from Maestro.constraints.Epsilon import _same_type, _flatten
 class Flipped:
     '''
     Constraint that limits discrete flips of tokens/chars based on granuliarity
     Commonlhy used for attacks such as Hotflip.
     In this constraint, we assume the equal length of original sentence and perturbed sentence.
     We then compare each token and check for each token/char.
+    The checks work on batches of numpy arrays or (device) torch tensors.
     '''
     def __init__(self,granularity:str,k:int):
         self.granularity = granularity
         self.k = k
+
+    def distances(self, og_sentence, perturbed_sentence):
+        '''
+        Per-example Hamming distance, the number of flipped tokens/chars.
+        '''
+        og_sentence, perturbed_sentence = _same_type(og_sentence, perturbed_sentence)
+        assert og_sentence.shape == perturbed_sentence.shape
+        return (_flatten(og_sentence) != _flatten(perturbed_sentence)).sum(1)
+
+    def violations(self, og_sentence, perturbed_sentence):
+        '''
+        Per-example boolean mask of the examples with more than k flips.
+        '''
+        return self.distances(og_sentence, perturbed_sentence) > self.k
+
+    def check(self, og_sentence, perturbed_sentence):
+        '''
+        Returns (violations, distances), see violations and distances.
+        '''
+        distances = self.distances(og_sentence, perturbed_sentence)
+        return distances > self.k, distances
+
     def violate(self,og_sentence, perturbed_sentence):
-        diff = np.sum(og_sentence != perturbed_sentence)
-        if diff > self.k:
-            return True
-        return False
\ No newline at end of file
+        return bool(self.violations(og_sentence, perturbed_sentence).any())
@@ -0,0 +1,108 @@
+import itertools
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Union
+
+
+def constraint_grid(constraint_class, **grid) -> List[Any]:
+    """
+    Builds one constraint per point of the grid, e.g.
+    constraint_grid(Epsilon, epsilon=[0.1, 0.2, 0.3]) or
+    constraint_grid(Flipped, granularity=["token"], k=[1, 3, 5]).
+    """
+    names = list(grid)
+    return [
+        constraint_class(**dict(zip(names, values)))
+        for values in itertools.product(*(grid[name] for name in names))
+    ]
+
+
+def constraint_params(constraint) -> Dict[str, Any]:
+    # trigger lengths are plain ints, the other constraints keep their settings as attributes
+    if isinstance(constraint, (int, float)):
+        return {"constraint": constraint}
+    return dict(vars(constraint))
+
+
+class EvaluationRunner:
+    """
+    Evaluates attackers over a sweep of constraints (epsilons, flip budgets,
+    trigger lengths). The jobs of every (attacker, constraint) evaluation, one
+    per batch for the batch wise evaluators, are dispatched to a pool of
+    `workers` threads querying the server concurrently, and the results are
+    aggregated into one row per evaluation.
+
+    The virtual_model is shared by the workers, create it with a pool_size of at
+    least `workers` so every worker gets its own keep-alive connection.
+    """
+
+    def __init__(self, evaluator_class, iterator_dataloader, vm, workers: int = 8) -> None:
+        self.evaluator_class = evaluator_class
+        self.iterator_dataloader = iterator_dataloader
+        self.vm = vm
+        self.workers = workers
+
+    def run(
+        self, attackers: Union[Dict[str, Any], Any], constraints: List[Any]
+    ) -> List[Dict[str, Any]]:
+        """
+        attackers: an attacker module, or a dict of them keyed by name (e.g. one
+            per submission).
+        constraints: the constraints to sweep, see constraint_grid.
+        Returns one row per (attacker, constraint) with the constraint settings,
+        "examples", "flip_rate", "constraint_violations" and "seconds" (the sum
+        of the time spent in its jobs).
+        """
+        if not isinstance(attackers, dict):
+            attackers = {getattr(attackers, "__name__", "attacker"): attackers}
+        # the same batches for every configuration, also when the dataloader shuffles
+        batches = list(self.iterator_dataloader)
+        evaluations = []
+        for (name, attacker), constraint in itertools.product(attackers.items(), constraints):
+            evaluator = self.evaluator_class(attacker, batches, self.vm, constraint)
+            row = {"attacker": name}
+            row.update(constraint_params(constraint))
+            evaluations.append((row, evaluator, evaluator.jobs(batches)))
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = [
+                [pool.submit(self._timed, job) for job in jobs]
+                for _, _, jobs in evaluations
+            ]
+            table = []
+            for (row, evaluator, _), evaluation_futures in zip(evaluations, futures):
+                results = [future.result() for future in evaluation_futures]
+                row.update(evaluator.aggregate([result for result, _ in results]))
+                row["seconds"] = sum(seconds for _, seconds in results)
+                table.append(row)
+        return table
+
+    @staticmethod
+    def _timed(job):
+        start = time.perf_counter()
+        result = job()
+        return result, time.perf_counter() - start
+
+
+def format_table(table: List[Dict[str, Any]]) -> str:
+    """
+    Renders the rows returned by EvaluationRunner.run as an aligned text table.
+    """
+    if not table:
+        return ""
+    columns = []
+    for row in table:
+        columns.extend(column for column in row if column not in columns)
+
+    def cell(value):
+        if isinstance(value, float):
+            return "{:.4f}".format(value)
+        return str(value)
+
+    rows = [[cell(row.get(column, "")) for column in columns] for row in table]
+    widths = [max(len(column), *(len(r[i]) for r in rows)) for i, column in enumerate(columns)]
+    lines = ["  ".join(column.ljust(width) for column, width in zip(columns, widths))]
+    lines.extend(
+        "  ".join(value.ljust(width) for value, width in zip(r, widths)) for r in rows
+    )
+    return "\n".join(lines)
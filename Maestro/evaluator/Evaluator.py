@@ -1,6 +1,54 @@
-class Evaluator:
+import abc
+import functools
+import numpy as np
+from typing import Any, Callable, Dict, Iterable, List
+
+
+class Evaluator(abc.ABC):
+    """
+    Base class of the evaluators. An evaluation is split into independent jobs
+    (by default one per batch) whose partial results are aggregated, so the
+    jobs can run serially (evaluate_attacker) or concurrently (EvaluationRunner).
+    """
+
     def __init__(self, attacker, iterator_dataloader, vm, constraint) -> None:
         self.attacker = attacker
         self.iterator_dataloader = iterator_dataloader
         self.vm = vm
         self.constraint = constraint
+
+    def jobs(self, batches: Iterable = None) -> List[Callable[[], Dict[str, Any]]]:
+        """
+        Returns the jobs of one evaluation, each returning a dict with the
+        number of "examples", of "flipped" labels and of examples violating the
+        constraint ("violations"), plus the per-example "distances" if measured.
+        """
+        if batches is None:
+            batches = self.iterator_dataloader
+        return [functools.partial(self.evaluate_batch, batch) for batch in batches]
+
+    @abc.abstractmethod
+    def evaluate_batch(self, batch) -> Dict[str, Any]:
+        """ attacks one batch and returns its partial result, see jobs """
+
+    @staticmethod
+    def aggregate(results: List[Dict[str, Any]]) -> Dict[str, Any]:
+        examples = sum(result["examples"] for result in results)
+        flipped = sum(result["flipped"] for result in results)
+        aggregated = {
+            "examples": examples,
+            "flip_rate": flipped / examples if examples else 0.0,
+            "constraint_violations": sum(result["violations"] for result in results),
+        }
+        distances = [result["distances"] for result in results if "distances" in result]
+        if distances:
+            distances = np.concatenate(distances)
+            aggregated["mean_distance"] = float(distances.mean()) if len(distances) else 0.0
+            aggregated["max_distance"] = float(distances.max(initial=0))
+        return aggregated
+
+    def evaluate_attacker(self) -> Dict[str, Any]:
+        results = self.aggregate([job() for job in self.jobs()])
+        print(f"Label flip rate: {results['flip_rate']}")
+        print(f"Constraint Violation Cases: {results['constraint_violations']}")
+        return results
@@ -1,52 +1,48 @@
+import functools
 import numpy as np
 import torch
 import torch.nn as nn
 from sklearn.metrics import accuracy_score, f1_score, precision_score, recall_score
+from Maestro.evaluator.Evaluator import Evaluator
 
-class Trigger_Evaluator:
-    def __init__(self, attacker, iterator_dataloader, vm, constraint) -> None:
-        self.attacker = attacker
-        self.iterator_dataloader = iterator_dataloader
-        self.vm = vm
-        self.constraint = constraint
+class Trigger_Evaluator(Evaluator):
+    def jobs(self, batches=None):
+        # the trigger is learned over the whole data, so one evaluation is one job
+        # whose "batch" is the whole dataloader
+        if batches is None:
+            batches = self.iterator_dataloader
+        return [functools.partial(self.evaluate_batch, batches)]
 
-    def evaluate_attacker(self):
-        trigger = self.attacker.attack(self.iterator_dataloader, self.vm, constraint=3)
-        constraint_violation = self._constraint(trigger)
-        self._evaluate_with_trigger(trigger)
-        print(f"Constraint Violation Cases: {constraint_violation}")
+    def evaluate_batch(self, dataloader):
+        trigger = self.attacker.attack(dataloader, self.vm, constraint=self.constraint)
+        results = self._evaluate_with_trigger(trigger, dataloader)
+        results["violations"] = int(self._constraint(trigger))
+        return results
 
-    def _evaluate_with_trigger(self, trigger):
-        all_vals = []
-        dataloader = self.iterator_dataloader
+    def _evaluate_with_trigger(self, trigger, dataloader=None):
+        examples = 0
+        flipped = 0
+        if dataloader is None:
+            dataloader = self.iterator_dataloader
         trigger = torch.LongTensor(trigger)
         for batch in dataloader:
-            # print("start_batch")
-            # print(batch)
-            flipped = [0]
-            # get gradient w.r.t. trigger embeddings for current batch
-            labels = batch["labels"]
-            # print(batch["input_ids"])
+            labels = batch["labels"].cpu().detach().numpy()
             batch_trigger = trigger.repeat(batch["input_ids"].shape[0], 1)
             perturbed_tokens = torch.cat(
                 (batch["input_ids"][:, :1], batch_trigger, batch["input_ids"][:, 1:],),
                 1,
             )
-            # print(perturbed_tokens)
             logits = self.vm.get_batch_output(
                 perturbed_tokens.cpu().detach().numpy(), labels
             )
-            # print(logits)
             preds = np.argmax(logits[1], axis=1)
             success = preds != labels
-            all_vals.append(success)
-        a = np.array(all_vals).mean()
-        print(f"Label flip rate: {a}")
+            examples += len(labels)
+            flipped += int(np.sum(success))
+        return {"examples": examples, "flipped": flipped}
 
     def _constraint(self, trigger):
         size = len(trigger)
         if size > self.constraint:
             return True
         return False
-
-
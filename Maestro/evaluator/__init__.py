@@ -1,3 +1,8 @@
 from Maestro.evaluator.Hotflip_Evaluator import Hotflip_Evaluator
 from Maestro.evaluator.Trigger_Evaluator import Trigger_Evaluator
 from Maestro.evaluator.FGSM_Evaluator import FGSM_Evaluator
+from Maestro.evaluator.EvaluationRunner import (
+    EvaluationRunner,
+    constraint_grid,
+    format_table,
+)
@@ -14,6 +14,7 @@ import torch.nn as nn
 from torch.utils.data import DataLoader
 import copy
 from attacker_request_helper import virtual_model
+from Maestro.attacker_helper import HotFlipCandidateSearch
 from transformers.data.data_collator import default_data_collator
 
 # from Maestro.models import build_model
@@ -46,33 +47,35 @@ def attack(
     flipped = []
     perturbed_tokens = copy.deepcopy(original_tokens)
     for i in range(constraint):
-    # -------------------------------- TODO ---------------------------------------
-    # implement the attack for Hotflip. You can either use API to take advantage of the server 
-    # resources, or use local resources via PyTorch
-    # ---------------------------------TODO END-----------------------------------------
+        # -------------------------------- TODO ---------------------------------------
+        # implement the attack for Hotflip. You can either use API to take advantage of the server
+        # resources, or use local resources via PyTorch. HotFlipCandidateSearch keeps the
+        # embedding resident and scores every position of a batch at once, e.g.
+        #   search = HotFlipCandidateSearch(vm.get_embedding(), excluded_ids=special_ids)
+        #   positions, cand_ids, scores = search.best_flip(data_grad, perturbed_tokens)
+        # a position of -1 means every position is excluded and there is nothing left to flip
+        pass
+        # ---------------------------------TODO END-----------------------------------------
     return perturbed_tokens
 
 
 def hotflip_attack_helper(
     grad, embedding_matrix, increase_loss=False, num_candidates=1,
 ) -> List[List[int]]:
-
-    grad = torch.FloatTensor(grad)
-    embedding_matrix = torch.FloatTensor(embedding_matrix)
-    grad = grad.unsqueeze(0).unsqueeze(0)
-    gradient_dot_embedding_matrix = torch.einsum(
-        "bij,kj->bik", (grad, embedding_matrix)
+    # pass a HotFlipCandidateSearch to keep the embedding resident across calls
+    search = (
+        embedding_matrix
+        if isinstance(embedding_matrix, HotFlipCandidateSearch)
+        else HotFlipCandidateSearch(embedding_matrix)
+    )
+    _, best_k_ids = search.topk(
+        np.asarray(grad).reshape(1, -1, search.embedding.shape[1]),
+        num_candidates,
+        increase_loss,
     )
-    if not increase_loss:
-        gradient_dot_embedding_matrix *= (
-            -1
-        )  # lower versus increase the class probability.
     if num_candidates > 1:  # get top k options
-        _, best_k_ids = torch.topk(gradient_dot_embedding_matrix, num_candidates, dim=2)
-        return best_k_ids.detach().cpu().numpy()[0]
-    _, best_at_each_step = gradient_dot_embedding_matrix.max(2)
-
-    return best_at_each_step[0].detach().cpu().numpy()
+        return best_k_ids[0]
+    return best_k_ids[0, :, 0]
 
 
 def main():
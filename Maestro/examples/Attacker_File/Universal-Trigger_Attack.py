@@ -14,6 +14,7 @@ import torch.nn as nn
 from torch.utils.data import DataLoader
 import copy
 from attacker_request_helper import virtual_model
+from Maestro.attacker_helper import HotFlipCandidateSearch
 from torch.utils.data.sampler import RandomSampler
 from transformers.data.data_collator import default_data_collator
 
@@ -32,7 +33,8 @@ def attack(iterator_dataloader: List[List[int]], vm: virtual_model, constraint:
     trigger_token_ids = [vm.convert_tokens_to_ids("the")] * num_trigger_tokens
 
     print("started the process")
-    embedding_weight = vm.get_embedding()
+    # keep the embedding resident across batches, see hotflip_attack_helper
+    embedding_weight = HotFlipCandidateSearch(vm.get_embedding())
     for batch in iterator_dataloader:
         # get accuracy with current triggers
         print("start_batch")
@@ -51,11 +53,9 @@ def attack(iterator_dataloader: List[List[int]], vm: virtual_model, constraint:
 def get_accuracy(vm, dev_data, trigger_token_ids, triggers=False, batch=False,) -> None:
     if batch:
         if triggers:
-            print_string = ""
-            for idx in trigger_token_ids:
-                print_string = (
-                    print_string + str(vm.convert_ids_to_tokens(int(idx))) + ", "
-                )
+            # one lookup for the whole trigger
+            tokens = vm.convert_ids_to_tokens([int(idx) for idx in trigger_token_ids])
+            print_string = "".join(str(token) + ", " for token in tokens)
             print("triggers:", print_string)
             outputs = eval_with_triggers(vm, dev_data, trigger_token_ids, False)
             logits = outputs[1]
@@ -80,11 +80,9 @@ def get_accuracy(vm, dev_data, trigger_token_ids, triggers=False, batch=False,)
             collate_fn=default_data_collator,
         )
         if triggers:
-            print_string = ""
-            for idx in trigger_token_ids:
-                print_string = (
-                    print_string + str(vm.convert_ids_to_tokens(int(idx))) + ", "
-                )
+            # one lookup for the whole trigger
+            tokens = vm.convert_ids_to_tokens([int(idx) for idx in trigger_token_ids])
+            print_string = "".join(str(token) + ", " for token in tokens)
             print("triggers:", print_string)
             with torch.no_grad():
                 all_vals = []
@@ -215,24 +213,20 @@ def get_best_candidates(
 def hotflip_attack_helper(
     grad, embedding_matrix, increase_loss=False, num_candidates=1,
 ) -> List[List[int]]:
-
-    grad = torch.FloatTensor(grad)
-    embedding_matrix = torch.FloatTensor(embedding_matrix)
-    grad = grad.unsqueeze(0)
-    print(grad.shape, embedding_matrix.shape)
-    gradient_dot_embedding_matrix = torch.einsum(
-        "bij,kj->bik", (grad, embedding_matrix)
+    # pass a HotFlipCandidateSearch to keep the embedding resident across calls
+    search = (
+        embedding_matrix
+        if isinstance(embedding_matrix, HotFlipCandidateSearch)
+        else HotFlipCandidateSearch(embedding_matrix)
+    )
+    _, best_k_ids = search.topk(
+        np.asarray(grad).reshape(1, -1, search.embedding.shape[1]),
+        num_candidates,
+        increase_loss,
     )
-    if not increase_loss:
-        gradient_dot_embedding_matrix *= (
-            -1
-        )  # lower versus increase the class probability.
     if num_candidates > 1:  # get top k options
-        _, best_k_ids = torch.topk(gradient_dot_embedding_matrix, num_candidates, dim=2)
-        return best_k_ids.detach().cpu().numpy()[0]
-    _, best_at_each_step = gradient_dot_embedding_matrix.max(2)
-
-    return best_at_each_step[0].detach().cpu().numpy()
+        return best_k_ids[0]
+    return best_k_ids[0, :, 0]
 
 
 def main():
@@ -28,14 +28,9 @@ def main():
 
     vm = virtual_model(url, application_name="FGSM")
     dataset_label_filter = 0
-    dev_data = vm.get_data(data_type="test")
-
-    targeted_dev_data = []
-    for instance in dev_data:
-        if instance["label"] == dataset_label_filter:
-            targeted_dev_data.append(instance)
+    # the server filters by label and only sends the examples we use
+    targeted_dev_data = vm.get_data(data_type="test", label=dataset_label_filter, limit=10)
     print(len(targeted_dev_data))
-    targeted_dev_data = targeted_dev_data[:10]
     universal_perturb_batch_size = 1
     # tokenizer = model_wrapper.get_tokenizer()
     iterator_dataloader = DataLoader(
@@ -1,7 +1,7 @@
 import importlib
 import numpy as np
 from Maestro.data import HuggingFaceDataset, get_dataset
-from Maestro.evaluator import FGSM_Evaluator
+from Maestro.evaluator import FGSM_Evaluator, EvaluationRunner, constraint_grid, format_table
 from Maestro.models import build_model
 from Maestro.attacker_helper.attacker_request_helper import virtual_model
 from Maestro.constraints import Epsilon
@@ -13,7 +13,7 @@ attacker = importlib.import_module("FGSM_Attack_sol")
 # url = "http://128.195.56.136:5000"
 url = "http://127.0.0.1:5000"
 application_name = "FGSM"
-vm = virtual_model(url,application_name=application_name)
+vm = virtual_model(url,application_name=application_name, pool_size=8)
 
 dataset_name = "MNIST"
 datasets = get_dataset(dataset_name)
@@ -36,3 +36,8 @@ epsilon = 0.2
 constraint = Epsilon(epsilon)
 E = FGSM_Evaluator(attacker, iterator_dataloader, vm, constraint=constraint)
 E.evaluate_attacker()
+
+# sweep several epsilons, the batches are sent to the server concurrently
+runner = EvaluationRunner(FGSM_Evaluator, iterator_dataloader, vm, workers=8)
+table = runner.run(attacker, constraint_grid(Epsilon, epsilon=[0.1, 0.2, 0.3]))
+print(format_table(table))
@@ -14,6 +14,7 @@ import torch.nn as nn
 from torch.utils.data import DataLoader
 import copy
 from Maestro.attacker_helper.attacker_request_helper import virtual_model
+from Maestro.attacker_helper import HotFlipCandidateSearch
 from Maestro.constraints.Flipped import Flipped
 
 # import torch.optim as optim
@@ -57,39 +58,36 @@ def attack(
     flipped = []
     print(original_tokens, original_tokens.shape)
     perturbed_tokens = copy.deepcopy(original_tokens)
+    # the embedding stays resident, every flip scores all positions at once
+    special_ids = vm.convert_tokens_to_ids(["[CLS]", "[SEP]", "[PAD]", "[UNK]"])
+    search = HotFlipCandidateSearch(vm.get_embedding(), excluded_ids=special_ids)
     for i in range(constraint):
         # -------------------------------- TODO ---------------------------------------
-        data_grad = vm.get_batch_input_gradient(perturbed_tokens, labels)
-        # print(len(data_grad))
-        # data_grad of shape [B, T, D] e.g., [1,128,768]
-        data_grad = data_grad[0]
-        # print(len(data_grad))
-        # print(len(data_grad[0]))
-        grads_magnitude = [np.dot(g, g) for g in data_grad]
-        print(grads_magnitude)
-        # only flip a token once
-        for index in flipped:
-            grads_magnitude[index] = -1
-
-        # We flip the token with highest gradient norm.
-        index_of_token_to_flip = np.argmax(grads_magnitude)
+        # one server pass gives the logits of the previous flip and the new gradient
+        _, logits, data_grad = vm.get_batch_output_and_gradient(perturbed_tokens, labels)
+        print(logits)
+        # data_grad of shape [B, T, D] e.g., [1,128,768], T drops the trailing padding
+        data_grad = np.asarray(data_grad)
+        length = data_grad.shape[1]
+        # only flip a token once, and never flip the special tokens
+        excluded = np.isin(perturbed_tokens[:, :length], special_ids)
+        excluded[:, flipped] = True
+        positions, cand_ids, scores = search.best_flip(
+            data_grad,
+            perturbed_tokens[:, :length],
+            increase_loss=True,
+            excluded_positions=excluded,
+        )
+        index_of_token_to_flip = positions[0]
         print("index of token to flip: {}".format(index_of_token_to_flip))
-        if grads_magnitude[index_of_token_to_flip] == -1:
+        if index_of_token_to_flip < 0:
             # If we've already flipped all of the tokens, we give up.
             break
         flipped.append(index_of_token_to_flip)
-        # index_of_token_to_flip = 1
-        embedding_weight = vm.get_embedding()
-        grad = data_grad[index_of_token_to_flip]
-        cand_id = hotflip_attack_helper(
-            grad, embedding_weight, num_candidates=1, increase_loss=True,
-        )
-        print("cand ids:", cand_id)
-        perturbed_tokens[0][index_of_token_to_flip] = cand_id[0]
-        logits = vm.get_batch_output(perturbed_tokens, labels)
-        print(logits)
-        # print("og label", batch["labels"].cpu().detach().numpy()[0])
-        # print("oglogits: {}, logits: {}".format(oglogits[0], logits[0]))
+        print("cand ids:", cand_ids)
+        perturbed_tokens[0][index_of_token_to_flip] = cand_ids[0]
+    logits = vm.get_batch_output(perturbed_tokens, labels)
+    print(logits)
     preds = np.argmax(logits[1], axis=1)
     term = preds != labels
     if term:
@@ -103,23 +101,19 @@ def attack(
 def hotflip_attack_helper(
     grad, embedding_matrix, increase_loss=False, num_candidates=1,
 ) -> List[List[int]]:
-
-    grad = torch.FloatTensor(grad)
-    embedding_matrix = torch.FloatTensor(embedding_matrix)
-    grad = grad.unsqueeze(0).unsqueeze(0)
-    gradient_dot_embedding_matrix = torch.einsum(
-        "bij,kj->bik", (grad, embedding_matrix)
+    search = (
+        embedding_matrix
+        if isinstance(embedding_matrix, HotFlipCandidateSearch)
+        else HotFlipCandidateSearch(embedding_matrix)
+    )
+    _, best_k_ids = search.topk(
+        np.asarray(grad).reshape(1, -1, search.embedding.shape[1]),
+        num_candidates,
+        increase_loss,
     )
-    if not increase_loss:
-        gradient_dot_embedding_matrix *= (
-            -1
-        )  # lower versus increase the class probability.
     if num_candidates > 1:  # get top k options
-        _, best_k_ids = torch.topk(gradient_dot_embedding_matrix, num_candidates, dim=2)
-        return best_k_ids.detach().cpu().numpy()[0]
-    _, best_at_each_step = gradient_dot_embedding_matrix.max(2)
-
-    return best_at_each_step[0].detach().cpu().numpy()
+        return best_k_ids[0]
+    return best_k_ids[0, :, 0]
 
 
 def main():
@@ -128,14 +122,9 @@ def main():
 
     vm = virtual_model(url)
     dataset_label_filter = 0
-    dev_data = vm.get_data()
-
-    targeted_dev_data = []
-    for instance in dev_data:
-        if instance["label"] == dataset_label_filter:
-            targeted_dev_data.append(instance)
+    # the server filters by label and only sends the examples we use
+    targeted_dev_data = vm.get_data(label=dataset_label_filter, limit=10)
     print(len(targeted_dev_data))
-    targeted_dev_data = targeted_dev_data[:10]
     universal_perturb_batch_size = 1
     # tokenizer = model_wrapper.get_tokenizer()
     iterator_dataloader = DataLoader(
@@ -14,6 +14,7 @@ import torch.nn as nn
 from torch.utils.data import DataLoader
 import copy
 from Maestro.attacker_helper.attacker_request_helper import virtual_model
+from Maestro.attacker_helper import HotFlipCandidateSearch
 
 # import torch.optim as optim
 # import torch.nn.functional as F
@@ -58,7 +59,8 @@ def attack(iterator_dataloader: List[List[int]], vm: virtual_model, constraint:
     # best_triggers = [22775, 17950, 17087]
     # trigger_token_ids = best_triggers
     # get_accuracy(model_wrapper, dev_data, tokenizer, best_triggers, True, False)
-    embedding_weight = vm.get_embedding()
+    # keep the embedding resident across batches
+    embedding_weight = HotFlipCandidateSearch(vm.get_embedding())
     for batch in iterator_dataloader:
         # get accuracy with current triggers
         print("start_batch")
@@ -93,11 +95,9 @@ def attack(iterator_dataloader: List[List[int]], vm: virtual_model, constraint:
 def get_accuracy(vm, dev_data, trigger_token_ids, triggers=False, batch=False,) -> None:
     if batch:
         if triggers:
-            print_string = ""
-            for idx in trigger_token_ids:
-                print_string = (
-                    print_string + str(vm.convert_ids_to_tokens(int(idx))) + ", "
-                )
+            # one lookup for the whole trigger
+            tokens = vm.convert_ids_to_tokens([int(idx) for idx in trigger_token_ids])
+            print_string = "".join(str(token) + ", " for token in tokens)
             print("triggers:", print_string)
             outputs = eval_with_triggers(vm, dev_data, trigger_token_ids, False)
             logits = outputs[1]
@@ -124,11 +124,9 @@ def get_accuracy(vm, dev_data, trigger_token_ids, triggers=False, batch=False,)
             collate_fn=default_data_collator,
         )
         if triggers:
-            print_string = ""
-            for idx in trigger_token_ids:
-                print_string = (
-                    print_string + str(vm.convert_ids_to_tokens(int(idx))) + ", "
-                )
+            # one lookup for the whole trigger
+            tokens = vm.convert_ids_to_tokens([int(idx) for idx in trigger_token_ids])
+            print_string = "".join(str(token) + ", " for token in tokens)
             print("triggers:", print_string)
             with torch.no_grad():
                 all_vals = []
@@ -206,18 +204,40 @@ def get_loss_per_candidate(
     if isinstance(cand_trigger_token_ids[0], (np.int64, int)):
         print("Only 1 candidate for index detected, not searching")
         return trigger_token_ids
-    loss_per_candidate = []
-    # loss for the trigger without trying the candidates
-    curr_loss = eval_with_triggers(vm, batch, trigger_token_ids, False)[0]
-    loss_per_candidate.append((deepcopy(trigger_token_ids), curr_loss))
-    for cand_id in range(len(cand_trigger_token_ids[0])):
-        trigger_token_ids_one_replaced = deepcopy(trigger_token_ids)  # copy trigger
-        trigger_token_ids_one_replaced[index] = cand_trigger_token_ids[index][
-            cand_id
-        ]  # replace one token
-        loss = eval_with_triggers(vm, batch, trigger_token_ids_one_replaced, False)[0]
-        loss_per_candidate.append((deepcopy(trigger_token_ids_one_replaced), loss))
-    return loss_per_candidate
+    return score_triggers(
+        vm, batch, get_candidate_triggers(index, [trigger_token_ids], cand_trigger_token_ids)
+    )
+
+
+def get_candidate_triggers(index, triggers, cand_trigger_token_ids) -> List[List[int]]:
+    """
+    For every trigger, the trigger itself followed by its copies with the token at
+    index replaced by each of the candidates for that index.
+    """
+    candidate_triggers = []
+    for trigger_token_ids in triggers:
+        # loss for the trigger without trying the candidates
+        candidate_triggers.append(deepcopy(trigger_token_ids))
+        for cand_id in range(len(cand_trigger_token_ids[0])):
+            trigger_token_ids_one_replaced = deepcopy(trigger_token_ids)  # copy trigger
+            trigger_token_ids_one_replaced[index] = cand_trigger_token_ids[index][
+                cand_id
+            ]  # replace one token
+            candidate_triggers.append(trigger_token_ids_one_replaced)
+    return candidate_triggers
+
+
+def score_triggers(vm, batch, candidate_triggers) -> List[Tuple[List[int], float]]:
+    """
+    Evaluates every candidate trigger on the batch with a single server request,
+    the server inserts the triggers after [CLS] like eval_with_triggers does.
+    """
+    losses = vm.score_candidates(
+        batch["input_ids"].cpu().detach().numpy(),
+        batch["labels"].cpu().detach().numpy(),
+        [[int(idx) for idx in trigger] for trigger in candidate_triggers],
+    )
+    return [(trigger, float(loss)) for trigger, loss in zip(candidate_triggers, losses)]
 
 
 def get_best_candidates(
@@ -240,16 +260,11 @@ def get_best_candidates(
     for idx in range(
         1, len(trigger_token_ids)
     ):  # for all trigger tokens, skipping the 0th (we did it above)
-        loss_per_candidate = []
-        for (
-            cand,
-            _,
-        ) in top_candidates:  # for all the beams, try all the candidates at idx
-            loss_per_candidate.extend(
-                get_loss_per_candidate(
-                    idx, vm, batch, cand, cand_trigger_token_ids, snli
-                )
-            )
+        # for all the beams, try all the candidates at idx in one request
+        beams = [cand for cand, _ in top_candidates]
+        loss_per_candidate = score_triggers(
+            vm, batch, get_candidate_triggers(idx, beams, cand_trigger_token_ids)
+        )
         top_candidates = heapq.nlargest(
             beam_size, loss_per_candidate, key=itemgetter(1)
         )
@@ -259,24 +274,19 @@ def get_best_candidates(
 def hotflip_attack_helper(
     grad, embedding_matrix, increase_loss=False, num_candidates=1,
 ) -> List[List[int]]:
-
-    grad = torch.FloatTensor(grad)
-    embedding_matrix = torch.FloatTensor(embedding_matrix)
-    grad = grad.unsqueeze(0)
-    print(grad.shape, embedding_matrix.shape)
-    gradient_dot_embedding_matrix = torch.einsum(
-        "bij,kj->bik", (grad, embedding_matrix)
+    search = (
+        embedding_matrix
+        if isinstance(embedding_matrix, HotFlipCandidateSearch)
+        else HotFlipCandidateSearch(embedding_matrix)
+    )
+    _, best_k_ids = search.topk(
+        np.asarray(grad).reshape(1, -1, search.embedding.shape[1]),
+        num_candidates,
+        increase_loss,
     )
-    if not increase_loss:
-        gradient_dot_embedding_matrix *= (
-            -1
-        )  # lower versus increase the class probability.
     if num_candidates > 1:  # get top k options
-        _, best_k_ids = torch.topk(gradient_dot_embedding_matrix, num_candidates, dim=2)
-        return best_k_ids.detach().cpu().numpy()[0]
-    _, best_at_each_step = gradient_dot_embedding_matrix.max(2)
-
-    return best_at_each_step[0].detach().cpu().numpy()
+        return best_k_ids[0]
+    return best_k_ids[0, :, 0]
 
 
 def main():
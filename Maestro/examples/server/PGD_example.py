@@ -43,6 +43,30 @@ def pgd_attack(url, uid, img, target, test, eps=0.3, alpha=5/255, steps=100, ran
     return adv_images
 
 
+def pgd_attack_on_server(url, img, target, eps=0.3, alpha=5/255, steps=100, random_start=True):
+    # same attack as pgd_attack, but all steps run on the server in one request
+    payload = {
+        "Application_Name": "FGSM",
+        "data": np.expand_dims(img, axis=0).tolist(),
+        "labels": [target],
+        "recipe": {
+            "epsilon": eps,
+            "step_size": alpha,
+            "steps": steps,
+            "random_start": random_start,
+            "report_every": 10,
+        },
+    }
+    response = requests.post(url + "/run_iterative_attack", json=payload, stream=True)
+    for line in response.iter_lines():
+        if not line:
+            continue
+        progress = json.loads(line)
+        if progress.get("done"):
+            return np.array(progress["adversarial"])[0]
+        print(progress)
+
+
 def produce_fgsm_hook(image, epsilon, data_grad) -> torch.Tensor:
     # print(type(data_grad))
     data_grad = torch.FloatTensor(data_grad)
@@ -130,7 +154,7 @@ def test(url, device, epsilon):
 
         # Re-classify the perturbed image
 
-        perturbed_img = pgd_attack(url, uid, img, target, "test")
+        perturbed_img = pgd_attack_on_server(url, img, target)
 
         output = get_output(url, uid, perturbed_img, target, "test", hook=identify_func, gradient=False)
         # print(perturbed_img.mean())
@@ -8,6 +8,14 @@ import textattack
 from textattack.models.helpers import GloveEmbeddingLayer
 from textattack.models.helpers.utils import load_cached_state_dict
 from textattack.shared import utils
+import os
+from Maestro.utils.weight_store import (
+    skip_init,
+    load_checkpoint,
+    has_weights,
+    load_weights,
+    load_model_weights,
+)
 
 # from pytorch_lightning.core.lightning import LightningModule
 
@@ -19,11 +27,16 @@ def build_model(
     device: int = 0,
     pretrained_file: str = None,
 ):
+    """
+    With a pretrained_file the model's weights are memory-mapped from the
+    checkpoint's weight store, see load_checkpoint; the vision models are built
+    without random initialization (skip_init). For huggingface models
+    pretrained_file is a save_pretrained directory.
+    """
     if model_name == "FGSM_example_model":
-        model = FGSM_example_model()
         if pretrained_file != None:
-            model.load_state_dict(torch.load(pretrained_file, map_location="cpu"))
-        return model
+            return load_checkpoint(skip_init(FGSM_example_model), pretrained_file)
+        return FGSM_example_model()
     elif model_name == "LSTM":
         model = LSTMForClassification(
             max_seq_length=max_length, num_labels=num_labels, emb_layer_trainable=False,
@@ -33,10 +46,21 @@ def build_model(
         model = textattack.models.wrappers.PyTorchModelWrapper(model, model.tokenizer)
         return model
     elif model_name == "MalimgClassifier":
-        model = MalimgClassifier()
         if pretrained_file != None:
-            model.load_state_dict(torch.load(pretrained_file, map_location="cpu"))
-        return model
+            return load_checkpoint(skip_init(MalimgClassifier), pretrained_file)
+        return MalimgClassifier()
+
+    elif pretrained_file:
+        # a fine-tuned checkpoint: no need to download and initialize the base model first
+        config = transformers.AutoConfig.from_pretrained(pretrained_file)
+        model = transformers.AutoModelForSequenceClassification.from_config(config)
+        if has_weights(pretrained_file):
+            # saved by a transformers version writing safetensors already
+            load_model_weights(model, load_weights(pretrained_file, device)).to(device)
+        else:
+            load_checkpoint(model, os.path.join(pretrained_file, "pytorch_model.bin"), device)
+        tokenizer = transformers.AutoTokenizer.from_pretrained(model_name)
+        return Model_and_Tokenizer(model, tokenizer)
 
     else:
         config = transformers.AutoConfig.from_pretrained(
@@ -96,7 +120,8 @@ class FGSM_example_model(nn.Module):
     def forward(self, x) -> torch.Tensor:
         x = F.relu(F.max_pool2d(self.conv1(x), 2))
         x = F.relu(F.max_pool2d(self.conv2_drop(self.conv2(x)), 2))
-        x = x.view(-1, 320)
+        # reshape: the activations are not contiguous in channels last memory format
+        x = x.reshape(-1, 320)
         x = F.relu(self.fc1(x))
         x = F.dropout(x, training=self.training)
         x = self.fc2(x)
@@ -193,7 +218,7 @@ class MalimgClassifier(nn.Module):
         x = self.pool1(x)
         x = F.relu(self.conv2(x))
         x = self.pool2(x)
-        x = x.view(-1, 128*52*14)
+        x = x.reshape(-1, 128*52*14)
         x = F.relu(self.fc1(x))
         x = self.dropout(x)
         x = self.fc2(x)
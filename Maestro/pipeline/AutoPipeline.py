@@ -1,5 +1,14 @@
 import os
+import inspect
 from Maestro.pipeline import Pipeline, VisionPipeline
+from Maestro.pipeline.checkpoint import (
+    CheckpointManifest,
+    data_hash,
+    latest_trainer_checkpoint,
+    REUSE,
+    RESUME,
+)
+from Maestro.pipeline.bucketing import BucketedTrainer, dynamic_padding_collator
 from Maestro.data import HuggingFaceDataset, get_dataset
 from Maestro.models import build_model
 from torch.utils.data.sampler import BatchSampler, RandomSampler
@@ -12,6 +21,9 @@ from transformers import (
 )
 from transformers.data.data_collator import default_data_collator
 from Maestro.utils import move_to_device, get_embedding
+from Maestro.utils.utils import int_to_device
+from Maestro.utils.token_cache import cached_trainable_data
+from Maestro.utils.weight_store import load_checkpoint
 import numpy as np
 import torch
 
@@ -21,9 +33,30 @@ import torch.optim as optim
 
 
 class AutoPipelineForNLP:
+    TRAINING_ARGUMENTS = dict(
+        do_train=True,
+        do_eval=True,
+        num_train_epochs=1,
+        evaluation_strategy="steps",
+        save_steps=200,
+        eval_steps=200,
+        per_device_train_batch_size=32,
+        per_device_eval_batch_size=128,
+        save_total_limit=5,
+    )
+
     def __init__(self):
         raise EnvironmentError("Use this like the AutoModel from huggingface")
 
+    @staticmethod
+    def training_manifest(model_name, dataset_name, train_dataset, validation_dataset):
+        return CheckpointManifest(
+            model_name,
+            dataset_name,
+            dict(AutoPipelineForNLP.TRAINING_ARGUMENTS, max_length=128),
+            data_hash(train_dataset, validation_dataset),
+        )
+
     @classmethod
     def initialize(
         self,
@@ -36,14 +69,15 @@ class AutoPipelineForNLP:
         training_process=None,
         device=0,
         finetune=True,
+        canonicalize=False,
+        cache_dir=None,
     ):
+        """
+        cache_dir: where the tokenized training splits are kept as memory-mapped
+            columns, see cached_trainable_data. Defaults to
+            ~/.cache/maestro/tokenized.
+        """
         datasets = get_dataset(dataset_name)
-        model = build_model(model_name, num_labels=2, max_length=128, device=device)
-        self.tokenizer = model.tokenizer
-        self.device = device
-        for dataset in datasets:
-            dataset.indexed(self.tokenizer, 128)
-
         train_dataset = datasets[0]
         if len(datasets) == 2:
             validation_dataset = datasets[1]
@@ -51,7 +85,29 @@ class AutoPipelineForNLP:
         else:
             validation_dataset = datasets[1]
             test_dataset = datasets[2]
-        if finetune:
+        reuse = False
+        if finetune and model_path:
+            manifest = AutoPipelineForNLP.training_manifest(
+                model_name, dataset_name, train_dataset, validation_dataset
+            )
+            reuse = manifest.action(model_path, checkpoint_path) == REUSE
+        # fine-tuned weights are memory-mapped into a model built without the base weights
+        model = build_model(
+            model_name,
+            num_labels=2,
+            max_length=128,
+            device=device,
+            pretrained_file=model_path if reuse else None,
+        )
+        self.tokenizer = model.tokenizer
+        self.device = device
+        for dataset in datasets:
+            dataset.indexed(self.tokenizer, 128)
+
+        if reuse:
+            print("loaded model from", model_path)
+            model = model.model
+        elif finetune:
             model = AutoPipelineForNLP.fine_tune_on_task(
                 AutoPipelineForNLP,
                 model,
@@ -60,6 +116,9 @@ class AutoPipelineForNLP:
                 model_path,
                 checkpoint_path,
                 compute_metrics=compute_metrics,
+                cache_dir=cache_dir,
+                model_name=model_name,
+                dataset_name=dataset_name,
             )
         return Pipeline(
             scenario,
@@ -70,6 +129,7 @@ class AutoPipelineForNLP:
             training_process,
             device,
             self.tokenizer,
+            canonicalize=canonicalize,
         )
 
     def fine_tune_on_task(
@@ -80,33 +140,58 @@ class AutoPipelineForNLP:
         model_path,
         checkpoint_path,
         compute_metrics=None,
+        cache_dir=None,
+        model_name=None,
+        dataset_name=None,
     ):
-        if not model_path or len(os.listdir(model_path)) == 0:
-            print("start training")
+        """
+        Reuses the weights at model_path when their manifest (see
+        CheckpointManifest) matches this model, dataset and hyperparameters,
+        resumes from the latest Trainer checkpoint under checkpoint_path when
+        such a run was interrupted, and trains from scratch otherwise. The
+        trained weights and their manifest go to model_path (checkpoint_path
+        when there is none), where the next start looks for them.
+        """
+        manifest = AutoPipelineForNLP.training_manifest(
+            model_name, dataset_name, train_dataset, validation_dataset
+        )
+        model_path = model_path or checkpoint_path
+        action = manifest.action(model_path, checkpoint_path)
+        if action != REUSE:
             # optimizer = optim.Adam(model.model.parameters())
             # scheduler = optim.lr_scheduler.LambdaLR(optimizer)
             training_args = TrainingArguments(
-                output_dir=checkpoint_path,
-                do_train=True,
-                do_eval=True,
-                num_train_epochs=1,
-                evaluation_strategy="steps",
-                save_steps=200,
-                eval_steps=200,
-                per_device_train_batch_size=32,
-                per_device_eval_batch_size=128,
-                save_total_limit=5,
+                output_dir=checkpoint_path, **AutoPipelineForNLP.TRAINING_ARGUMENTS
             )
-            trainer = Trainer(
+            # length bucketed batches padded to their longest sentence, not to 128
+            trainer = BucketedTrainer(
                 args=training_args,
                 model=model.model,
+                data_collator=dynamic_padding_collator,
                 # optimizers=(optimizer, None),
-                train_dataset=train_dataset.get_trainable_data(self.tokenizer, 128),
-                eval_dataset=validation_dataset.get_trainable_data(self.tokenizer, 128),
+                train_dataset=cached_trainable_data(
+                    train_dataset, self.tokenizer, 128, cache_dir
+                ),
+                eval_dataset=cached_trainable_data(
+                    validation_dataset, self.tokenizer, 128, cache_dir
+                ),
                 compute_metrics=compute_metrics,
             )
-            trainer.train()
-            trainer.save_model(checkpoint_path)
+            resume_from = None
+            if action == RESUME:
+                resume_from = latest_trainer_checkpoint(checkpoint_path)
+                print("resuming training from", resume_from)
+            else:
+                print("start training")
+            # the manifest of an unfinished run, so an interrupted run is resumed
+            os.makedirs(model_path, exist_ok=True)
+            manifest.save(model_path)
+            if "resume_from_checkpoint" in inspect.signature(trainer.train).parameters:
+                trainer.train(resume_from_checkpoint=resume_from)
+            else:
+                trainer.train(model_path=resume_from)
+            trainer.save_model(model_path)
+            manifest.record_weights(model_path)
             model = model.model
         else:
             print("loading model from", model_path)
@@ -153,7 +238,12 @@ class AutoPipelineForVision:
         training_process=None,
         device=0,
         finetune=True,
+        require_checkpoint=False,
     ):
+        """
+        require_checkpoint: raise FileNotFoundError instead of serving an
+            untrained model when there is no usable checkpoint at model_path.
+        """
         datasets = get_dataset(dataset_name)
         model = build_model(model_name, num_labels=2, max_length=128, device=device)
         self.device = device
@@ -168,6 +258,9 @@ class AutoPipelineForVision:
                 model_path,
                 checkpoint_path,
                 compute_metrics=compute_metrics,
+                model_name=model_name,
+                dataset_name=dataset_name,
+                require_checkpoint=require_checkpoint,
             )
         return VisionPipeline(
             scenario,
@@ -188,12 +281,27 @@ class AutoPipelineForVision:
         model_path,
         checkpoint_path,
         compute_metrics=None,
+        model_name=None,
+        dataset_name=None,
+        require_checkpoint=False,
     ):
-        if not model_path or len(os.listdir(checkpoint_path)) == 0:
-            print("start training")
-            pass
-        else:
-            model.load_state_dict(torch.load(model_path, map_location=self.device))
+        """
+        Loads the weights at model_path when their manifest (see
+        CheckpointManifest) matches this model and dataset. Vision models are
+        not trained here: without a usable checkpoint the model keeps its
+        initial weights, or FileNotFoundError is raised with require_checkpoint.
+        """
+        manifest = CheckpointManifest(model_name, dataset_name, {}, data_hash(train_dataset))
+        if not model_path or manifest.action(model_path) != REUSE:
+            message = "no usable checkpoint of {} on {} at {}".format(
+                model_name, dataset_name, model_path
+            )
+            if require_checkpoint:
+                raise FileNotFoundError(message)
+            print(message + ", the model is not trained")
+            model.to(self.device)
+            return model
+        load_checkpoint(model, model_path, self.device)
         model.to(self.device)
         return model
 
@@ -217,17 +325,33 @@ class AutoPipelineForSec:
         print(dataset_name)
 
         datasets = get_dataset(dataset_name)
-        self.model = build_model(model_name, num_labels=2, max_length=128, device=0)
-        self.model.to(device)
         train_dataset = datasets["train"]
         test_dataset = datasets["test"]
 
-        if not model_path or len(os.listdir(checkpoint_path)) == 0:
-            self.model = self.train(self.model, train_dataset, device)
-            torch.save(self.model.state_dict(), checkpoint_path+'malimg.pth')
+        epoches = 10
+        manifest = CheckpointManifest(
+            model_name,
+            dataset_name,
+            {"epoches": epoches, "batch_size": 100, "optimizer": "Adam"},
+            # the image files are hashed by path, size and mtime, not read
+            data_hash(train_dataset),
+        )
+        # the decision and the weights are both about model_path, the file that is loaded
+        if not model_path:
+            model_path = os.path.join(checkpoint_path, "malimg.pth")
+        if manifest.action(model_path) != REUSE:
+            self.model = build_model(model_name, num_labels=2, max_length=128, device=0)
+            self.model.to(device)
+            self.model = self.train(self.model, train_dataset, device, epoches)
+            torch.save(self.model.state_dict(), model_path)
+            manifest.record_weights(model_path)
 
         else:
-            self.model.load_state_dict(torch.load(model_path, map_location="cuda:"+str(device)))
+            # built without random initialization, the weights are memory-mapped
+            self.model = build_model(
+                model_name, num_labels=2, max_length=128, device=0, pretrained_file=model_path
+            )
+            self.model.to(int_to_device(device) if isinstance(device, int) else device)
             print("train:")
             self.test(self.model, train_dataset, device)
             print("test:")
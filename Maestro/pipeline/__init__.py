@@ -1,2 +1,12 @@
-from Maestro.pipeline.pipeline import Pipeline, VisionPipeline, Scenario, AttackerAccess
+from Maestro.pipeline.pipeline import (
+    Pipeline,
+    VisionPipeline,
+    Scenario,
+    AttackerAccess,
+    IterativeAttackRecipe,
+    ExecutionPolicy,
+    QueryBudget,
+)
+from Maestro.pipeline.bucketing import LengthBucketSampler, BucketedTrainer, dynamic_padding_collator
+from Maestro.pipeline.checkpoint import CheckpointManifest
 from Maestro.pipeline.AutoPipeline import AutoPipelineForNLP, AutoPipelineForVision, AutoPipelineForSec
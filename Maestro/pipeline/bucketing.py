@@ -0,0 +1,126 @@
+from typing import Any, Dict, Iterator, List, Sequence
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Sampler
+from transformers import Trainer
+from transformers.data.data_collator import default_data_collator
+
+# columns that are padded along the sequence dimension
+SEQUENCE_COLUMNS = ["input_ids", "attention_mask", "token_type_ids"]
+
+
+def round_up(length: int, multiple: int) -> int:
+    if not multiple:
+        return length
+    return (length + multiple - 1) // multiple * multiple
+
+
+def sequence_lengths(dataset) -> np.ndarray:
+    """
+    Number of real (non padding) tokens of every example, read from the
+    attention masks; memory-mapped TokenizedDatasets are summed in one go.
+    """
+    columns = getattr(dataset, "columns", None)
+    if columns is not None and "attention_mask" in columns:
+        return np.asarray(columns["attention_mask"]).sum(axis=1)
+    return np.array(
+        [int(np.asarray(dataset[i]["attention_mask"]).sum()) for i in range(len(dataset))]
+    )
+
+
+class LengthBucketSampler(Sampler):
+    """
+    Batch sampler grouping examples of similar length: the (shuffled) examples
+    are split into pools of batch_size * bucket_size_multiplier, each pool is
+    sorted by length and cut into batches, and the batches are shuffled. Padded
+    batches then stay close to their longest example instead of max_length.
+    """
+
+    def __init__(
+        self,
+        lengths: Sequence[int],
+        batch_size: int,
+        shuffle: bool = True,
+        bucket_size_multiplier: int = 50,
+        drop_last: bool = False,
+        seed: int = 0,
+    ) -> None:
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.bucket_size_multiplier = bucket_size_multiplier
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+
+    def __iter__(self) -> Iterator[List[int]]:
+        rng = np.random.RandomState(self.seed + self.epoch)
+        self.epoch += 1
+        if self.shuffle:
+            indices = rng.permutation(len(self.lengths))
+        else:
+            indices = np.arange(len(self.lengths))
+        pool_size = self.batch_size * self.bucket_size_multiplier
+        batches = []
+        for start in range(0, len(indices), pool_size):
+            pool = indices[start : start + pool_size]
+            # stable, so equal lengths keep their (shuffled) order
+            pool = pool[np.argsort(self.lengths[pool], kind="stable")]
+            for batch_start in range(0, len(pool), self.batch_size):
+                batch = pool[batch_start : batch_start + self.batch_size]
+                if self.drop_last and len(batch) < self.batch_size:
+                    continue
+                batches.append(batch.tolist())
+        if self.shuffle:
+            rng.shuffle(batches)
+        return iter(batches)
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.lengths) // self.batch_size
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+
+def dynamic_padding_collator(
+    features: List[Dict[str, Any]], pad_to_multiple_of: int = 8
+) -> Dict[str, torch.Tensor]:
+    """
+    default_data_collator, then the sequence columns are cut down to the
+    longest example of the batch, rounded up to a multiple of pad_to_multiple_of.
+    Expects right padded examples, like the ones of get_trainable_data.
+    """
+    batch = default_data_collator(features)
+    if "attention_mask" not in batch:
+        return batch
+    width = batch["attention_mask"].shape[1]
+    length = int(batch["attention_mask"].sum(dim=1).max())
+    length = min(width, round_up(max(length, 1), pad_to_multiple_of))
+    for name in SEQUENCE_COLUMNS:
+        if name in batch:
+            batch[name] = batch[name][:, :length]
+    return batch
+
+
+class BucketedTrainer(Trainer):
+    """
+    Trainer feeding length bucketed batches to training (single process;
+    distributed runs keep the default loader). Evaluation and prediction keep
+    the dataset order, so predictions line up with the examples.
+    """
+
+    def get_train_dataloader(self) -> DataLoader:
+        if self.args.local_rank != -1:
+            return super(BucketedTrainer, self).get_train_dataloader()
+        return self._bucketed_dataloader(
+            self.train_dataset, self.args.train_batch_size, shuffle=True
+        )
+
+    def _bucketed_dataloader(self, dataset, batch_size, shuffle) -> DataLoader:
+        sampler = LengthBucketSampler(
+            sequence_lengths(dataset),
+            batch_size,
+            shuffle=shuffle,
+            drop_last=self.args.dataloader_drop_last,
+            seed=self.args.seed,
+        )
+        return DataLoader(dataset, batch_sampler=sampler, collate_fn=self.data_collator)
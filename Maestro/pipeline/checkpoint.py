@@ -0,0 +1,269 @@
+import glob
+import hashlib
+import json
+import os
+import re
+from typing import Any, Dict, List, Optional
+import numpy as np
+import torch
+from Maestro.utils.token_cache import dataset_identity
+
+# files holding the weights of a huggingface save_pretrained directory
+PRETRAINED_WEIGHT_FILES = ["config.json", "pytorch_model.bin", "model.safetensors"]
+MANIFEST_FILE = "maestro_manifest.json"
+
+REUSE = "reuse"
+RESUME = "resume"
+TRAIN = "train"
+
+
+def data_hash(*datasets) -> str:
+    """
+    sha256 over the identity (name, subset, split, size) and the content of the
+    training splits. The content is read from what the dataset keeps in bulk
+    when it can: the columns of a TokenizedDataset, the data/targets arrays of
+    torchvision style datasets or the fingerprint huggingface datasets keep of
+    their arrow files. Datasets reading their examples from image files (e.g.
+    ImageFolder) are hashed by the path, size and modification time of the
+    files; other datasets are hashed example by example.
+    """
+    digest = hashlib.sha256()
+    for dataset in datasets:
+        digest.update(json.dumps(dataset_identity(dataset), sort_keys=True).encode())
+        arrays = _bulk_arrays(dataset)
+        fingerprint = _fingerprint(dataset)
+        samples = _file_samples(dataset)
+        if arrays is not None:
+            _update(digest, arrays)
+        elif fingerprint is not None:
+            digest.update(fingerprint.encode())
+        elif samples is not None:
+            for name, path, target in samples:
+                info = os.stat(path)
+                digest.update(repr((name, info.st_size, info.st_mtime_ns, target)).encode())
+        else:
+            for index in range(len(dataset)):
+                _update(digest, dataset[index])
+    return digest.hexdigest()
+
+
+def _bulk_arrays(dataset) -> Optional[Dict[str, Any]]:
+    columns = getattr(dataset, "columns", None)
+    if isinstance(columns, dict):
+        return columns
+    arrays = {
+        name: getattr(dataset, name)
+        for name in ("data", "targets")
+        if isinstance(getattr(dataset, name, None), (np.ndarray, torch.Tensor))
+    }
+    return arrays if "data" in arrays else None
+
+
+def _file_samples(dataset) -> Optional[List[Any]]:
+    """
+    (name, path, target) of the examples of torchvision's DatasetFolder or
+    ImageFolder (or of a Subset of one, e.g. from random_split), the name is
+    the path relative to the dataset's root.
+    """
+    indices = getattr(dataset, "indices", None)
+    if indices is not None and hasattr(dataset, "dataset"):
+        samples = _file_samples(dataset.dataset)
+        return None if samples is None else [samples[int(i)] for i in indices]
+    samples = getattr(dataset, "samples", None)
+    if not isinstance(samples, list) or len(samples) != len(dataset):
+        return None
+    if not all(isinstance(sample, (tuple, list)) and isinstance(sample[0], str) for sample in samples):
+        return None
+    root = getattr(dataset, "root", None)
+    return [
+        (os.path.relpath(sample[0], root) if root else sample[0], sample[0], sample[1])
+        for sample in samples
+    ]
+
+
+def _fingerprint(dataset) -> Optional[str]:
+    # huggingface datasets.Dataset, also when wrapped (e.g. textattack's _dataset)
+    candidates = [dataset, getattr(dataset, "_dataset", None), getattr(dataset, "dataset", None)]
+    for candidate in candidates:
+        fingerprint = getattr(candidate, "_fingerprint", None)
+        if isinstance(fingerprint, str):
+            return fingerprint
+    return None
+
+
+def _update(digest, value) -> None:
+    """ feeds a (nested) example to the digest, type and shape included """
+    if isinstance(value, torch.Tensor):
+        value = value.detach().cpu()
+        if value.dtype == torch.bfloat16:
+            value = value.float()
+        value = value.numpy()
+    if isinstance(value, np.ndarray):
+        value = np.ascontiguousarray(value)
+        digest.update("{}{}".format(value.dtype.str, value.shape).encode())
+        digest.update(value.tobytes())
+    elif isinstance(value, dict):
+        for key in sorted(value, key=str):
+            digest.update(repr(key).encode())
+            _update(digest, value[key])
+    elif isinstance(value, (list, tuple)):
+        digest.update("[{}".format(len(value)).encode())
+        for item in value:
+            _update(digest, item)
+    elif hasattr(value, "tobytes"):
+        # PIL images
+        digest.update(repr((type(value).__name__, getattr(value, "size", None))).encode())
+        digest.update(value.tobytes())
+    else:
+        digest.update(repr(value).encode())
+
+
+def weight_files(path: str) -> List[str]:
+    """
+    The weight files of a checkpoint: the file itself, or the pretrained
+    weight files of a save_pretrained directory.
+    """
+    if os.path.isfile(path):
+        return [path]
+    files = [os.path.join(path, name) for name in PRETRAINED_WEIGHT_FILES]
+    files = [name for name in files if os.path.isfile(name)]
+    # a config without weights is not a checkpoint
+    if all(os.path.basename(name) == "config.json" for name in files):
+        return []
+    return files
+
+
+def weights_hash(path: str) -> Optional[str]:
+    files = weight_files(path)
+    if not files:
+        return None
+    digest = hashlib.sha256()
+    for name in files:
+        digest.update(os.path.basename(name).encode())
+        with open(name, "rb") as f:
+            for block in iter(lambda: f.read(1 << 24), b""):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def latest_trainer_checkpoint(output_dir: str) -> Optional[str]:
+    """
+    The checkpoint-<step> directory with the highest step written by Trainer.
+    """
+    checkpoints = []
+    for path in glob.glob(os.path.join(output_dir, "checkpoint-*")):
+        match = re.match(r".*checkpoint-(\d+)$", path)
+        if match and os.path.isdir(path):
+            checkpoints.append((int(match.group(1)), path))
+    return max(checkpoints)[1] if checkpoints else None
+
+
+class CheckpointManifest:
+    """
+    What a checkpoint was trained from: model name, dataset, hyperparameters and
+    a hash of the training data, plus the hash of the weights once training
+    finished. It is kept next to the checkpoint (<dir>/maestro_manifest.json or
+    <file>.manifest.json) and decides whether AutoPipeline reuses the weights,
+    resumes an interrupted training run or trains from scratch.
+    """
+
+    def __init__(
+        self,
+        model_name: str,
+        dataset_name: str,
+        hyperparameters: Dict[str, Any] = None,
+        data_hash: str = None,
+        weights_hash: str = None,
+        weights_stat: List[int] = None,
+    ) -> None:
+        self.model_name = model_name
+        self.dataset_name = dataset_name
+        self.hyperparameters = hyperparameters or {}
+        self.data_hash = data_hash
+        self.weights_hash = weights_hash
+        # (size, mtime_ns) of the weights when they were hashed, unchanged
+        # weights are not hashed again on every start
+        self.weights_stat = weights_stat
+
+    @staticmethod
+    def path(checkpoint: str) -> str:
+        if os.path.isdir(checkpoint) or checkpoint.endswith(os.sep):
+            return os.path.join(checkpoint, MANIFEST_FILE)
+        return checkpoint + ".manifest.json"
+
+    @classmethod
+    def load(cls, checkpoint: str) -> Optional["CheckpointManifest"]:
+        path = cls.path(checkpoint)
+        if not os.path.isfile(path):
+            return None
+        with open(path) as f:
+            return cls(**json.load(f))
+
+    def save(self, checkpoint: str) -> None:
+        path = self.path(checkpoint)
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp_path, "w") as f:
+            json.dump(vars(self), f, indent=2, sort_keys=True)
+        os.replace(tmp_path, path)
+
+    def same_training(self, other: "CheckpointManifest") -> bool:
+        """
+        Whether both describe the same model, data and hyperparameters.
+        """
+        return (
+            self.model_name == other.model_name
+            and self.dataset_name == other.dataset_name
+            and self.data_hash == other.data_hash
+            # through JSON so tuples and lists compare equal
+            and json.loads(json.dumps(self.hyperparameters, sort_keys=True))
+            == json.loads(json.dumps(other.hyperparameters, sort_keys=True))
+        )
+
+    def record_weights(self, checkpoint: str) -> None:
+        """
+        Hashes the finished weights and saves the manifest next to them.
+        """
+        self.weights_hash = weights_hash(checkpoint)
+        self.weights_stat = _stat(checkpoint)
+        self.save(checkpoint)
+
+    def action(self, checkpoint: str, output_dir: str = None) -> str:
+        """
+        REUSE when the checkpoint holds finished weights of this training
+        configuration, RESUME when a run of this configuration was interrupted
+        and output_dir holds Trainer checkpoints, TRAIN otherwise.
+
+        Weights without a manifest (saved before manifests existed) are adopted
+        for this configuration instead of being retrained; everything else, e.g.
+        stray files or weights of another configuration, is never loaded.
+        """
+        existing = CheckpointManifest.load(checkpoint)
+        if existing is None:
+            if weight_files(checkpoint):
+                print("adopting unversioned weights", checkpoint)
+                self.record_weights(checkpoint)
+                return REUSE
+            return TRAIN
+        if not existing.same_training(self):
+            print("checkpoint", checkpoint, "was trained with another configuration")
+            return TRAIN
+        if existing.weights_hash is not None and weight_files(checkpoint):
+            if existing.weights_stat == _stat(checkpoint):
+                return REUSE
+            if existing.weights_hash == weights_hash(checkpoint):
+                existing.weights_stat = _stat(checkpoint)
+                existing.save(checkpoint)
+                return REUSE
+            print("weights of", checkpoint, "do not match their manifest")
+            return TRAIN
+        if output_dir is not None and latest_trainer_checkpoint(output_dir) is not None:
+            return RESUME
+        return TRAIN
+
+
+def _stat(checkpoint: str) -> List[int]:
+    stat = []
+    for name in weight_files(checkpoint):
+        info = os.stat(name)
+        stat.extend([info.st_size, info.st_mtime_ns])
+    return stat
@@ -3,10 +3,17 @@ import torch.nn as nn
 import torch.nn.functional as F
 from typing import List, Iterator, Dict, Tuple, Any, Type
 import torch.optim as optim
+import numpy as np
+import copy
+import threading
 from functools import wraps
+from contextlib import contextmanager, ExitStack
 import yaml
 from Maestro.data import DataModifier
-from Maestro.utils import move_to_device, get_embedding
+from Maestro.utils import move_to_device, get_embedding, model_fingerprint, metrics
+from Maestro.utils.utils import int_to_device
+from Maestro.constraints import Epsilon
+from Maestro.pipeline.bucketing import round_up
 from transformers.data.data_collator import default_data_collator
 
 # not supposed to use this
@@ -27,6 +34,8 @@ class Scenario:
         self.attacker_access = None
         self.target = None
         self.constraint = None
+        self.execution_policy = ExecutionPolicy()
+        self.query_budget = QueryBudget()
 
     def load_from_yaml(self, yaml_file) -> None:
         with open(yaml_file) as f:
@@ -35,6 +44,10 @@ class Scenario:
             self.constraint = data["Attack Method"]["constraint"]
             self.attacker_access = AttackerAccess()
             self.attacker_access.load_from_yaml(data["Attacker Access"])
+            self.execution_policy = ExecutionPolicy()
+            self.execution_policy.load_from_yaml(data.get("Execution") or {})
+            self.query_budget = QueryBudget()
+            self.query_budget.load_from_yaml(data.get("Query Budget") or {})
 
 
 # def get_access_level(access_dict: Dict[str, bool]) -> int:
@@ -78,6 +91,263 @@ class AttackerAccess:
         self.output_access_level = data["output_access"]
 
 
+class ExecutionPolicy:
+    """
+    How an application runs its output queries:
+        inference_mode: run them under torch.inference_mode instead of no_grad
+            (torch >= 1.9, no_grad on older versions).
+        autocast: "bf16" or "fp16" to autocast the forward pass where the device
+            supports it (bf16 on CPU and CUDA, fp16 on CUDA only); outputs are
+            returned as float32. Gradient queries always run in float32.
+            Needs torch.autocast (torch >= 1.10).
+        channels_last: keep the weights and the 4-d inputs of CNNs channels last.
+        cpu_threads / cpu_interop_threads: torch CPU thread pools. These are
+            process wide, so the last loaded application setting them wins.
+        cpu_backend: how vision models answer output queries on CPU, "eager"
+            (the default), "torchscript" (traced, frozen and optimized for
+            inference, needs torch.jit.freeze from torch >= 1.8) or "compile"
+            (torch.compile, torch >= 2.0).
+        quantize: "dynamic_int8" quantizes the Linear layers of the CPU serving
+            model dynamically to int8.
+    The CPU serving model is a copy: gradients still come from the eager fp32 model.
+    """
+
+    AUTOCAST_DTYPES = {"bf16": torch.bfloat16, "fp16": torch.float16}
+    CPU_BACKENDS = ["eager", "torchscript", "compile"]
+    QUANTIZATION = ["dynamic_int8"]
+
+    def __init__(
+        self,
+        inference_mode: bool = True,
+        autocast: str = None,
+        channels_last: bool = False,
+        cpu_threads: int = None,
+        cpu_interop_threads: int = None,
+        cpu_backend: str = "eager",
+        quantize: str = None,
+    ) -> None:
+        if autocast is not None and autocast not in self.AUTOCAST_DTYPES:
+            raise ValueError(
+                "autocast must be one of {}, got {}".format(list(self.AUTOCAST_DTYPES), autocast)
+            )
+        if autocast is not None and not hasattr(torch, "autocast"):
+            raise ValueError("autocast requires torch >= 1.10, got {}".format(torch.__version__))
+        if cpu_backend not in self.CPU_BACKENDS:
+            raise ValueError(
+                "cpu_backend must be one of {}, got {}".format(self.CPU_BACKENDS, cpu_backend)
+            )
+        if cpu_backend == "torchscript" and not hasattr(torch.jit, "freeze"):
+            raise ValueError(
+                "cpu_backend torchscript requires torch >= 1.8, got {}".format(torch.__version__)
+            )
+        if cpu_backend == "compile" and not hasattr(torch, "compile"):
+            raise ValueError(
+                "cpu_backend compile requires torch >= 2.0, got {}".format(torch.__version__)
+            )
+        if quantize is not None and quantize not in self.QUANTIZATION:
+            raise ValueError(
+                "quantize must be one of {}, got {}".format(self.QUANTIZATION, quantize)
+            )
+        self.inference_mode = inference_mode
+        self.autocast = autocast
+        self.channels_last = channels_last
+        self.cpu_threads = cpu_threads
+        self.cpu_interop_threads = cpu_interop_threads
+        self.cpu_backend = cpu_backend
+        self.quantize = quantize
+
+    def load_from_yaml(self, data) -> None:
+        self.__init__(
+            inference_mode=data.get("inference_mode", True),
+            autocast=data.get("autocast"),
+            channels_last=data.get("channels_last", False),
+            cpu_threads=data.get("cpu_threads"),
+            cpu_interop_threads=data.get("cpu_interop_threads"),
+            cpu_backend=data.get("cpu_backend") or "eager",
+            quantize=data.get("quantize"),
+        )
+
+    def apply(self, model: nn.Module) -> nn.Module:
+        """
+        Applies the model wide settings once, when the pipeline is built.
+        """
+        if self.cpu_threads:
+            torch.set_num_threads(self.cpu_threads)
+        if self.cpu_interop_threads:
+            try:
+                torch.set_num_interop_threads(self.cpu_interop_threads)
+            except RuntimeError:
+                # can only be set before the first inter-op parallel work
+                pass
+        if self.channels_last:
+            model.to(memory_format=torch.channels_last)
+        return model
+
+    def uses_serving_model(self, device) -> bool:
+        return int_to_device(device).type == "cpu" and (
+            self.cpu_backend != "eager" or self.quantize is not None
+        )
+
+    def build_serving_model(self, model: nn.Module, example: torch.Tensor) -> nn.Module:
+        """
+        Builds the CPU serving copy of a vision model; `example` is a batch of
+        inputs used to trace the model.
+        """
+        serving_model = copy.deepcopy(model).cpu().eval()
+        if self.quantize == "dynamic_int8":
+            serving_model = torch.quantization.quantize_dynamic(
+                serving_model, {nn.Linear}, dtype=torch.qint8
+            )
+        if self.cpu_backend == "torchscript":
+            with torch.no_grad():
+                serving_model = torch.jit.trace(serving_model, example)
+                serving_model = torch.jit.freeze(serving_model)
+                if hasattr(torch.jit, "optimize_for_inference"):
+                    serving_model = torch.jit.optimize_for_inference(serving_model)
+        elif self.cpu_backend == "compile":
+            serving_model = torch.compile(serving_model)
+        return serving_model
+
+    def prepare_input(self, x: torch.Tensor) -> torch.Tensor:
+        if self.channels_last and x.dim() == 4:
+            return x.contiguous(memory_format=torch.channels_last)
+        return x
+
+    def _autocast_dtype(self, device_type: str):
+        if self.autocast == "bf16" and device_type in ("cpu", "cuda"):
+            return torch.bfloat16
+        if self.autocast == "fp16" and device_type == "cuda":
+            return torch.float16
+        return None
+
+    @contextmanager
+    def output_context(self, device):
+        """
+        Context of the forward pass of an output (no gradient) query.
+        """
+        device_type = int_to_device(device).type
+        with ExitStack() as stack:
+            if self.inference_mode and hasattr(torch, "inference_mode"):
+                stack.enter_context(torch.inference_mode())
+            else:
+                stack.enter_context(torch.no_grad())
+            dtype = self._autocast_dtype(device_type)
+            if dtype is not None:
+                stack.enter_context(torch.autocast(device_type, dtype=dtype))
+            yield
+
+    def cast_outputs(self, outputs):
+        """
+        Returns autocast outputs as float32 like the rest of the server expects.
+        """
+        if isinstance(outputs, torch.Tensor):
+            return outputs.float() if outputs.is_floating_point() else outputs
+        if isinstance(outputs, (tuple, list)):
+            return type(outputs)(self.cast_outputs(output) for output in outputs)
+        return outputs
+
+
+class QueryBudget:
+    """
+    How much each attacker may query an application, enforced by the server:
+        forward_queries: output queries, every scored candidate counts as one.
+        gradient_queries: gradient queries, every iterative attack step counts
+            as one.
+        examples: examples processed over all queries.
+        rate: sustained queries per second (token bucket), burst: the number
+            of queries that can be sent at once (defaults to rate).
+    None means unlimited.
+    """
+
+    LIMITS = ["forward_queries", "gradient_queries", "examples"]
+
+    def __init__(
+        self,
+        forward_queries: int = None,
+        gradient_queries: int = None,
+        examples: int = None,
+        rate: float = None,
+        burst: float = None,
+    ) -> None:
+        if rate is not None and rate <= 0:
+            raise ValueError("rate must be positive, got {}".format(rate))
+        self.forward_queries = forward_queries
+        self.gradient_queries = gradient_queries
+        self.examples = examples
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+
+    def load_from_yaml(self, data) -> None:
+        self.__init__(
+            forward_queries=data.get("forward_queries"),
+            gradient_queries=data.get("gradient_queries"),
+            examples=data.get("examples"),
+            rate=data.get("rate"),
+            burst=data.get("burst"),
+        )
+
+    def limits(self) -> Dict[str, int]:
+        return {name: getattr(self, name) for name in self.LIMITS}
+
+
+class IterativeAttackRecipe:
+    """
+    Parameters of a PGD/BIM style attack that VisionPipeline runs on the server.
+    Values may come in as strings (query parameters) and are converted here;
+    invalid ones raise ValueError.
+    """
+
+    FIELDS = [
+        "epsilon",
+        "step_size",
+        "steps",
+        "norm",
+        "random_start",
+        "clip_min",
+        "clip_max",
+        "report_every",
+    ]
+
+    def __init__(
+        self,
+        epsilon: float = 0.3,
+        step_size: float = 2 / 255,
+        steps: int = 10,
+        norm: str = "linf",
+        random_start: bool = False,
+        clip_min: float = 0.0,
+        clip_max: float = 1.0,
+        report_every: int = 1,
+    ) -> None:
+        self.norm = str(norm).lower()
+        if self.norm not in ("linf", "l2"):
+            raise ValueError("norm must be 'linf' or 'l2', got {}".format(norm))
+        self.epsilon = float(epsilon)
+        self.step_size = float(step_size)
+        self.steps = int(steps)
+        if isinstance(random_start, str):
+            random_start = random_start.lower() in ("1", "true", "yes")
+        self.random_start = bool(random_start)
+        self.clip_min = float(clip_min)
+        self.clip_max = float(clip_max)
+        self.report_every = max(int(report_every), 1)
+        if self.epsilon < 0 or self.step_size < 0 or self.steps < 0:
+            raise ValueError("epsilon, step_size and steps must not be negative")
+        if self.clip_min > self.clip_max:
+            raise ValueError(
+                "clip_min {} is larger than clip_max {}".format(self.clip_min, self.clip_max)
+            )
+
+    @classmethod
+    def from_dict(cls, recipe: Dict[str, Any]) -> "IterativeAttackRecipe":
+        unknown = sorted(set(recipe) - set(cls.FIELDS))
+        if unknown:
+            raise ValueError(
+                "unknown recipe arguments {}, expected some of {}".format(unknown, cls.FIELDS)
+            )
+        return cls(**recipe)
+
+
 class Pipeline:
     """
     Pipeline contains everything.
@@ -93,6 +363,9 @@ class Pipeline:
         training_process,
         device: int,
         tokenizer,
+        canonicalize: bool = False,
+        max_length: int = 128,
+        pad_to_multiple_of: int = 8,
     ) -> None:
         self.scenario = scenario
         self.training_data = training_data
@@ -102,6 +375,13 @@ class Pipeline:
         self.training_process = training_process
         self.device = device
         self.tokenizer = tokenizer
+        # if True, incoming ids are decoded to text and tokenized again instead of
+        # being fed to the model as they are
+        self.canonicalize = canonicalize
+        self.max_length = max_length
+        # batches are padded to their longest sequence rounded up to this multiple
+        # (tensor core friendly), never to max_length
+        self.pad_to_multiple_of = pad_to_multiple_of
 
         # adding methods for getting the prediction and the outputs
         # getting the data modifier
@@ -114,6 +394,73 @@ class Pipeline:
         self.test_data = DataModifier(
             self.test_data, self.scenario.attacker_access.test_data_access_level
         )
+        self.execution_policy = getattr(scenario, "execution_policy", None) or ExecutionPolicy()
+        self.execution_policy.apply(self.model)
+
+    def _encode_batch(self, x, reserve: int = 0) -> Dict[str, torch.Tensor]:
+        """
+        Builds input_ids/attention_mask/token_type_ids for a batch of token ids.
+        The ids are used as they are: every row must start with [CLS] and end
+        with [SEP] before its trailing padding (ValueError otherwise), so the
+        positions of the returned gradients are the positions the client sent.
+        Rows longer than max_length lose the tokens before their [SEP]. The
+        decode/encode round trip is only done in canonicalize mode. `reserve` positions are left free below max_length for
+        tokens inserted afterwards (e.g. triggers). The batch is padded to its
+        longest sequence, rounded up to a multiple of pad_to_multiple_of.
+        """
+        max_length = self.max_length - reserve
+        device = self.device
+        if self.canonicalize:
+            # the tokenizer rounds up after truncating, only round when that stays in bounds
+            multiple = self.pad_to_multiple_of
+            if multiple and max_length % multiple:
+                multiple = None
+            decoded_x = self.tokenizer.batch_decode(x, skip_special_tokens=True)
+            return self.tokenizer.batch_encode_plus(
+                decoded_x,
+                max_length=max_length,
+                truncation=True,
+                padding=True,
+                pad_to_multiple_of=multiple,
+                return_tensors="pt",
+            ).to(device)
+
+        tokenizer = self.tokenizer
+        vocab_size = len(tokenizer)
+        pad_id = tokenizer.pad_token_id
+        cls_id = tokenizer.cls_token_id
+        sep_id = tokenizer.sep_token_id
+        rows = []
+        for index, row in enumerate(x):
+            row = np.asarray(row, dtype=np.int64)
+            if row.size and (row.min() < 0 or row.max() >= vocab_size):
+                raise ValueError(
+                    "token ids must be in [0, {}), got {}".format(vocab_size, row)
+                )
+            non_pad = np.nonzero(row != pad_id)[0]
+            row = row[: non_pad[-1] + 1].tolist() if len(non_pad) else []
+            if cls_id is not None and (not row or row[0] != cls_id):
+                raise ValueError("row {} does not start with [CLS] ({})".format(index, cls_id))
+            if sep_id is not None and (not row or row[-1] != sep_id):
+                raise ValueError(
+                    "row {} does not end with [SEP] ({}) before its padding".format(index, sep_id)
+                )
+            if len(row) > max_length:
+                row = row[: max_length - 1] + row[-1:]
+            rows.append(row)
+
+        length = max(len(row) for row in rows)
+        # rounding up never pads past max_length
+        length = max(length, min(round_up(length, self.pad_to_multiple_of), max_length))
+        input_ids = torch.full((len(rows), length), pad_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(rows), length), dtype=torch.long)
+        for i, row in enumerate(rows):
+            input_ids[i, : len(row)] = torch.LongTensor(row)
+            attention_mask[i, : len(row)] = 1
+        inputs = {"input_ids": input_ids, "attention_mask": attention_mask}
+        if "token_type_ids" in getattr(tokenizer, "model_input_names", ["token_type_ids"]):
+            inputs["token_type_ids"] = torch.zeros_like(input_ids)
+        return {name: tensor.to(device) for name, tensor in inputs.items()}
 
     def _get_inputs(self, x, data_type="train", nlp=True):
         data = None
@@ -142,20 +489,17 @@ class Pipeline:
         assert self.scenario.attacker_access.output_access_level["output"] == True
         device = self.device
         # print(x)
-        decoded_x = self.tokenizer.batch_decode(x, skip_special_tokens=True)
-        x = self.tokenizer.batch_encode_plus(
-            decoded_x,
-            max_length=128,
-            truncation=True,
-            padding=True,
-            return_tensors="pt",
-        ).to(device)
+        with metrics.timer("tokenize"):
+            x = self._encode_batch(x)
         # x = obj._get_inputs(x, data_type)
         x["labels"] = torch.LongTensor(labels).to(device)
-        with torch.no_grad():
-            print("get batch output:", x["input_ids"].shape)
+        metrics.observe("batch_size", x["input_ids"].shape[0])
+        policy = self.execution_policy
+        with policy.output_context(device), metrics.timer(
+            "forward", shape=list(x["input_ids"].shape)
+        ):
             output = self.model(**x)
-        return output
+        return policy.cast_outputs(output)
 
     def get_input_gradient(self, x_id, data_type="train", pred_hook=lambda x: x):
         assert self.scenario.attacker_access.output_access_level["gradient"] == True
@@ -171,8 +515,6 @@ class Pipeline:
         self.model.zero_grad()
         loss.backward()
         x_grad = x.grad.data
-        print("pipeline")
-        print(x_grad)
         return x_grad
 
     def get_batch_input_gradient(self, x, labels):
@@ -189,32 +531,120 @@ class Pipeline:
         hooks.append(embedding.register_forward_hook(hook_layers))
         # print(torch.cuda.memory_summary(device=0, abbreviated=True))
 
-        decoded_x = self.tokenizer.batch_decode(x, skip_special_tokens=True)
-        print(decoded_x)
-        x = self.tokenizer.batch_encode_plus(
-            decoded_x,
-            max_length=128,
-            truncation=True,
-            padding=True,
-            return_tensors="pt",
-        ).to(device)
+        with metrics.timer("tokenize"):
+            x = self._encode_batch(x)
         # print(x["input_ids"])
         # print(pred_hook(x)["input_ids"])
         x["labels"] = torch.LongTensor(labels).to(device)
-        outputs = self.model(**x)
+        metrics.observe("batch_size", x["input_ids"].shape[0])
+        with metrics.timer("forward", shape=list(x["input_ids"].shape)):
+            outputs = self.model(**x)
         # print(outputs)
         loss = outputs[0]
         # print(loss)
-        embedding_gradients_auto = torch.autograd.grad(
-            loss, embedding_outputs[0], create_graph=False
-        )
+        with metrics.timer("backward"):
+            embedding_gradients_auto = torch.autograd.grad(
+                loss, embedding_outputs[0], create_graph=False
+            )
         for hook in hooks:
             hook.remove()
         return embedding_gradients_auto[0]
 
+    def get_batch_output_and_gradient(self, x, labels):
+        """
+        Runs one forward/backward pass and returns the per-example loss, the
+        logits and the gradient of the mean loss w.r.t. the embedding outputs,
+        i.e. what get_batch_output and get_batch_input_gradient return together.
+        """
+        assert self.scenario.attacker_access.output_access_level["output"] == True
+        assert self.scenario.attacker_access.output_access_level["gradient"] == True
+        device = self.device
+        embedding_outputs = []
+
+        def hook_layers(module, grad_in, grad_out):
+            embedding_outputs.append(grad_out)
+
+        embedding = get_embedding(self.model)
+        hook = embedding.register_forward_hook(hook_layers)
+        try:
+            with metrics.timer("tokenize"):
+                x = self._encode_batch(x)
+            labels = torch.LongTensor(labels).to(device)
+            metrics.observe("batch_size", x["input_ids"].shape[0])
+            with metrics.timer("forward", shape=list(x["input_ids"].shape)):
+                logits = self.model(**x)[0]
+                losses = F.cross_entropy(logits, labels, reduction="none")
+            with metrics.timer("backward"):
+                embedding_gradients = torch.autograd.grad(
+                    losses.mean(), embedding_outputs[0], create_graph=False
+                )
+        finally:
+            hook.remove()
+        return losses.detach(), logits.detach(), embedding_gradients[0]
+
+    def score_trigger_candidates(
+        self, x, labels, candidates, position: int = 1, max_rows: int = 256
+    ) -> torch.Tensor:
+        """
+        Returns the mean loss of the batch for every candidate trigger, i.e. what
+        get_batch_output(...)[0] gives for the batch with that trigger inserted at
+        `position` (1: right after [CLS]). The perturbed inputs are built on the
+        device and run in chunks of at most max_rows examples.
+        """
+        assert self.scenario.attacker_access.output_access_level["output"] == True
+        device = self.device
+        candidates = torch.as_tensor(np.asarray(candidates), dtype=torch.long)
+        if candidates.dim() == 1:
+            candidates = candidates.unsqueeze(0)
+        if candidates.numel() and (
+            candidates.min() < 0 or candidates.max() >= len(self.tokenizer)
+        ):
+            raise ValueError(
+                "token ids must be in [0, {}), got {}".format(len(self.tokenizer), candidates)
+            )
+        candidates = candidates.to(device)
+        num_candidates, trigger_length = candidates.shape
+        with metrics.timer("tokenize"):
+            inputs = self._encode_batch(x, reserve=trigger_length)
+        labels = torch.LongTensor(labels).to(device)
+        batch_size = labels.shape[0]
+        chunk = max(1, max_rows // batch_size)
+        losses = []
+        with self.execution_policy.output_context(device):
+            for start in range(0, num_candidates, chunk):
+                triggers = candidates[start : start + chunk]
+                repeats = triggers.shape[0]
+                # candidate major: rows [i * batch_size, (i + 1) * batch_size) use trigger i
+                trigger_ids = triggers.repeat_interleave(batch_size, dim=0)
+                perturbed = {}
+                for name, tensor in inputs.items():
+                    tensor = tensor.repeat(repeats, 1)
+                    if name == "input_ids":
+                        inserted = trigger_ids
+                    elif name == "attention_mask":
+                        inserted = torch.ones_like(trigger_ids)
+                    else:
+                        inserted = torch.zeros_like(trigger_ids)
+                    perturbed[name] = torch.cat(
+                        (tensor[:, :position], inserted, tensor[:, position:]), 1
+                    )
+                metrics.observe("batch_size", perturbed["input_ids"].shape[0])
+                with metrics.timer("forward", shape=list(perturbed["input_ids"].shape)):
+                    logits = self.model(**perturbed)[0]
+                loss = F.cross_entropy(
+                    logits.float(), labels.repeat(repeats), reduction="none"
+                )
+                losses.append(loss.view(repeats, batch_size).mean(1))
+        return torch.cat(losses) if losses else torch.zeros(0, device=device)
+
     def get_tokenizer(self):
         return self.tokenizer
 
+    def get_fingerprint(self) -> str:
+        if getattr(self, "_fingerprint", None) is None:
+            self._fingerprint = model_fingerprint(self.model)
+        return self._fingerprint
+
     # adding the training method
     # or we could return a trainer object
     def train(self):
@@ -278,6 +708,11 @@ class VisionPipeline:
         self.test_data = DataModifier(
             self.test_data, self.scenario.attacker_access.test_data_access_level
         )
+        self.execution_policy = getattr(scenario, "execution_policy", None) or ExecutionPolicy()
+        self.execution_policy.apply(self.model)
+        # CPU serving copies of the model by input shape, see ExecutionPolicy
+        self._serving_models = {}
+        self._serving_lock = threading.Lock()
 
     def get_batch_output(self, x, data_type="train"):
         assert self.scenario.attacker_access.output_access_level["output"] == True
@@ -285,23 +720,165 @@ class VisionPipeline:
         x_tensor = torch.FloatTensor(x)
         x_tensor = x_tensor.to(device)
         # print(self.model)
-        output = self.model(x_tensor)
-        return output
+        metrics.observe("batch_size", x_tensor.shape[0])
+        policy = self.execution_policy
+        x_tensor = policy.prepare_input(x_tensor)
+        model = self.model
+        if policy.uses_serving_model(device):
+            model = self._get_serving_model(x_tensor)
+        with policy.output_context(device), metrics.timer(
+            "forward", shape=list(x_tensor.shape)
+        ):
+            output = model(x_tensor)
+        return policy.cast_outputs(output)
+
+    def _get_serving_model(self, x_tensor):
+        """
+        The CPU serving copy of the model (see ExecutionPolicy), built on the
+        first output query of every input shape since traced graphs may
+        specialize on it.
+        """
+        key = tuple(x_tensor.shape[1:])
+        with self._serving_lock:
+            if key not in self._serving_models:
+                with metrics.timer("build_serving_model"):
+                    self._serving_models[key] = self.execution_policy.build_serving_model(
+                        self.model, x_tensor
+                    )
+            return self._serving_models[key]
+
+    def refresh_serving_model(self):
+        """ Drops the CPU serving copies, e.g. after the weights changed. """
+        with self._serving_lock:
+            self._serving_models = {}
+
+    def build_serving_model(self):
+        """
+        Builds the CPU serving copy for the shape of the test examples ahead of
+        the first query, e.g. before forking workers so they inherit it.
+        """
+        if not self.execution_policy.uses_serving_model(self.device):
+            return
+        data = self.test_data.get_write_data()
+        if len(data) == 0:
+            return
+        x_tensor = torch.FloatTensor(np.asarray(data[0][0])[None]).to(self.device)
+        self._get_serving_model(self.execution_policy.prepare_input(x_tensor))
 
     def get_batch_input_gradient(self, x, data_type="train"):
         assert self.scenario.attacker_access.output_access_level["gradient"] == True
         device = self.device
         x_tensor = torch.FloatTensor(x)
-        x_tensor = x_tensor.to(device)
+        x_tensor = self.execution_policy.prepare_input(x_tensor.to(device))
         x_tensor.requires_grad = True
-        print(x_tensor.shape)
-        output = self.model(x_tensor)
-        pred = output.max(1, keepdim=True)[1]
-        loss = F.nll_loss(output, pred[0])
-        self.model.zero_grad()
-        loss.backward()
+        metrics.observe("batch_size", x_tensor.shape[0])
+        with metrics.timer("forward", shape=list(x_tensor.shape)):
+            output = self.model(x_tensor)
+            pred = output.max(1, keepdim=True)[1]
+            loss = F.nll_loss(output, pred[0])
+        with metrics.timer("backward"):
+            self.model.zero_grad()
+            loss.backward()
         x_grad = x_tensor.grad.data
-        print("pipeline, get_batch_input_gradient")
         # print(x_grad)
         return x_grad
 
+    def get_batch_output_and_gradient(self, x, labels):
+        """
+        Runs one forward/backward pass and returns the per-example loss w.r.t.
+        labels, the outputs and the input gradient of the mean loss, i.e. what
+        get_batch_output and a labelled get_batch_input_gradient return together.
+        """
+        assert self.scenario.attacker_access.output_access_level["output"] == True
+        assert self.scenario.attacker_access.output_access_level["gradient"] == True
+        if labels is None or len(np.atleast_1d(labels)) != len(x):
+            raise ValueError("get_batch_output_and_gradient needs one label per example")
+        device = self.device
+        x_tensor = torch.FloatTensor(x)
+        x_tensor = self.execution_policy.prepare_input(x_tensor.to(device))
+        x_tensor.requires_grad = True
+        labels = torch.LongTensor(np.atleast_1d(labels)).to(device)
+        metrics.observe("batch_size", x_tensor.shape[0])
+        with metrics.timer("forward", shape=list(x_tensor.shape)):
+            output = self.model(x_tensor)
+            losses = F.nll_loss(output, labels, reduction="none")
+        with metrics.timer("backward"):
+            x_grad = torch.autograd.grad(losses.mean(), x_tensor)[0]
+        return losses.detach(), output.detach(), x_grad
+
+    def get_fingerprint(self) -> str:
+        if getattr(self, "_fingerprint", None) is None:
+            self._fingerprint = model_fingerprint(self.model)
+        return self._fingerprint
+
+    def run_iterative_attack(self, x, labels=None, recipe: IterativeAttackRecipe = None):
+        """
+        Runs an iterative (PGD/BIM) attack on the batch without leaving the device.
+        Yields a progress dict every recipe.report_every steps and finally
+        {"done": True, "adversarial": tensor, "violations": n, "max_distance": d}
+        where n counts the examples outside the epsilon ball (0 unless rounding
+        pushed one out). Without labels the model's predictions on the clean
+        batch are used as targets.
+        """
+        # checked eagerly, the steps only run once the caller starts iterating
+        assert self.scenario.attacker_access.output_access_level["gradient"] == True
+        recipe = recipe or IterativeAttackRecipe()
+        device = self.device
+        x_tensor = torch.FloatTensor(x).to(device)
+        if labels is None:
+            with torch.no_grad():
+                targets = self.model(x_tensor).max(1)[1]
+        else:
+            targets = torch.LongTensor(labels).to(device)
+        return self._iterative_attack_steps(x_tensor, targets, recipe)
+
+    def _iterative_attack_steps(self, x_tensor, targets, recipe: IterativeAttackRecipe):
+        adversarial = x_tensor.clone()
+        if recipe.random_start:
+            adversarial = adversarial + self._project(
+                torch.empty_like(x_tensor).uniform_(-recipe.epsilon, recipe.epsilon),
+                recipe,
+            )
+            adversarial = adversarial.clamp(recipe.clip_min, recipe.clip_max)
+        for step in range(recipe.steps):
+            adversarial.requires_grad = True
+            output = self.model(adversarial)
+            loss = F.nll_loss(output, targets, reduction="sum")
+            grad = torch.autograd.grad(loss, adversarial)[0]
+            with torch.no_grad():
+                if recipe.norm == "linf":
+                    adversarial = adversarial + recipe.step_size * grad.sign()
+                else:
+                    grad_norm = grad.flatten(1).norm(dim=1).clamp_min(1e-12)
+                    grad = grad / grad_norm.view(-1, *([1] * (grad.dim() - 1)))
+                    adversarial = adversarial + recipe.step_size * grad
+                delta = self._project(adversarial - x_tensor, recipe)
+                adversarial = (x_tensor + delta).clamp(recipe.clip_min, recipe.clip_max)
+            if (step + 1) % recipe.report_every == 0 or step + 1 == recipe.steps:
+                success = (output.max(1)[1] != targets).float().mean().item()
+                yield {
+                    "step": step + 1,
+                    "loss": loss.item() / len(targets),
+                    "success_rate": success,
+                }
+
+        # every step is projected onto the ball and clamped, what is left to
+        # report is rounding, which is not worth failing the whole stream for
+        with torch.no_grad():
+            violations, distances = Epsilon(recipe.epsilon, distance=recipe.norm).check(
+                x_tensor, adversarial
+            )
+        yield {
+            "done": True,
+            "adversarial": adversarial.detach(),
+            "violations": int(violations.sum().item()),
+            "max_distance": distances.max().item() if len(distances) else 0.0,
+        }
+
+    @staticmethod
+    def _project(delta, recipe: IterativeAttackRecipe):
+        if recipe.norm == "linf":
+            return delta.clamp(-recipe.epsilon, recipe.epsilon)
+        norm = delta.flatten(1).norm(dim=1).clamp_min(1e-12)
+        factor = (recipe.epsilon / norm).clamp(max=1.0)
+        return delta * factor.view(-1, *([1] * (delta.dim() - 1)))
@@ -2,128 +2,669 @@ import flask
 import argparse
 from flask import request, jsonify
 from models import load_all_applications
+from batching import MicroBatcher
+from serving import DeviceExecutor, serve, SERVERS, FORKING_SERVERS
+from budgets import BudgetLedger, SharedBudgetLedger, QueryBudgetExceeded
 import dill as pickle
 import json
-from Maestro.utils import list_to_json, get_embedding, get_json_data
+from Maestro.pipeline import Pipeline, IterativeAttackRecipe
+from Maestro.utils import (
+    list_to_json,
+    get_embedding,
+    get_json_instance,
+    select_examples,
+    TENSOR_CONTENT_TYPE,
+    encode_tensors,
+    decode_tensors,
+    metrics,
+    ResponseCache,
+    cache_key,
+)
 import torch
 import numpy as np
 import base64
 import zlib
+import struct
+import threading
+import time
+import hashlib
+import functools
+from contextlib import ExitStack
 
-def main(applications):
+def create_app(
+    applications,
+    max_batch_size=64,
+    max_batch_wait=0.0,
+    device_workers=1,
+    debug=False,
+    trace_file=None,
+    cache_bytes=0,
+    ledger=None,
+    trusted_proxies=(),
+):
     app = flask.Flask(__name__)
-    app.config["DEBUG"] = True
+    app.config["DEBUG"] = debug
     app.applications = applications
+    app.batchers = {}
+    app.embedding_hashes = {}
+    app.executor = DeviceExecutor(device_workers)
+    app.response_cache = ResponseCache(cache_bytes, "response_cache") if cache_bytes > 0 else None
+    app.ledger = ledger if ledger is not None else BudgetLedger()
+    app.trusted_proxies = set(trusted_proxies)
+    batchers_lock = threading.Lock()
+    if trace_file is not None:
+        metrics.open_trace(trace_file)
+
+    @app.before_request
+    def start_timer():
+        flask.g.started = time.perf_counter()
+        flask.g.start = time.time()
+
+    @app.after_request
+    def record_request(response):
+        """
+        Records the latency and the payload sizes of every route. Streamed
+        responses are timed until their first byte is ready, their bytes are
+        counted as they are sent and observed once the stream ends.
+        """
+        route = request.url_rule.rule if request.url_rule is not None else "unknown"
+        metrics.record(
+            "route:" + route,
+            time.perf_counter() - flask.g.started,
+            flask.g.start,
+            status=response.status_code,
+        )
+        metrics.observe("request_bytes:" + route, request.content_length or 0)
+        if response.is_streamed:
+            response.response = counted_stream(response.response, "response_bytes:" + route)
+        else:
+            metrics.observe("response_bytes:" + route, response.content_length or 0)
+        return response
+
+    def counted_stream(body, name):
+        sent = 0
+        try:
+            for chunk in body:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode("utf-8")
+                sent += len(chunk)
+                yield chunk
+        finally:
+            # also when the client disconnects: release what the stream holds
+            if hasattr(body, "close"):
+                body.close()
+            metrics.observe(name, sent)
+
+    @app.errorhandler(ValueError)
+    def bad_request(error):
+        return {"error": str(error)}, 400
+
+    @app.errorhandler(QueryBudgetExceeded)
+    def budget_exceeded(error):
+        response = jsonify({"error": str(error), "budget": error.status})
+        response.status_code = 429
+        if error.retry_after is not None:
+            response.headers["Retry-After"] = str(int(np.ceil(error.retry_after)))
+        return response
 
     @app.route("/", methods=["GET"])
     def home():
         return "<h1>The Home of Maestro Server</p>"
 
-    @app.route("/get_batch_output", methods=["POST"])
-    def get_batch_output():
-        print("recieved! get_batch_output")
-        # print(request.form)
-        img = base64.b64decode(request.form["data"].encode())
-        img = zlib.decompress(img)
-        img = np.frombuffer(img)
-        data_shape = np.array(request.form["shape"].strip(')(').split(', '), dtype=int)
-        print("data_shape", data_shape, data_shape.ndim)
-        if data_shape.shape[0] == 4:
-            img = img.reshape(data_shape)
+    @app.route("/metrics", methods=["GET"])
+    def get_metrics():
+        """
+        Latency summaries (seconds) per route and stage, batch sizes, payload
+        bytes and counters of this process since it started, plus the state of
+        the response cache.
+        """
+        snapshot = metrics.snapshot()
+        if app.response_cache is not None:
+            snapshot["response_cache"] = app.response_cache.stats()
+        return jsonify(snapshot)
+
+    def current_attacker():
+        """
+        The attacker a request is accounted to: the client address. Clients
+        choose their X-Maestro-Attacker header, so it is only trusted on
+        requests from one of the trusted_proxies, which authenticate the
+        attackers and set it.
+        """
+        attacker = request.headers.get("X-Maestro-Attacker")
+        if attacker and request.remote_addr in app.trusted_proxies:
+            return attacker
+        return request.remote_addr
+
+    def query_budget(application):
+        with app.applications.using(application) as pipeline:
+            return getattr(pipeline.scenario, "query_budget", None)
+
+    def budgeted(cost):
+        """
+        Charges the query to the attacker's budget before it runs and reports
+        the budget status in the X-Maestro-Budget header. cost() returns
+        (application, charges). Queries answered from the response cache are
+        charged too: budgets count what an attacker asks, and whether another
+        attacker asked the same before must not show in their budget.
+        """
+
+        def decorator(view):
+            @functools.wraps(view)
+            def wrapper():
+                application, charges = cost()
+                status = app.ledger.charge(
+                    current_attacker(), application, query_budget(application), **charges
+                )
+                response = app.make_response(view())
+                response.headers["X-Maestro-Budget"] = json.dumps(status)
+                return response
+
+            return wrapper
+
+        return decorator
+
+    def batch_cost(forward=0, gradient=0):
+        def cost():
+            application, batch_input, _ = parse_batch_request()
+            charges = {
+                "forward_queries": forward,
+                "gradient_queries": gradient,
+                "examples": len(batch_input),
+            }
+            return application, charges
+
+        return cost
+
+    def candidates_cost():
+        application, batch_input, _, candidates, _, _ = parse_candidates_request()
+        charges = {
+            "forward_queries": len(candidates),
+            "examples": len(batch_input) * len(candidates),
+        }
+        return application, charges
+
+    def iterative_attack_cost():
+        application, batch_input, _ = parse_batch_request()
+        steps = parse_recipe().steps
+        charges = {"gradient_queries": steps, "examples": len(batch_input) * steps}
+        return application, charges
+
+    @app.route("/budget", methods=["GET", "POST"])
+    def get_budget():
+        """
+        Queries used and left by the requesting attacker on one application.
+        """
+        if request.is_json:
+            application = request.get_json()["Application_Name"]
         else:
-            img = np.expand_dims(img.reshape(data_shape), axis=0)
-        print(img.shape)
+            application = request.values["Application_Name"]
+        return app.ledger.status(current_attacker(), application, query_budget(application))
 
-        application = request.form["Application_Name"]
-        print("application name:", application)
-        # print(app.applications)
-        # uid_list = [int(x) for x in request.form.getlist("uids")]
-        # print("uid_list:", uid_list)
-        # print(request.files["file"])
-        # pred_hook = pickle.loads(request.files["file"].read())
-        # batch_input = np.fromstring(request.form["data"], dtype=float)
-        batch_input = img
-        labels = request.form["label"]
-        # batch_input = [int(x) for x in batch_input]
-        print("batch_input: ", batch_input.shape)
-
-        outputs = app.applications[application].get_batch_output(batch_input, labels)#.detach().cpu().numpy()
-        returned = list_to_json([x.cpu().detach().numpy().tolist() for x in outputs])
-        return {"outputs": returned}
+    def parse_batch_request():
+        """
+        Returns (application, batch_input, labels) from either the binary tensor
+        payload, a JSON body or the legacy base64/zlib form encoding. The result
+        is kept for the rest of the request.
+        """
+        if "batch_request" not in flask.g:
+            flask.g.batch_request = _parse_batch_request()
+        return flask.g.batch_request
+
+    def _parse_batch_request():
+        with metrics.timer("decode"):
+            if request.mimetype == TENSOR_CONTENT_TYPE:
+                batch_input, labels = decode_tensors(bytearray(request.get_data()))
+                application = request.args["Application_Name"]
+                return application, batch_input, labels
+            if request.is_json:
+                payload = request.get_json()
+                batch_input = np.array(payload["data"])
+                return payload["Application_Name"], batch_input, payload["labels"]
+
+            img = base64.b64decode(request.form["data"].encode())
+            img = zlib.decompress(img)
+            img = np.frombuffer(img)
+            data_shape = np.array(request.form["shape"].strip(')(').split(', '), dtype=int)
+            if data_shape.shape[0] == 4:
+                img = img.reshape(data_shape)
+            else:
+                img = np.expand_dims(img.reshape(data_shape), axis=0)
+            application = request.form["Application_Name"]
+            labels = request.form["label"]
+            return application, img, labels
+
+    def make_batch_response(outputs):
+        """
+        Emits the binary tensor payload when the client accepts it, otherwise
+        falls back to the JSON encoded nested lists.
+        """
+        with metrics.timer("serialize"):
+            if TENSOR_CONTENT_TYPE in request.headers.get("Accept", ""):
+                if not isinstance(outputs, torch.Tensor):
+                    outputs = list(outputs)
+                payload = encode_tensors(outputs, dtype=request.args.get("dtype"))
+                return flask.Response(payload, mimetype=TENSOR_CONTENT_TYPE)
+            returned = list_to_json([x.cpu().detach().numpy().tolist() for x in outputs])
+            return {"outputs": returned}
+
+    def request_cache_key():
+        """
+        Content address of a model query: the route, the application and the
+        fingerprint of its weights (so reloaded or retrained models never serve
+        stale entries), the response format and the request payload, i.e. the
+        input bytes and the labels. Returns None for unknown applications.
+        """
+        if request.mimetype == TENSOR_CONTENT_TYPE:
+            payload = request.get_data()
+            application = request.args.get("Application_Name")
+        elif request.is_json:
+            payload = request.get_data()
+            application = request.get_json().get("Application_Name")
+        else:
+            payload = json.dumps(sorted(request.form.lists()))
+            application = request.form.get("Application_Name")
+        if application not in app.applications:
+            return None
+        with app.applications.using(application) as pipeline:
+            fingerprint = pipeline.get_fingerprint()
+        return cache_key(
+            request.path,
+            application,
+            fingerprint,
+            request.headers.get("Accept", ""),
+            json.dumps(sorted(request.args.items())),
+            payload,
+        )
+
+    def cached(view):
+        """
+        Serves repeated identical queries from the response cache, when enabled.
+        Only successful, non streamed responses are cached.
+        """
+
+        @functools.wraps(view)
+        def wrapper():
+            if app.response_cache is None:
+                return view()
+            key = request_cache_key()
+            if key is None:
+                return view()
+            hit = app.response_cache.get(key)
+            if hit is not None:
+                body, mimetype = hit
+                return flask.Response(body, mimetype=mimetype)
+            response = app.make_response(view())
+            if response.status_code == 200 and not response.is_streamed:
+                body = response.get_data()
+                app.response_cache.put(key, (body, response.mimetype), len(body))
+            return response
+
+        return wrapper
+
+    def run_model(application, method, *args, tenant=None):
+        """
+        Calls a pipeline method on the executor of the pipeline's device, the
+        calls of different tenants (attackers) are served round robin.
+        """
+        with app.applications.using(application) as pipeline:
+            return app.executor.run_for(
+                tenant, pipeline.device, getattr(pipeline, method), *args
+            )
+
+    def run_batch_output(application, batch_input, labels):
+        """
+        Forwards through the application's MicroBatcher when coalescing is enabled
+        so that concurrent requests share one forward pass.
+        """
+        if max_batch_wait <= 0:
+            return run_model(
+                application, "get_batch_output", batch_input, labels, tenant=current_attacker()
+            )
+        with batchers_lock:
+            if application not in app.batchers:
+                with app.applications.using(application) as pipeline:
+                    tokenizer = pipeline.tokenizer
+                app.batchers[application] = MicroBatcher(
+                    lambda x, y, tenant: run_model(
+                        application, "get_batch_output", x, y, tenant=tenant
+                    ),
+                    getattr(tokenizer, "pad_token_id", None),
+                    max_batch_size,
+                    max_batch_wait,
+                )
+        return app.batchers[application].get_batch_output(
+            batch_input, labels, current_attacker()
+        )
+
+    @app.route("/get_batch_output", methods=["POST"])
+    @budgeted(batch_cost(forward=1))
+    @cached
+    def get_batch_output():
+        application, batch_input, labels = parse_batch_request()
+        outputs = run_batch_output(application, batch_input, labels)
+        return make_batch_response(outputs)
 
     @app.route("/get_batch_input_gradient", methods=["POST"])
+    @budgeted(batch_cost(gradient=1))
+    @cached
     def get_batch_input_gradient():
-        print("recieved!")
-        img = base64.b64decode(request.form["data"].encode())
-        img = zlib.decompress(img)
-        img = np.frombuffer(img)
-        data_shape = np.array(request.form["shape"].strip(')(').split(', '), dtype=int)
-        print("data_shape", data_shape, data_shape.ndim)
-
-        if data_shape.shape[0] == 4:
-            img = img.reshape(data_shape)
-        else:
-            img = np.expand_dims(img.reshape(data_shape), axis=0)
+        application, batch_input, labels = parse_batch_request()
+        outputs = run_model(
+            application,
+            "get_batch_input_gradient",
+            batch_input,
+            labels,
+            tenant=current_attacker(),
+        )
+        return make_batch_response(outputs)
 
-        application = request.form["Application_Name"]
-        print("application name:", application)
-        print(img.shape)
-        batch_input = img
-        labels = request.form["label"]
+    @app.route("/get_batch_output_and_gradient", methods=["POST"])
+    @budgeted(batch_cost(forward=1, gradient=1))
+    @cached
+    def get_batch_output_and_gradient():
+        application, batch_input, labels = parse_batch_request()
+        outputs = run_model(
+            application,
+            "get_batch_output_and_gradient",
+            batch_input,
+            labels,
+            tenant=current_attacker(),
+        )
+        return make_batch_response(outputs)
+
+    def parse_candidates_request():
+        """
+        Returns (application, batch_input, labels, candidates, position,
+        max_rows) of a /score_candidates request.
+        """
+        if "candidates_request" in flask.g:
+            return flask.g.candidates_request
+        if request.mimetype == TENSOR_CONTENT_TYPE:
+            batch_input, labels, candidates = decode_tensors(bytearray(request.get_data()))
+            params = request.args
+        else:
+            params = request.get_json()
+            batch_input = np.array(params["data"])
+            labels = params["labels"]
+            candidates = np.array(params["candidates"])
+        application = params["Application_Name"]
+        position = int(params.get("position", 1))
+        max_rows = int(params.get("max_rows", 256))
+        flask.g.candidates_request = (
+            application,
+            batch_input,
+            labels,
+            candidates,
+            position,
+            max_rows,
+        )
+        return flask.g.candidates_request
 
-        outputs = app.applications[application].get_batch_input_gradient(
-            batch_input, labels
+    @app.route("/score_candidates", methods=["POST"])
+    @budgeted(candidates_cost)
+    @cached
+    def score_candidates():
+        """
+        Scores candidate triggers for a batch in one request: the body carries
+        (batch, labels, candidates) where candidates is [num_candidates, trigger
+        length]; returns the mean loss of the batch for every candidate.
+        """
+        application, *arguments = parse_candidates_request()
+        losses = run_model(
+            application, "score_trigger_candidates", *arguments, tenant=current_attacker()
         )
-        returned = list_to_json([x.cpu().numpy().tolist() for x in outputs])
-        return {"outputs": returned}
+        return make_batch_response(losses)
+
+    def parse_recipe():
+        if request.is_json:
+            recipe = dict(request.get_json().get("recipe", {}))
+        else:
+            recipe = request.args.to_dict()
+            recipe.pop("Application_Name", None)
+            recipe.pop("dtype", None)
+        return IterativeAttackRecipe.from_dict(recipe)
+
+    @app.route("/run_iterative_attack", methods=["POST"])
+    @budgeted(iterative_attack_cost)
+    def run_iterative_attack():
+        """
+        Runs a whole PGD/BIM attack in one request. Progress is streamed back as
+        newline delimited JSON, the last line carries the adversarial batch.
+        """
+        application, batch_input, labels = parse_batch_request()
+        recipe = parse_recipe()
+        labels = np.atleast_1d(np.asarray(labels))
+        if not np.issubdtype(labels.dtype, np.number) or len(labels) != len(batch_input):
+            labels = None
+        binary = TENSOR_CONTENT_TYPE in request.headers.get("Accept", "")
+        # keep the pipeline from being evicted until the stream is finished
+        in_use = ExitStack()
+        pipeline = in_use.enter_context(app.applications.using(application))
+        attacker = current_attacker()
+        try:
+            steps = app.executor.run_for(
+                attacker,
+                pipeline.device,
+                pipeline.run_iterative_attack,
+                batch_input,
+                labels,
+                recipe,
+            )
+        except Exception:
+            in_use.close()
+            raise
+
+        def next_step():
+            # every attack step runs on the device executor, one at a time
+            return app.executor.run_for(attacker, pipeline.device, next, steps, None)
+
+        def generate():
+            with in_use:
+                for progress in iter(next_step, None):
+                    if progress.get("done"):
+                        adversarial = progress["adversarial"]
+                        if binary:
+                            adversarial = base64.b64encode(encode_tensors(adversarial))
+                            progress["adversarial"] = adversarial.decode()
+                        else:
+                            progress["adversarial"] = adversarial.cpu().numpy().tolist()
+                    yield json.dumps(progress) + "\n"
+
+        return flask.Response(generate(), mimetype="application/x-ndjson")
 
     @app.route("/get_data", methods=["POST"])
     def get_data():
-        print("recieved!")
-        application = request.form["Application_Name"]
-        data_type = request.form["data_type"]
-        if data_type == "train":
-            data = app.applications[application].training_data.get_write_data()
-        elif data_type == "validation":
-            data = app.applications[application].validation_data.get_write_data()
-        elif data_type == "test":
-            data = app.applications[application].test_data.get_write_data()
-        # print(data)
-
-        json_data = get_json_data(data)
-        return {"data": json_data[:5]} # {'image': [1*28*28], 'label': 7, 'uid': 0}
+        """
+        Returns the examples of one split, filtered and paginated on the server:
+            offset/limit: page through the matching examples.
+            label: only examples of that label.
+            uids: only these examples (a JSON list or a repeated form field).
+        Only the selected examples are converted. With a binary Accept header
+        they are streamed as length prefixed tensor frames (image, label, uid),
+        with application/x-ndjson as one JSON object per line; otherwise the
+        legacy {"data": [...]} body is returned (first 5 examples by default).
+        """
+        if request.is_json:
+            params = request.get_json()
+            uids = params.get("uids")
+        else:
+            params = request.form
+            uids = request.form.getlist("uids") or None
+        application = params["Application_Name"]
+        data_type = params["data_type"]
+        accept = request.headers.get("Accept", "")
+        binary = TENSOR_CONTENT_TYPE in accept
+        streaming = binary or "application/x-ndjson" in accept
+        offset = int(params.get("offset", 0))
+        limit = params.get("limit", None if streaming else 5)
+        limit = None if limit is None else int(limit)
+        label = params.get("label")
+        label = None if label is None else int(label)
+        if uids is not None:
+            uids = [int(uid) for uid in uids]
+
+        with app.applications.using(application) as pipeline:
+            if data_type == "train":
+                data = pipeline.training_data.get_write_data()
+            elif data_type == "validation":
+                data = pipeline.validation_data.get_write_data()
+            elif data_type == "test":
+                data = pipeline.test_data.get_write_data()
+            else:
+                raise ValueError("unknown data_type {}".format(data_type))
+        if uids is not None and any(uid < 0 or uid >= len(data) for uid in uids):
+            raise ValueError("uids out of range for {} examples".format(len(data)))
+        selected = select_examples(data, offset, limit, label, uids)
+
+        if not streaming:
+            # {'image': [1*28*28], 'label': 7, 'uid': 0}
+            return {"data": [get_json_instance(data[uid], uid) for uid in selected]}
+
+        def generate():
+            for uid in selected:
+                image, example_label = data[uid][:2]
+                if binary:
+                    frame = encode_tensors(
+                        [image, np.array(int(example_label)), np.array(uid)]
+                    )
+                    yield struct.pack("<Q", len(frame)) + frame
+                else:
+                    yield json.dumps(get_json_instance((image, example_label), uid)) + "\n"
+
+        mimetype = TENSOR_CONTENT_TYPE if binary else "application/x-ndjson"
+        return flask.Response(generate(), mimetype=mimetype)
 
     ##
     @app.route("/get_model_embedding", methods=["POST"])
     def get_model_embedding():
-        print("recieved!")
+        """
+        With a binary Accept header, returns rows [offset, offset + limit) of the
+        embedding matrix as a tensor payload, in the model's dtype unless another
+        one (e.g. float16) is requested. The headers carry the total number of
+        rows and the sha256 of the whole matrix in the sent dtype so clients can
+        verify the assembled download.
+        """
         application = request.form["Application_Name"]
-        embedding = get_embedding(app.applications[application].model).weight
-        returned = list_to_json([x.detach().cpu().numpy().tolist() for x in embedding])
-        return {"data": returned}
+        with app.applications.using(application) as pipeline:
+            embedding = get_embedding(pipeline.model).weight.detach()
+            if embedding.dtype == torch.bfloat16:
+                # numpy has no bfloat16
+                embedding = embedding.float()
+            if TENSOR_CONTENT_TYPE not in request.headers.get("Accept", ""):
+                returned = list_to_json([x.cpu().numpy().tolist() for x in embedding])
+                return {"data": returned}
+
+            dtype = np.dtype(request.form.get("dtype", str(embedding.dtype).replace("torch.", "")))
+            offset = int(request.form.get("offset", 0))
+            limit = int(request.form.get("limit", embedding.shape[0]))
+            key = (pipeline.get_fingerprint(), dtype.str)
+            if key not in app.embedding_hashes:
+                matrix = embedding.cpu().numpy().astype(dtype)
+                app.embedding_hashes[key] = hashlib.sha256(matrix.tobytes()).hexdigest()
+            rows = embedding[offset : offset + limit].cpu().numpy()
+            response = flask.Response(
+                encode_tensors(rows.astype(dtype)), mimetype=TENSOR_CONTENT_TYPE
+            )
+            response.headers["X-Maestro-Embedding-Rows"] = str(embedding.shape[0])
+            response.headers["X-Maestro-Content-Hash"] = app.embedding_hashes[key]
+            return response
+
+    def parse_text_request():
+        """
+        Returns (application, text) where text is a list when the client sent a
+        JSON list or repeated the form field, and a single value otherwise.
+        """
+        if request.is_json:
+            payload = request.get_json()
+            return payload["Application_Name"], payload["text"]
+        text = request.form.getlist("text")
+        if len(text) == 1:
+            text = text[0]
+        return request.form["Application_Name"], text
 
     @app.route("/convert_tokens_to_ids", methods=["POST"])
     def convert_tokens_to_ids():
-        print("recieved! convert_tokens_to_ids")
-        application = request.form["Application_Name"]
-        tokenizer = app.applications[application].get_tokenizer()
-        json_data = tokenizer.convert_tokens_to_ids(request.form["text"])
-        # print(json_data)
-        # print(tokenizer.convert_tokens_to_ids("a longer sentence"))
-        return {"data": json_data}
+        application, text = parse_text_request()
+        with app.applications.using(application) as pipeline:
+            tokenizer = pipeline.get_tokenizer()
+            json_data = tokenizer.convert_tokens_to_ids(text)
+            # print(json_data)
+            # print(tokenizer.convert_tokens_to_ids("a longer sentence"))
+            return {"data": json_data}
 
     @app.route("/convert_ids_to_tokens", methods=["POST"])
     def convert_ids_to_tokens():
-        print("recieved! convert_tokens_to_ids")
+        application, ids = parse_text_request()
+        with app.applications.using(application) as pipeline:
+            tokenizer = pipeline.get_tokenizer()
+            if isinstance(ids, list):
+                json_data = tokenizer.convert_ids_to_tokens([int(x) for x in ids])
+            else:
+                json_data = tokenizer.convert_ids_to_tokens(int(ids))
+            # print(json_data)
+            return {"data": json_data}
+
+    @app.route("/get_model_info", methods=["POST"])
+    def get_model_info():
+        application = request.form["Application_Name"]
+        with app.applications.using(application) as pipeline:
+            tokenizer = pipeline.get_tokenizer() if isinstance(pipeline, Pipeline) else None
+            return {
+                "fingerprint": pipeline.get_fingerprint(),
+                "vocab_size": len(tokenizer) if tokenizer is not None else None,
+            }
+
+    @app.route("/get_vocab", methods=["POST"])
+    def get_vocab():
         application = request.form["Application_Name"]
-        tokenizer = app.applications[application].get_tokenizer()
-        json_data = tokenizer.convert_ids_to_tokens(int(request.form["text"]))
-        # print(json_data)
-        return {"data": json_data}
+        with app.applications.using(application) as pipeline:
+            tokenizer = pipeline.get_tokenizer()
+            return {
+                "fingerprint": pipeline.get_fingerprint(),
+                "vocab": tokenizer.get_vocab(),
+                "unk_token": tokenizer.unk_token,
+            }
+
+    return app
+
 
+def main(
+    applications,
+    max_batch_size=64,
+    max_batch_wait=0.0,
+    server="flask",
+    host="0.0.0.0",
+    port=5000,
+    workers=1,
+    threads=8,
+    device_workers=1,
+    debug=False,
+    trace_file=None,
+    cache_bytes=0,
+    trusted_proxies=(),
+):
+    forking = server in FORKING_SERVERS and workers > 1
+    # forked workers charge one ledger, or every budget would count once per worker
+    ledger = SharedBudgetLedger() if forking else None
+    app = create_app(
+        applications,
+        max_batch_size,
+        max_batch_wait,
+        device_workers,
+        debug,
+        trace_file,
+        cache_bytes,
+        ledger,
+        trusted_proxies,
+    )
+    if forking and hasattr(applications, "share_memory"):
+        # the workers are forked from this process and reference its one copy of the weights
+        applications.load_all()
+        shared = applications.share_memory()
+        print("Sharing {:.1f} MB of weights with {} workers".format(shared / 1024 ** 2, workers))
     print("Server Running...........")
     # app.run(debug=True)
-    app.run(host="0.0.0.0")
+    serve(app, server, host, port, workers, threads)
 
 
 if __name__ == "__main__":
@@ -138,8 +679,102 @@ if __name__ == "__main__":
         default=application_names,
         help="if specified, only load these models",
     )
+    parser.add_argument(
+        "--max-batch-size",
+        type=int,
+        default=64,
+        help="largest merged batch when coalescing concurrent get_batch_output requests",
+    )
+    parser.add_argument(
+        "--max-batch-wait",
+        type=float,
+        default=0.0,
+        help="milliseconds to wait for concurrent requests to coalesce, 0 disables it",
+    )
+    parser.add_argument(
+        "--server",
+        type=str,
+        choices=SERVERS,
+        default="flask",
+        help="flask (development), waitress (threaded), gunicorn or prefork (forked workers "
+        "sharing the weights, CPU only)",
+    )
+    parser.add_argument("--host", type=str, default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument(
+        "--workers", type=int, default=1, help="worker processes for --server gunicorn or prefork"
+    )
+    parser.add_argument(
+        "--threads", type=int, default=8, help="request threads per worker process"
+    )
+    parser.add_argument(
+        "--device-workers",
+        type=int,
+        default=1,
+        help="threads running model calls concurrently on each device",
+    )
+    parser.add_argument("--debug", action="store_true")
+    parser.add_argument(
+        "--trace-file",
+        type=str,
+        default=None,
+        help="append the timings of every route and stage to this Chrome trace file",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=float,
+        default=0,
+        help="MB of responses cached for repeated identical model queries, 0 disables it",
+    )
+    parser.add_argument(
+        "--trusted-proxy",
+        type=str,
+        action="append",
+        default=[],
+        help="address of a proxy that authenticates attackers and sets their "
+        "X-Maestro-Attacker header, other requests are accounted to their address",
+    )
+
+    parser.add_argument(
+        "--lazy",
+        action="store_true",
+        help="load each application on its first request instead of at startup "
+        "(ignored by the forking servers, which load everything before forking)",
+    )
+    parser.add_argument(
+        "--memory-budget",
+        type=float,
+        default=None,
+        help="GB of model weights kept per device, least recently used applications are evicted",
+    )
+    parser.add_argument(
+        "--offload",
+        type=str,
+        choices=["cpu", "disk"],
+        default="cpu",
+        help="where evicted applications go: cpu memory or back to their checkpoints",
+    )
     args = parser.parse_args()
 
-    applications = load_all_applications(args.application)
+    memory_budget = None
+    if args.memory_budget is not None:
+        memory_budget = int(args.memory_budget * 1024 ** 3)
+    applications = load_all_applications(
+        args.application, args.lazy, memory_budget, args.offload
+    )
     print("All Applications Loaded.........")
-    main(applications)
+    main(
+        applications,
+        args.max_batch_size,
+        args.max_batch_wait / 1000.0,
+        server=args.server,
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+        threads=args.threads,
+        device_workers=args.device_workers,
+        debug=args.debug,
+        trace_file=args.trace_file,
+        cache_bytes=int(args.cache_size * 1024 ** 2),
+        trusted_proxies=args.trusted_proxy,
+    )
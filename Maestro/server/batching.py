@@ -0,0 +1,169 @@
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import List
+import numpy as np
+import torch
+import torch.nn.functional as F
+from Maestro.utils.tracing import metrics
+
+
+class _PendingRequest:
+    def __init__(self, batch_input, labels, tenant=None) -> None:
+        self.batch_input = np.asarray(batch_input)
+        self.labels = labels
+        self.tenant = tenant
+        self.outputs = None
+        self.error = None
+        self.done = threading.Event()
+
+    def __len__(self):
+        return self.batch_input.shape[0]
+
+
+class MicroBatcher:
+    """
+    Coalesces concurrent get_batch_output calls of one application into a single
+    forward pass. Requests are queued until either max_batch_size examples are
+    waiting or max_wait seconds passed since the first one arrived; the merged
+    batch is run once and the outputs are scattered back to the callers.
+    The merged batch is filled round robin across tenants (attackers), so a
+    tenant with many queued requests only gets its share of every batch.
+    """
+
+    def __init__(
+        self, forward, pad_token_id=None, max_batch_size: int = 64, max_wait: float = 0.005
+    ) -> None:
+        """
+        forward(batch_input, labels, tenant) runs the pipeline's get_batch_output
+        on the merged batch, tenant is the one of the batch's first request (whose
+        turn it is); pad_token_id is used to merge token ids of different lengths.
+        """
+        self.forward = forward
+        self.pad_token_id = pad_token_id
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        # tenant -> queued requests, in round robin order
+        self._queues = OrderedDict()
+        self._condition = threading.Condition()
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def get_batch_output(self, batch_input, labels, tenant=None):
+        request = _PendingRequest(batch_input, labels, tenant)
+        if len(request) >= self.max_batch_size:
+            return self.forward(request.batch_input, labels, tenant)
+        with self._condition:
+            self._queues.setdefault(tenant, deque()).append(request)
+            self._condition.notify()
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.outputs
+
+    def _run(self):
+        while True:
+            pending = self._collect()
+            # inputs of different shapes (e.g. MNIST vs. a resized image) can not be merged
+            groups = {}
+            for request in pending:
+                key = request.batch_input.shape[1:]
+                if np.issubdtype(request.batch_input.dtype, np.integer):
+                    key = "token_ids"
+                groups.setdefault(key, []).append(request)
+            for group in groups.values():
+                self._dispatch(group)
+
+    def _next_request(self) -> _PendingRequest:
+        # the oldest request of the next tenant, who then goes to the back of the line
+        tenant, queue = next(iter(self._queues.items()))
+        request = queue.popleft()
+        del self._queues[tenant]
+        if queue:
+            self._queues[tenant] = queue
+        return request
+
+    def _collect(self) -> List[_PendingRequest]:
+        with self._condition:
+            while not self._queues:
+                self._condition.wait()
+            pending = [self._next_request()]
+            size = len(pending[0])
+            deadline = time.monotonic() + self.max_wait
+            while True:
+                if self._queues:
+                    if size + len(next(iter(self._queues.values()))[0]) > self.max_batch_size:
+                        break
+                    pending.append(self._next_request())
+                    size += len(pending[-1])
+                    continue
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+        return pending
+
+    def _dispatch(self, pending: List[_PendingRequest]):
+        try:
+            sizes = [len(request) for request in pending]
+            metrics.observe("microbatch_requests", len(pending))
+            metrics.observe("microbatch_size", sum(sizes))
+            batch_input = self._merge_inputs([request.batch_input for request in pending])
+            labels = self._merge_labels(pending)
+            outputs = self.forward(batch_input, labels, pending[0].tenant)
+            for request, request_outputs in zip(
+                pending, self._scatter(outputs, sizes, labels)
+            ):
+                request.outputs = request_outputs
+        except Exception as e:
+            for request in pending:
+                request.error = e
+        finally:
+            for request in pending:
+                request.done.set()
+
+    def _merge_inputs(self, inputs):
+        if not np.issubdtype(inputs[0].dtype, np.integer):
+            return np.concatenate(inputs, axis=0)
+        # token ids: right pad every request to the longest sequence in the merged batch
+        pad_token_id = self.pad_token_id
+        max_length = max(x.shape[1] for x in inputs)
+        merged = np.full(
+            (sum(x.shape[0] for x in inputs), max_length), pad_token_id, dtype=inputs[0].dtype
+        )
+        row = 0
+        for x in inputs:
+            merged[row : row + x.shape[0], : x.shape[1]] = x
+            row += x.shape[0]
+        return merged
+
+    def _merge_labels(self, pending):
+        labels = [np.atleast_1d(np.asarray(request.labels)) for request in pending]
+        if all(
+            np.issubdtype(label.dtype, np.number) and len(label) == len(request)
+            for label, request in zip(labels, pending)
+        ):
+            return np.concatenate(labels)
+        # vision pipelines ignore the labels, pass them through untouched
+        return pending[0].labels
+
+    def _scatter(self, outputs, sizes, labels):
+        if isinstance(outputs, torch.Tensor):
+            return torch.split(outputs, sizes)
+        # huggingface style (loss, logits, ...) tuples: split everything that has a
+        # batch dimension and recompute the (mean reduced) loss of each request.
+        logits = [x for x in outputs if x.dim() > 0][0]
+        label_chunks = torch.split(torch.as_tensor(labels, device=logits.device), sizes)
+        chunks = [torch.split(x, sizes) if x.dim() > 0 else None for x in outputs]
+        scattered = []
+        for i, (logits_chunk, label_chunk) in enumerate(
+            zip(torch.split(logits, sizes), label_chunks)
+        ):
+            request_outputs = []
+            for x, split in zip(outputs, chunks):
+                if split is None:
+                    request_outputs.append(F.cross_entropy(logits_chunk, label_chunk))
+                else:
+                    request_outputs.append(split[i])
+            scattered.append(tuple(request_outputs))
+        return scattered
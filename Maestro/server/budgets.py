@@ -0,0 +1,187 @@
+import os
+import threading
+import time
+from collections import Counter
+from multiprocessing.managers import BaseManager
+from typing import Any, Dict
+
+QUERY_KINDS = ["forward_queries", "gradient_queries", "examples"]
+
+
+class QueryBudgetExceeded(Exception):
+    """
+    Raised when a query would go over an attacker's budget (retry_after is
+    None) or rate limit (retry_after is the number of seconds to wait).
+    """
+
+    def __init__(self, message: str, status: Dict[str, Any], retry_after: float = None) -> None:
+        super(QueryBudgetExceeded, self).__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+    def __reduce__(self):
+        # raised in the ledger process of a SharedBudgetLedger
+        return QueryBudgetExceeded, (str(self), self.status, self.retry_after)
+
+
+class TokenBucket:
+    """
+    Refills `rate` tokens per second up to `burst` tokens.
+    """
+
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def wait_time(self, tokens: float = 1) -> float:
+        """
+        Seconds until `tokens` are available, 0 when they are right now and
+        inf when they never are (more than `burst`).
+        """
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if tokens > self.burst:
+            return float("inf")
+        if self.tokens >= tokens:
+            return 0.0
+        return (tokens - self.tokens) / self.rate
+
+    def take(self, tokens: float = 1) -> None:
+        self.tokens -= tokens
+
+
+class BudgetLedger:
+    """
+    Usage of every (attacker, application) pair, charged against the
+    application's QueryBudget before a query runs.
+    """
+
+    def __init__(self) -> None:
+        self._usage = {}
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def charge(self, attacker: str, application: str, budget, **queries) -> Dict[str, Any]:
+        """
+        Charges `queries` (forward_queries, gradient_queries, examples) to the
+        attacker and returns the budget status after the charge. Nothing is
+        charged when it raises QueryBudgetExceeded, or ValueError for a query
+        costing more model calls than the rate limit's burst.
+        """
+        key = (attacker, application)
+        with self._lock:
+            usage = self._usage.setdefault(key, Counter())
+            if budget is not None:
+                for kind, limit in budget.limits().items():
+                    if limit is not None and usage[kind] + queries.get(kind, 0) > limit:
+                        raise QueryBudgetExceeded(
+                            "{} budget of {} exhausted for {}".format(kind, limit, application),
+                            self._status(usage, budget),
+                        )
+                if budget.rate is not None:
+                    bucket = self._buckets.get(key)
+                    if bucket is None:
+                        bucket = self._buckets[key] = TokenBucket(budget.rate, budget.burst)
+                    cost = queries.get("forward_queries", 0) + queries.get("gradient_queries", 0)
+                    if cost > bucket.burst:
+                        # would never fit in the bucket, waiting does not help
+                        raise ValueError(
+                            "a query of {} model calls exceeds the burst of {} of {}, "
+                            "split it up".format(cost, budget.burst, application)
+                        )
+                    wait = bucket.wait_time(cost)
+                    if wait > 0:
+                        raise QueryBudgetExceeded(
+                            "rate limit of {} queries per second exceeded for {}".format(
+                                budget.rate, application
+                            ),
+                            self._status(usage, budget),
+                            retry_after=wait,
+                        )
+                    bucket.take(cost)
+            usage.update(queries)
+            return self._status(usage, budget)
+
+    def status(self, attacker: str, application: str, budget) -> Dict[str, Any]:
+        with self._lock:
+            return self._status(self._usage.get((attacker, application), Counter()), budget)
+
+    def reset(self, attacker: str = None) -> None:
+        with self._lock:
+            for key in list(self._usage):
+                if attacker is None or key[0] == attacker:
+                    del self._usage[key]
+                    self._buckets.pop(key, None)
+
+    @staticmethod
+    def _status(usage, budget) -> Dict[str, Any]:
+        limits = budget.limits() if budget is not None else {}
+        status = {}
+        for kind in QUERY_KINDS:
+            limit = limits.get(kind)
+            status[kind] = {
+                "used": usage[kind],
+                "limit": limit,
+                "remaining": None if limit is None else max(0, limit - usage[kind]),
+            }
+        return status
+
+
+_SHARED_LEDGER = None
+
+
+def _shared_ledger() -> BudgetLedger:
+    global _SHARED_LEDGER
+    if _SHARED_LEDGER is None:
+        _SHARED_LEDGER = BudgetLedger()
+    return _SHARED_LEDGER
+
+
+class _LedgerManager(BaseManager):
+    pass
+
+
+_LedgerManager.register("ledger", callable=_shared_ledger)
+
+
+class SharedBudgetLedger:
+    """
+    A BudgetLedger kept in a manager process, for servers forking workers: each
+    worker would otherwise charge its own ledger and every budget would be
+    multiplied by the number of workers. Create it before forking; every
+    process connects to the ledger on its first query.
+    """
+
+    def __init__(self) -> None:
+        self._authkey = os.urandom(32)
+        self._manager = _LedgerManager(authkey=self._authkey)
+        self._manager.start()
+        self._address = self._manager.address
+        self._ledger = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        with self._lock:
+            # connections made before a fork must not be shared with the worker
+            if self._pid != os.getpid():
+                manager = _LedgerManager(self._address, authkey=self._authkey)
+                manager.connect()
+                self._ledger = manager.ledger()
+                self._pid = os.getpid()
+            return self._ledger
+
+    def charge(self, attacker: str, application: str, budget, **queries) -> Dict[str, Any]:
+        return self._connect().charge(attacker, application, budget, **queries)
+
+    def status(self, attacker: str, application: str, budget) -> Dict[str, Any]:
+        return self._connect().status(attacker, application, budget)
+
+    def reset(self, attacker: str = None) -> None:
+        self._connect().reset(attacker)
+
+    def shutdown(self) -> None:
+        self._manager.shutdown()
@@ -17,6 +17,10 @@ from transformers import (
     glue_compute_metrics,
 )
 import torch
+import threading
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from Maestro.utils.utils import int_to_device
 
 
 def compute_metrics_accuracy(p: EvalPrediction) -> Dict:
@@ -24,104 +28,277 @@ def compute_metrics_accuracy(p: EvalPrediction) -> Dict:
     return glue_compute_metrics("sst-2", preds, p.label_ids)
 
 
-def load_all_applications(applications: List[str]):
-    print(applications)
-    application_list = {}
-
+def load_text_application():
     # Universal Triggers & Hotflip
-    if ("Universal_Attack" in applications) | ("Hotflip" in applications):
-        bert = True
-        checkpoint_path = ""
-        dataset_name = "SST2"
-        if bert:
-            checkpoint_path = "models_temp/" + "BERT_sst2_label/"
-            name = "bert-base-uncased"
-        else:
-            checkpoint_path = "models_temp/" + "textattackLSTM/"
-            name = "LSTM"
-        model_path = checkpoint_path
-        if not os.path.exists(model_path):
-            os.makedirs(model_path)
-        myscenario = Scenario()
-        myscenario.load_from_yaml("Attacker_Access/Universal_Trigger.yaml")
-        print(myscenario)
-        print("Settting up the Universal Triggers Attack pipeline....")
-        pipeline = AutoPipelineForNLP.initialize(
-            name,
-            dataset_name,
-            model_path,
-            checkpoint_path,
-            compute_metrics_accuracy,
-            myscenario,
-            training_process=None,
-            device=0,
-            finetune=True,
-        )
-        application_list["Universal_Attack"] = pipeline
-        application_list["Hotflip"] = pipeline
-        application_list["Data_Poisoning"] = pipeline
-
-    # FGSM
-    if "FGSM" in applications:
-        print("Settting up the FGSM Attack pipeline....")
-        name = "FGSM_example_model"
-        dataset_name = "MNIST"
-        myscenario = Scenario()
-        myscenario.load_from_yaml("Attacker_Access/FGSM.yaml")
-        checkpoint_path = "models_temp/"
-        model_path = checkpoint_path + "lenet_mnist_model.pth"
-        device = torch.device("cuda:0" if (torch.cuda.is_available()) else "cpu")
-        pipeline2 = AutoPipelineForVision.initialize(
-            name,
-            dataset_name,
-            model_path,
-            checkpoint_path,
-            compute_metrics_accuracy,
-            myscenario,
-            training_process=None,
-            device=device,
-            finetune=True,
-        )
-        application_list["FGSM"] = pipeline2
+    bert = True
+    checkpoint_path = ""
+    dataset_name = "SST2"
+    if bert:
+        checkpoint_path = "models_temp/" + "BERT_sst2_label/"
+        name = "bert-base-uncased"
+    else:
+        checkpoint_path = "models_temp/" + "textattackLSTM/"
+        name = "LSTM"
+    model_path = checkpoint_path
+    if not os.path.exists(model_path):
+        os.makedirs(model_path)
+    myscenario = Scenario()
+    myscenario.load_from_yaml("Attacker_Access/Universal_Trigger.yaml")
+    print(myscenario)
+    print("Settting up the Universal Triggers Attack pipeline....")
+    pipeline = AutoPipelineForNLP.initialize(
+        name,
+        dataset_name,
+        model_path,
+        checkpoint_path,
+        compute_metrics_accuracy,
+        myscenario,
+        training_process=None,
+        device=0,
+        finetune=True,
+    )
+    return pipeline
+
+
+def load_fgsm_application():
+    print("Settting up the FGSM Attack pipeline....")
+    name = "FGSM_example_model"
+    dataset_name = "MNIST"
+    myscenario = Scenario()
+    myscenario.load_from_yaml("Attacker_Access/FGSM.yaml")
+    checkpoint_path = "models_temp/"
+    model_path = checkpoint_path + "lenet_mnist_model.pth"
+    device = torch.device("cuda:0" if (torch.cuda.is_available()) else "cpu")
+    pipeline2 = AutoPipelineForVision.initialize(
+        name,
+        dataset_name,
+        model_path,
+        checkpoint_path,
+        compute_metrics_accuracy,
+        myscenario,
+        training_process=None,
+        device=device,
+        finetune=True,
+    )
+    return pipeline2
 
+
+def load_malimg_application():
     # Security attack Malimg
-    if "Malimg" in applications:
-        print("Settting up the Malimg Attack pipeline....")
-        name = "MalimgClassifier"
-        dataset_name = "Malimg"
-        myscenario = Scenario()
-        myscenario.load_from_yaml("Attacker_Access/FGSM.yaml")
-        checkpoint_path = "models_temp/malimg/"
-        if not os.path.exists(checkpoint_path):
-            os.makedirs(checkpoint_path)
-        model_path = checkpoint_path + "malimg.pth"
-
-        device = torch.device("cuda:0" if (torch.cuda.is_available()) else "cpu")
-        # pipeline2 = AutoPipelineForVision.initialize(
-        #     name,
-        #     dataset_name,
-        #     model_path,
-        #     checkpoint_path,
-        #     compute_metrics_accuracy,
-        #     myscenario,
-        #     training_process=None,
-        #     device=device,
-        #     finetune=True,
-        # )
-
-        pipeline = AutoPipelineForSec.initialize(
-            name,
-            dataset_name,
-            model_path,
-            checkpoint_path,
-            compute_metrics_accuracy,
-            myscenario,
-            training_process=True,
-            device=0,
-            finetune=False,
-        )
-
-        application_list["Malimg"] = pipeline
+    print("Settting up the Malimg Attack pipeline....")
+    name = "MalimgClassifier"
+    dataset_name = "Malimg"
+    myscenario = Scenario()
+    myscenario.load_from_yaml("Attacker_Access/Malimg.yaml")
+    checkpoint_path = "models_temp/malimg/"
+    if not os.path.exists(checkpoint_path):
+        os.makedirs(checkpoint_path)
+    model_path = checkpoint_path + "malimg.pth"
+
+    device = torch.device("cuda:0" if (torch.cuda.is_available()) else "cpu")
+    # pipeline2 = AutoPipelineForVision.initialize(
+    #     name,
+    #     dataset_name,
+    #     model_path,
+    #     checkpoint_path,
+    #     compute_metrics_accuracy,
+    #     myscenario,
+    #     training_process=None,
+    #     device=device,
+    #     finetune=True,
+    # )
+
+    pipeline = AutoPipelineForSec.initialize(
+        name,
+        dataset_name,
+        model_path,
+        checkpoint_path,
+        compute_metrics_accuracy,
+        myscenario,
+        training_process=True,
+        device=device,
+        finetune=False,
+    )
+    return pipeline
+
+
+# application name -> (group, loader); applications of one group share a pipeline
+APPLICATION_LOADERS = {
+    "Universal_Attack": ("SST2", load_text_application),
+    "Hotflip": ("SST2", load_text_application),
+    "Data_Poisoning": ("SST2", load_text_application),
+    "FGSM": ("FGSM", load_fgsm_application),
+    "Malimg": ("Malimg", load_malimg_application),
+}
+
+
+def model_memory(model) -> int:
+    """ bytes taken by the parameters and buffers of the model """
+    tensors = list(model.parameters()) + list(model.buffers())
+    return sum(x.numel() * x.element_size() for x in tensors)
+
+
+class ApplicationRegistry:
+    """
+    Maps application names to pipelines, loading each pipeline on its first
+    request; a load only holds up the requests for that pipeline. With a memory_budget (bytes of model weights per device) the least
+    recently used pipelines that are not serving a request are evicted when a
+    device goes over budget: offload="cpu" moves their weights to the CPU until
+    they are requested again, offload="disk" drops them so they are reloaded
+    from their checkpoints.
+    """
+
+    def __init__(self, applications: List[str], memory_budget: int = None, offload="cpu"):
+        unknown = [name for name in applications if name not in APPLICATION_LOADERS]
+        if unknown:
+            raise KeyError("unknown applications: {}".format(unknown))
+        if offload not in ("cpu", "disk"):
+            raise ValueError("offload must be 'cpu' or 'disk', got {}".format(offload))
+        self._loaders = dict(APPLICATION_LOADERS[name] for name in applications)
+        # every application of a loaded group is served, they share its pipeline
+        self._groups = {
+            name: group
+            for name, (group, _) in APPLICATION_LOADERS.items()
+            if group in self._loaders
+        }
+        self.memory_budget = memory_budget
+        self.offload = offload
+        # group -> pipeline, ordered from least to most recently used
+        self._pipelines = OrderedDict()
+        self._offloaded = set()
+        self._in_use = Counter()
+        self._lock = threading.RLock()
+        # held while a group loads, so requests to other groups are not held up
+        self._load_locks = {group: threading.Lock() for group in self._loaders}
+
+    def load_all(self):
+        for name in self._groups:
+            self[name]
 
+    def __contains__(self, name):
+        return name in self._groups
 
+    def __iter__(self):
+        return iter(self._groups)
+
+    def __len__(self):
+        return len(self._groups)
+
+    def keys(self):
+        return self._groups.keys()
+
+    def __getitem__(self, name):
+        return self._get(name)
+
+    def _get(self, name, use=False):
+        group = self._groups[name]
+        with self._lock:
+            if group in self._pipelines:
+                return self._activate(group, use)
+        with self._load_locks[group]:
+            with self._lock:
+                # loaded by another request while this one waited
+                if group in self._pipelines:
+                    return self._activate(group, use)
+            print("Loading application", name)
+            pipeline = self._loaders[group]()
+            with self._lock:
+                self._pipelines[group] = pipeline
+                return self._activate(group, use)
+
+    def _activate(self, group, use):
+        """ marks a loaded group as most recently used (and in use), under the lock """
+        pipeline = self._pipelines[group]
+        self._pipelines.move_to_end(group)
+        if group in self._offloaded:
+            pipeline.model.to(pipeline.device)
+            _refresh_serving_model(pipeline)
+            self._offloaded.discard(group)
+        if use:
+            self._in_use[group] += 1
+        self._enforce_budget(pipeline.device)
+        return pipeline
+
+    def share_memory(self) -> int:
+        """
+        Moves the weights of every loaded pipeline to shared memory so worker
+        processes forked afterwards all reference this one copy instead of
+        duplicating pages. Returns the bytes shared. Only for CPU pipelines,
+        CUDA can not be used after a fork. CPU serving copies (see
+        ExecutionPolicy) are built first, so workers inherit them too.
+        """
+        shared = 0
+        with self._lock:
+            for group, pipeline in self._pipelines.items():
+                if _device_key(pipeline.device) != "cpu":
+                    raise ValueError(
+                        "application group {} is on {}, forked workers need CPU models".format(
+                            group, _device_key(pipeline.device)
+                        )
+                    )
+                if hasattr(pipeline, "build_serving_model"):
+                    pipeline.build_serving_model()
+                pipeline.model.share_memory()
+                shared += model_memory(pipeline.model)
+        return shared
+
+    @contextmanager
+    def using(self, name):
+        """ protects the pipeline from eviction while a request is using it """
+        group = self._groups[name]
+        pipeline = self._get(name, use=True)
+        try:
+            yield pipeline
+        finally:
+            with self._lock:
+                self._in_use[group] -= 1
+
+    def _enforce_budget(self, device):
+        if self.memory_budget is None:
+            return
+        device = _device_key(device)
+        resident = [
+            group
+            for group, pipeline in self._pipelines.items()
+            if group not in self._offloaded and _device_key(pipeline.device) == device
+        ]
+        used = sum(model_memory(self._pipelines[group].model) for group in resident)
+        # the most recently used pipeline (the one just requested) is never evicted
+        for group in resident[:-1]:
+            if used <= self.memory_budget:
+                break
+            if self._in_use[group]:
+                continue
+            pipeline = self._pipelines[group]
+            used -= model_memory(pipeline.model)
+            if self.offload == "cpu" and device != "cpu":
+                print("Offloading application group", group, "to cpu")
+                pipeline.model.to("cpu")
+                _refresh_serving_model(pipeline)
+                self._offloaded.add(group)
+            else:
+                print("Evicting application group", group)
+                _refresh_serving_model(pipeline)
+                del self._pipelines[group]
+
+
+def _refresh_serving_model(pipeline):
+    """ serving copies are built from the weights, drop them when those move """
+    if hasattr(pipeline, "refresh_serving_model"):
+        pipeline.refresh_serving_model()
+
+
+def _device_key(device) -> str:
+    if isinstance(device, int):
+        device = int_to_device(device)
+    return str(device)
+
+
+def load_all_applications(
+    applications: List[str], lazy=False, memory_budget=None, offload="cpu"
+):
+    print(applications)
+    application_list = ApplicationRegistry(applications, memory_budget, offload)
+    if not lazy:
+        application_list.load_all()
     return application_list
@@ -0,0 +1,245 @@
+import os
+import signal
+import socket
+import threading
+import time
+import torch
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from Maestro.utils.utils import int_to_device
+from Maestro.utils.tracing import metrics
+
+SERVERS = ["flask", "waitress", "gunicorn", "prefork"]
+# servers forking worker processes off the process that loaded the applications
+FORKING_SERVERS = ["gunicorn", "prefork"]
+
+
+class _FairQueue:
+    """
+    Worker threads serving the queued calls round robin across tenants (e.g.
+    attackers) and in order within a tenant, so one tenant with many queued
+    calls can not starve the others.
+    """
+
+    def __init__(self, workers: int, name: str) -> None:
+        self._queues = OrderedDict()
+        self._condition = threading.Condition()
+        for i in range(workers):
+            threading.Thread(
+                target=self._work, name="{}-{}".format(name, i), daemon=True
+            ).start()
+
+    def submit(self, tenant, fn) -> Future:
+        future = Future()
+        with self._condition:
+            self._queues.setdefault(tenant, deque()).append((future, fn))
+            self._condition.notify()
+        return future
+
+    def _work(self):
+        while True:
+            with self._condition:
+                while not self._queues:
+                    self._condition.wait()
+                tenant, queue = next(iter(self._queues.items()))
+                future, fn = queue.popleft()
+                # the tenant goes to the back of the line
+                del self._queues[tenant]
+                if queue:
+                    self._queues[tenant] = queue
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn())
+            except BaseException as e:
+                future.set_exception(e)
+
+
+class DeviceExecutor:
+    """
+    Funnels model execution through a small thread pool per device so request
+    threads only do the CPU side work (decoding, encoding, JSON) concurrently
+    while the forward/backward passes of one device never contend. Calls of
+    different tenants (attackers) are served round robin.
+    """
+
+    def __init__(self, workers_per_device: int = 1) -> None:
+        self.workers_per_device = workers_per_device
+        self._executors = {}
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def run(self, device, fn, *args, **kwargs):
+        return self.run_for(None, device, fn, *args, **kwargs)
+
+    def run_for(self, tenant, device, fn, *args, **kwargs):
+        """
+        Runs fn on the device's workers, queued behind the other calls of the
+        same tenant.
+        """
+        submitted = time.perf_counter()
+
+        def call():
+            # time spent waiting for the device, e.g. behind other requests
+            metrics.record("device_queue", time.perf_counter() - submitted)
+            return fn(*args, **kwargs)
+
+        return self._executor(device).submit(tenant, call).result()
+
+    def _executor(self, device):
+        key = str(int_to_device(device)) if isinstance(device, int) else str(device)
+        with self._lock:
+            if self._pid != os.getpid():
+                # worker threads do not survive a fork, start over in the child
+                self._executors = {}
+                self._pid = os.getpid()
+            if key not in self._executors:
+                self._executors[key] = _FairQueue(
+                    self.workers_per_device, "maestro-" + key.replace(":", "-")
+                )
+            return self._executors[key]
+
+
+def serve(app, server="flask", host="0.0.0.0", port=5000, workers=1, threads=8):
+    """
+    Runs the flask app with the chosen server:
+        flask: werkzeug development server, one process with a thread per request.
+        waitress: production grade multi-threaded server in one process, use it
+            when the models live on a GPU.
+        gunicorn: pre-fork server with `workers` processes of `threads` threads
+            each. The applications are loaded before forking so this is meant
+            for CPU-only nodes (CUDA can not be used after a fork).
+        prefork: the same without gunicorn, `workers` forked werkzeug servers
+            accepting on one shared socket; crashed workers are replaced, with
+            a growing delay when they keep crashing right after their start.
+    With the forking servers the workers share the weights of the parent, see
+    ApplicationRegistry.share_memory.
+    """
+    if server == "flask":
+        app.run(host=host, port=port, threaded=True)
+    elif server == "waitress":
+        try:
+            import waitress
+        except ImportError:
+            raise ImportError("--server waitress requires `pip install waitress`")
+        waitress.serve(app, host=host, port=port, threads=threads)
+    elif server == "gunicorn":
+        try:
+            from gunicorn.app.base import BaseApplication
+        except ImportError:
+            raise ImportError("--server gunicorn requires `pip install gunicorn`")
+
+        class _Application(BaseApplication):
+            def load_config(self):
+                self.cfg.set("bind", "{}:{}".format(host, port))
+                self.cfg.set("workers", workers)
+                self.cfg.set("threads", threads)
+                self.cfg.set("worker_class", "gthread")
+                # model calls can legitimately take long, e.g. iterative attacks
+                self.cfg.set("timeout", 0)
+                self.cfg.set("preload_app", True)
+                self.cfg.set("post_fork", lambda server, worker: _init_worker(workers))
+
+            def load(self):
+                return app
+
+        _Application().run()
+    elif server == "prefork":
+        _serve_prefork(app, host, port, workers)
+    else:
+        raise ValueError("unknown server {}, expected one of {}".format(server, SERVERS))
+
+
+def _init_worker(workers):
+    # the workers split the cores instead of each running torch on all of them
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    torch.set_num_threads(min(torch.get_num_threads(), threads))
+
+
+class _RespawnBackoff:
+    """
+    Paces the replacement of prefork workers. A worker exiting within
+    min_uptime seconds of its start (e.g. failing at startup) is replaced after
+    a delay doubling with every such exit in a row, up to max_delay, and after
+    max_failures of them in a row the server gives up instead of forking in a
+    tight loop. A worker which ran for at least min_uptime resets the count.
+    """
+
+    def __init__(
+        self,
+        min_uptime: float = 10.0,
+        base_delay: float = 0.5,
+        max_delay: float = 30.0,
+        max_failures: int = 10,
+    ) -> None:
+        self.min_uptime = min_uptime
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_failures = max_failures
+        self.failures = 0
+
+    def exited(self, uptime: float) -> float:
+        """
+        Returns the seconds to wait before replacing a worker which ran for
+        `uptime` seconds, raises RuntimeError once it is time to give up.
+        """
+        if uptime >= self.min_uptime:
+            self.failures = 0
+            return 0.0
+        self.failures += 1
+        if self.failures >= self.max_failures:
+            raise RuntimeError(
+                "{} workers in a row exited within {}s of their start, giving up".format(
+                    self.failures, self.min_uptime
+                )
+            )
+        return min(self.base_delay * 2 ** (self.failures - 1), self.max_delay)
+
+
+def _serve_prefork(app, host, port, workers, backoff=None):
+    from werkzeug.serving import make_server
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((host, port))
+    listener.listen(128)
+    listener.set_inheritable(True)
+    backoff = backoff or _RespawnBackoff()
+    # pid -> time.monotonic() at fork
+    children = {}
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                _init_worker(workers)
+                make_server(host, port, app, threaded=True, fd=listener.fileno()).serve_forever()
+                status = 0
+            finally:
+                os._exit(status)
+        children[pid] = time.monotonic()
+
+    for _ in range(workers):
+        spawn()
+    print("Forked", workers, "workers")
+    try:
+        while children:
+            pid, status = os.wait()
+            started = children.pop(pid, None)
+            if started is None:
+                continue
+            code = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+            delay = backoff.exited(time.monotonic() - started)
+            print(
+                "worker {} exited with {}, starting a new one in {:.1f}s".format(
+                    pid, code, delay
+                )
+            )
+            time.sleep(delay)
+            spawn()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
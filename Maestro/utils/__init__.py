@@ -1 +1,14 @@
-from Maestro.utils.utils import move_to_device, get_embedding, list_to_json, get_json_data
+from Maestro.utils.utils import (
+    move_to_device,
+    get_embedding,
+    list_to_json,
+    get_json_data,
+    get_json_instance,
+    select_examples,
+    model_fingerprint,
+)
+from Maestro.utils.serialization import TENSOR_CONTENT_TYPE, encode_tensors, decode_tensors
+from Maestro.utils.tracing import Metrics, metrics
+from Maestro.utils.cache import ResponseCache, cache_key
+from Maestro.utils.token_cache import TokenizedDataset, cached_trainable_data
+from Maestro.utils.weight_store import save_weights, load_weights, load_checkpoint, skip_init
@@ -0,0 +1,89 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Optional
+
+import numpy as np
+
+from Maestro.utils.tracing import metrics
+
+
+def cache_key(*parts) -> str:
+    """
+    Content address of a query: sha256 over its parts. Strings and bytes are
+    hashed as they are, arrays with their dtype and shape, None as a marker.
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        if part is None:
+            digest.update(b"\x00none")
+        elif isinstance(part, (bytes, bytearray, memoryview)):
+            digest.update(b"\x01%d:" % len(part))
+            digest.update(part)
+        elif isinstance(part, str):
+            encoded = part.encode()
+            digest.update(b"\x02%d:" % len(encoded))
+            digest.update(encoded)
+        else:
+            array = np.ascontiguousarray(part)
+            digest.update(
+                "\x03{}{}:".format(array.dtype.str, array.shape).encode()
+            )
+            digest.update(array.tobytes())
+    return digest.hexdigest()
+
+
+class ResponseCache:
+    """
+    Thread-safe LRU cache of query responses bounded by the total size of the
+    cached values. Hits and misses are counted on the cache and, when it has a
+    name, as "<name>_hits"/"<name>_misses" counters of the metrics registry.
+    """
+
+    def __init__(self, max_bytes: int, name: str = None) -> None:
+        self.max_bytes = max_bytes
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end(key)
+        if self.name is not None:
+            metrics.increment(self.name + ("_misses" if entry is None else "_hits"))
+        return None if entry is None else entry[0]
+
+    def put(self, key: str, value: Any, size: int) -> None:
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries = OrderedDict()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
@@ -0,0 +1,107 @@
+import struct
+from typing import List, Sequence, Union
+import numpy as np
+import torch
+
+# Binary wire format shared by the server and the attacker helper.
+#
+#   header:  magic (4s) | version (B) | flags (B) | count (H)
+#   tensor:  dtype code (B) | ndim (B) | shape (ndim * Q) | raw little-endian data
+#
+# flags bit 0 marks a sequence of tensors (e.g. the (loss, logits) output of a
+# huggingface model); without it the payload decodes to a single array.
+
+TENSOR_CONTENT_TYPE = "application/x-maestro-tensor"
+
+_MAGIC = b"MTSR"
+_VERSION = 1
+_FLAG_SEQUENCE = 1
+_HEADER = struct.Struct("<4sBBH")
+_TENSOR_HEADER = struct.Struct("<BB")
+
+_DTYPES = [
+    np.dtype("<f2"),
+    np.dtype("<f4"),
+    np.dtype("<f8"),
+    np.dtype("<i4"),
+    np.dtype("<i8"),
+    np.dtype("u1"),
+    np.dtype("?"),
+]
+_DTYPE_CODES = {dtype: code for code, dtype in enumerate(_DTYPES)}
+
+
+def _to_numpy(x) -> np.ndarray:
+    if isinstance(x, torch.Tensor):
+        return x.detach().cpu().numpy()
+    return np.asarray(x)
+
+
+def _encode_one(x, dtype=None) -> bytes:
+    array = _to_numpy(x)
+    if dtype is not None and array.dtype.kind == "f":
+        array = array.astype(dtype)
+    # ascontiguousarray promotes 0-d arrays (e.g. a scalar loss) to 1-d, keep the shape
+    array = np.ascontiguousarray(array, dtype=array.dtype.newbyteorder("<")).reshape(
+        array.shape
+    )
+    if array.dtype not in _DTYPE_CODES:
+        raise TypeError("unsupported dtype for tensor serialization: %s" % array.dtype)
+    header = _TENSOR_HEADER.pack(_DTYPE_CODES[array.dtype], array.ndim)
+    shape = struct.pack("<%dQ" % array.ndim, *array.shape)
+    return header + shape + array.tobytes()
+
+
+def encode_tensors(tensors: Union[np.ndarray, torch.Tensor, Sequence], dtype=None) -> bytes:
+    """
+    Serialize a tensor or a sequence of tensors into the binary wire format.
+    ``dtype`` (e.g. ``"float16"``) only downcasts floating point tensors.
+    """
+    sequence = not isinstance(tensors, (np.ndarray, torch.Tensor))
+    if not sequence:
+        tensors = [tensors]
+    tensors = list(tensors)
+    flags = _FLAG_SEQUENCE if sequence else 0
+    chunks = [_HEADER.pack(_MAGIC, _VERSION, flags, len(tensors))]
+    for x in tensors:
+        chunks.append(_encode_one(x, dtype))
+    return b"".join(chunks)
+
+
+def decode_tensors(payload: bytes) -> Union[np.ndarray, List[np.ndarray]]:
+    """
+    Inverse of ``encode_tensors``. The returned arrays are read-only views on
+    ``payload`` so no copy is made. Malformed payloads raise ValueError.
+    """
+    buffer = memoryview(payload)
+    try:
+        magic, version, flags, count = _HEADER.unpack_from(buffer, 0)
+        if magic != _MAGIC or version != _VERSION:
+            raise ValueError("not a Maestro tensor payload")
+        if not flags & _FLAG_SEQUENCE and count != 1:
+            raise ValueError("a single tensor payload holds %d tensors" % count)
+        offset = _HEADER.size
+        tensors = []
+        for _ in range(count):
+            code, ndim = _TENSOR_HEADER.unpack_from(buffer, offset)
+            offset += _TENSOR_HEADER.size
+            if code >= len(_DTYPES):
+                raise ValueError("unknown dtype code %d in Maestro tensor payload" % code)
+            shape = struct.unpack_from("<%dQ" % ndim, buffer, offset)
+            offset += 8 * ndim
+            dtype = _DTYPES[code]
+            size = 1
+            for dim in shape:
+                size *= dim
+            if offset + size * dtype.itemsize > len(buffer):
+                raise ValueError("truncated Maestro tensor payload")
+            array = np.frombuffer(buffer, dtype=dtype, count=size, offset=offset)
+            offset += size * dtype.itemsize
+            tensors.append(array.reshape(shape))
+    except struct.error:
+        raise ValueError("truncated Maestro tensor payload")
+    if offset != len(buffer):
+        raise ValueError("trailing bytes in Maestro tensor payload")
+    if flags & _FLAG_SEQUENCE:
+        return tensors
+    return tensors[0]
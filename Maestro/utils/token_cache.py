@@ -0,0 +1,148 @@
+import hashlib
+import json
+import os
+import shutil
+from typing import Any, Dict
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "maestro", "tokenized")
+
+
+def dataset_identity(dataset) -> Dict[str, Any]:
+    """
+    What tells one dataset split from another: its huggingface name, subset and
+    split when it has them, its class and its number of examples.
+    """
+    identity = {"class": type(dataset).__name__, "examples": len(dataset)}
+    for attribute in ("name", "subset", "split", "label_map"):
+        value = getattr(dataset, attribute, None)
+        if value is not None:
+            identity[attribute] = value if isinstance(value, (str, int)) else repr(value)
+    return identity
+
+
+def tokenizer_identity(tokenizer) -> Dict[str, Any]:
+    """
+    The tokenizer's class, name and a hash of its vocabulary, so retrained or
+    extended vocabularies get their own cache entries.
+    """
+    vocab = json.dumps(sorted(tokenizer.get_vocab().items()))
+    return {
+        "class": type(tokenizer).__name__,
+        "name": getattr(tokenizer, "name_or_path", None),
+        "vocab": hashlib.sha256(vocab.encode()).hexdigest(),
+        "do_lower_case": getattr(tokenizer, "do_lower_case", None),
+    }
+
+
+def tokenized_cache_key(dataset, tokenizer, max_length: int) -> str:
+    key = {
+        "dataset": dataset_identity(dataset),
+        "tokenizer": tokenizer_identity(tokenizer),
+        "max_length": max_length,
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+class TokenizedDataset(Dataset):
+    """
+    A tokenized split stored as one memory-mapped .npy file per column
+    (input_ids, attention_mask, labels, ...). Examples are read straight from
+    the page cache, so reopening a split costs no tokenization and no copy of
+    the whole split.
+    """
+
+    def __init__(self, path: str) -> None:
+        with open(os.path.join(path, "columns.json")) as f:
+            self.manifest = json.load(f)
+        self.path = path
+        self.columns = {
+            name: np.load(os.path.join(path, name + ".npy"), mmap_mode="r")
+            for name in self.manifest["columns"]
+        }
+
+    def __len__(self):
+        return self.manifest["examples"]
+
+    def __getitem__(self, index) -> Dict[str, torch.Tensor]:
+        # np.array copies the row out of the read-only map, torch wants writable memory
+        return {
+            name: torch.as_tensor(np.array(column[index]))
+            for name, column in self.columns.items()
+        }
+
+    @classmethod
+    def write(cls, path: str, examples, metadata: Dict[str, Any] = None) -> "TokenizedDataset":
+        """
+        Writes the examples (dicts of tensors, arrays or ints padded to the same
+        shapes, e.g. the output of get_trainable_data) column by column and
+        opens the result. The split only becomes visible once fully written.
+        """
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        columns = None
+        for index in range(len(examples)):
+            example = {name: _to_numpy(value) for name, value in examples[index].items()}
+            if columns is None:
+                columns = {
+                    name: np.lib.format.open_memmap(
+                        os.path.join(tmp_path, name + ".npy"),
+                        mode="w+",
+                        dtype=value.dtype,
+                        shape=(len(examples),) + value.shape,
+                    )
+                    for name, value in example.items()
+                }
+            for name, value in example.items():
+                columns[name][index] = value
+        columns = columns or {}
+        for column in columns.values():
+            column.flush()
+        manifest = {
+            "examples": len(examples),
+            "columns": list(columns),
+            "metadata": metadata or {},
+        }
+        with open(os.path.join(tmp_path, "columns.json"), "w") as f:
+            json.dump(manifest, f)
+        del columns
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # another process wrote the same split first
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        return cls(path)
+
+
+def _to_numpy(value) -> np.ndarray:
+    if isinstance(value, torch.Tensor):
+        return value.detach().cpu().numpy()
+    return np.asarray(value)
+
+
+def cached_trainable_data(
+    dataset, tokenizer, max_length: int = 128, cache_dir: str = None
+) -> TokenizedDataset:
+    """
+    Returns dataset.get_trainable_data(tokenizer, max_length) from the on-disk
+    cache under cache_dir (default ~/.cache/maestro/tokenized), tokenizing and
+    writing the split only the first time.
+    """
+    if cache_dir is None:
+        cache_dir = DEFAULT_CACHE_DIR
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, tokenized_cache_key(dataset, tokenizer, max_length))
+    if os.path.isfile(os.path.join(path, "columns.json")):
+        return TokenizedDataset(path)
+    print("tokenizing", dataset_identity(dataset), "into", path)
+    metadata = {
+        "dataset": dataset_identity(dataset),
+        "tokenizer": tokenizer_identity(tokenizer),
+        "max_length": max_length,
+    }
+    examples = dataset.get_trainable_data(tokenizer, max_length)
+    return TokenizedDataset.write(path, examples, metadata)
@@ -0,0 +1,132 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Dict
+
+import numpy as np
+
+
+class _Summary:
+    """
+    Count, sum and max of a series plus its most recent `window` values for
+    the percentiles.
+    """
+
+    def __init__(self, window: int = 1024) -> None:
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.recent = deque(maxlen=window)
+
+    def add(self, value: float) -> None:
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+        self.recent.append(value)
+
+    def snapshot(self) -> Dict[str, float]:
+        p50, p95, p99 = np.percentile(self.recent, [50, 95, 99]) if self.recent else (0, 0, 0)
+        return {
+            "count": self.count,
+            "total": self.total,
+            "mean": self.total / self.count if self.count else 0.0,
+            "max": self.max,
+            "p50": float(p50),
+            "p95": float(p95),
+            "p99": float(p99),
+        }
+
+
+class Metrics:
+    """
+    Thread-safe latency and value summaries of the hot path, e.g. per-route and
+    per-stage (decode, tokenize, forward, backward, serialize) latencies, batch
+    sizes and payload bytes, and counters such as cache hits. Timings can also
+    be appended to a trace file in the Chrome trace event format (open it in
+    chrome://tracing or ui.perfetto.dev).
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._latencies = {}
+        self._values = {}
+        self._counters = {}
+        self._trace = None
+        self._started = time.time()
+
+    def open_trace(self, path: str) -> None:
+        """
+        Appends every timed event to `path` from now on.
+        """
+        trace = open(path, "a", buffering=1)
+        if trace.tell() == 0:
+            # the closing bracket of the JSON array is optional for trace viewers
+            trace.write("[\n")
+        with self._lock:
+            self._trace = trace
+
+    def observe(self, name: str, value: float) -> None:
+        with self._lock:
+            if name not in self._values:
+                self._values[name] = _Summary()
+            self._values[name].add(value)
+
+    def increment(self, name: str, count: int = 1) -> None:
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + count
+
+    def record(self, name: str, seconds: float, start: float = None, **args) -> None:
+        with self._lock:
+            if name not in self._latencies:
+                self._latencies[name] = _Summary()
+            self._latencies[name].add(seconds)
+            if self._trace is not None:
+                if start is None:
+                    start = time.time() - seconds
+                event = {
+                    "name": name,
+                    "ph": "X",
+                    "ts": int(start * 1e6),
+                    "dur": int(seconds * 1e6),
+                    "pid": os.getpid(),
+                    "tid": threading.get_ident(),
+                    "args": args,
+                }
+                self._trace.write(json.dumps(event) + ",\n")
+
+    @contextmanager
+    def timer(self, name: str, **args):
+        """
+        Records the wall time of the block under `name`; `args` only go to the
+        trace file (e.g. the application or the batch size).
+        """
+        start = time.time()
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started, start, **args)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "uptime_seconds": time.time() - self._started,
+                "latency_seconds": {
+                    name: summary.snapshot() for name, summary in self._latencies.items()
+                },
+                "values": {name: summary.snapshot() for name, summary in self._values.items()},
+                "counters": dict(self._counters),
+            }
+
+    def reset(self) -> None:
+        with self._lock:
+            self._latencies = {}
+            self._values = {}
+            self._counters = {}
+
+
+# process wide registry used by the server and the pipelines
+metrics = Metrics()
@@ -1,19 +1,51 @@
-from typing import Any, Dict, List, Optional, Sequence, Tuple, TypeVar, Union
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple, TypeVar, Union
 import torch
 import json
+import hashlib
 
 
 def get_json_data(examples):
     new_data = []
     for idx, instance in enumerate(examples):
-        new_instance = {}
-        new_instance["image"] = instance[0].numpy().tolist()
-        new_instance["label"] = instance[1]
-        new_instance["uid"] = idx
-        new_data.append(new_instance)
+        new_data.append(get_json_instance(instance, idx))
     return new_data
 
 
+def get_json_instance(instance, uid):
+    new_instance = {}
+    new_instance["image"] = instance[0].numpy().tolist()
+    new_instance["label"] = int(instance[1])
+    new_instance["uid"] = uid
+    return new_instance
+
+
+def select_examples(
+    examples, offset: int = 0, limit: int = None, label: int = None, uids: List[int] = None
+) -> Iterator[int]:
+    """
+    Yields the uids (indices) of the examples matching label/uids, skipping the
+    first `offset` matches and stopping after `limit`. Labels are read from
+    `examples.targets` when the dataset has it (torchvision) so that filtering
+    does not decode every image.
+    """
+    candidates = range(len(examples)) if uids is None else uids
+    targets = getattr(examples, "targets", None)
+    skipped = 0
+    returned = 0
+    for uid in candidates:
+        if limit is not None and returned >= limit:
+            return
+        if label is not None:
+            example_label = targets[uid] if targets is not None else examples[uid][1]
+            if int(example_label) != label:
+                continue
+        if skipped < offset:
+            skipped += 1
+            continue
+        returned += 1
+        yield uid
+
+
 def int_to_device(device: Union[int, torch.device]) -> torch.device:
     if isinstance(device, torch.device):
         return device
@@ -85,3 +117,21 @@ def get_embedding(model):
             embedding = module
             break
     return embedding
+
+
+def model_fingerprint(model) -> str:
+    """
+    sha256 over the names, shapes, dtypes and values of the model's state_dict.
+    Clients use it to tell whether their cached vocabulary/embedding still
+    belongs to the model being served.
+    """
+    digest = hashlib.sha256()
+    for name, tensor in model.state_dict().items():
+        tensor = tensor.detach().cpu().contiguous()
+        digest.update(name.encode())
+        digest.update(str((tuple(tensor.shape), str(tensor.dtype))).encode())
+        if tensor.dtype == torch.bfloat16:
+            # numpy has no bfloat16
+            tensor = tensor.float()
+        digest.update(tensor.numpy().tobytes())
+    return digest.hexdigest()
@@ -0,0 +1,194 @@
+import glob
+import inspect
+import json
+import os
+import re
+import shutil
+import uuid
+from typing import Dict, Union
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from Maestro.utils.utils import int_to_device
+
+try:
+    import safetensors.torch
+except ImportError:
+    safetensors = None
+
+SAFETENSORS_FILE = "model.safetensors"
+INDEX_FILE = "index.json"
+DATA_FILE = "weights.bin"
+# tensor offsets in weights.bin, so every dtype can be viewed in place
+ALIGNMENT = 64
+# <store>.<version>: the directories a store path points at
+_VERSION_PATTERN = re.compile(r"\.[0-9a-f]{32}$")
+
+
+def weight_store_path(checkpoint: str) -> str:
+    """
+    Where the weight store of a checkpoint lives: <file>.weights next to a
+    checkpoint file, <dir>/maestro.weights in a checkpoint directory. The store
+    path is a symlink to the current version, <store>.<version>.
+    """
+    if os.path.isdir(checkpoint):
+        return os.path.join(checkpoint, "maestro.weights")
+    return checkpoint + ".weights"
+
+
+def has_weights(path: str) -> bool:
+    return os.path.isfile(os.path.join(path, SAFETENSORS_FILE)) or os.path.isfile(
+        os.path.join(path, INDEX_FILE)
+    )
+
+
+def save_weights(state_dict: Union[nn.Module, Dict[str, torch.Tensor]], path: str) -> None:
+    """
+    Writes a state_dict (or a model's) as a memory-mappable weight store: a
+    safetensors file when safetensors is installed, otherwise the raw tensors
+    back to back in weights.bin with their dtype, shape and offset in index.json
+(bfloat16 tensors as float32, numpy has no bfloat16).
+
+    Every save writes a new version directory and then swaps the store's
+    symlink over to it in one rename, so readers see either the old or the new
+    weights, never a missing or half written store.
+    """
+    if isinstance(state_dict, nn.Module):
+        state_dict = state_dict.state_dict()
+    # clones: tied weights would share storage, which safetensors refuses
+    tensors = {
+        name: tensor.detach().cpu().contiguous().clone() for name, tensor in state_dict.items()
+    }
+    path = path.rstrip(os.sep)
+    version = "{}.{}".format(path, uuid.uuid4().hex)
+    os.makedirs(version)
+    if safetensors is not None:
+        safetensors.torch.save_file(tensors, os.path.join(version, SAFETENSORS_FILE))
+    else:
+        index = {}
+        offset = 0
+        with open(os.path.join(version, DATA_FILE), "wb") as f:
+            for name, tensor in tensors.items():
+                padding = -offset % ALIGNMENT
+                f.write(b"\0" * padding)
+                offset += padding
+                entry = {"dtype": str(tensor.dtype).replace("torch.", "")}
+                if tensor.dtype == torch.bfloat16:
+                    # numpy has no bfloat16, every bfloat16 is exactly a float32
+                    tensor = tensor.float()
+                    entry["stored_dtype"] = "float32"
+                # through numpy, Tensor.view(dtype) needs torch >= 1.8
+                data = tensor.numpy().tobytes()
+                f.write(data)
+                entry.update(shape=list(tensor.shape), offset=offset, nbytes=len(data))
+                index[name] = entry
+                offset += len(data)
+        with open(os.path.join(version, INDEX_FILE), "w") as f:
+            json.dump(index, f)
+    _point_to(path, version)
+
+
+def _point_to(path: str, version: str) -> None:
+    """
+    Atomically points the store path at a version and removes the versions
+    before the previous one (processes that already resolved the previous
+    version may still be opening it; mapped files outlive their removal).
+    """
+    previous = os.path.realpath(path) if os.path.islink(path) else None
+    if os.path.isdir(path) and not os.path.islink(path):
+        # a store written before versioning, moved aside once
+        previous = "{}.{}".format(path, uuid.uuid4().hex)
+        os.rename(path, previous)
+    link = "{}.{}.link".format(path, uuid.uuid4().hex)
+    os.symlink(os.path.basename(version), link)
+    os.replace(link, path)
+    for old in glob.glob(glob.escape(path) + ".*"):
+        if not _VERSION_PATTERN.search(old) or not os.path.isdir(old):
+            continue
+        if os.path.realpath(old) not in (os.path.realpath(version), previous):
+            shutil.rmtree(old, ignore_errors=True)
+
+
+def load_weights(path: str, device="cpu") -> Dict[str, torch.Tensor]:
+    """
+    Opens a weight store without reading it: CPU tensors are copy-on-write
+    views of the memory-mapped file, so processes loading the same store share
+    its pages; tensors for other devices are copied there one at a time.
+    """
+    device = int_to_device(device) if isinstance(device, int) else torch.device(device)
+    safetensors_file = os.path.join(path, SAFETENSORS_FILE)
+    if os.path.isfile(safetensors_file):
+        if safetensors is None:
+            raise ImportError("{} needs `pip install safetensors`".format(safetensors_file))
+        return safetensors.torch.load_file(safetensors_file, device=str(device))
+
+    with open(os.path.join(path, INDEX_FILE)) as f:
+        index = json.load(f)
+    data = np.memmap(os.path.join(path, DATA_FILE), dtype=np.uint8, mode="c")
+    tensors = {}
+    for name, entry in index.items():
+        raw = data[entry["offset"] : entry["offset"] + entry["nbytes"]]
+        stored_dtype = entry.get("stored_dtype", entry["dtype"])
+        if stored_dtype == "bfloat16":
+            # written by an older version, as raw bfloat16 bits
+            tensor = torch.from_numpy(raw.view(np.int16)).view(torch.bfloat16)
+        else:
+            tensor = torch.from_numpy(raw.view(np.dtype(stored_dtype)))
+            if stored_dtype != entry["dtype"]:
+                tensor = tensor.to(getattr(torch, entry["dtype"]))
+        tensor = tensor.reshape(entry["shape"])
+        if device.type != "cpu":
+            tensor = tensor.to(device)
+        tensors[name] = tensor
+    return tensors
+
+
+def _assign_supported() -> bool:
+    return "assign" in inspect.signature(nn.Module.load_state_dict).parameters
+
+
+def skip_init(module_cls, *args, **kwargs) -> nn.Module:
+    """
+    Builds module_cls(*args, **kwargs) for weights that are loaded right after
+    with load_model_weights. On torch >= 2.1 it is built on the meta device, so
+    no memory is allocated and nothing is initialized until the loaded tensors
+    are assigned; older versions build and initialize it as usual.
+    """
+    if _assign_supported() and hasattr(torch.device, "__enter__"):
+        with torch.device("meta"):
+            return module_cls(*args, **kwargs)
+    return module_cls(*args, **kwargs)
+
+
+def load_model_weights(model: nn.Module, state_dict: Dict[str, torch.Tensor]) -> nn.Module:
+    """
+    Points the model's parameters at the loaded tensors (torch >= 2.1) instead
+    of copying them, falling back to load_state_dict's copy.
+    """
+    if _assign_supported():
+        model.load_state_dict(state_dict, assign=True)
+    else:
+        model.load_state_dict(state_dict)
+    missing = [
+        name
+        for name, tensor in list(model.named_parameters()) + list(model.named_buffers())
+        if tensor.device.type == "meta"
+    ]
+    if missing:
+        raise ValueError("no weights loaded for {}".format(missing))
+    return model
+
+
+def load_checkpoint(model: nn.Module, checkpoint: str, device="cpu") -> nn.Module:
+    """
+    Loads a torch.save state_dict checkpoint into the model through its weight
+    store, which is written from the checkpoint the first time (and again
+    whenever the checkpoint is newer).
+    """
+    store = weight_store_path(checkpoint)
+    if not has_weights(store) or os.path.getmtime(store) < os.path.getmtime(checkpoint):
+        save_weights(torch.load(checkpoint, map_location="cpu"), store)
+    load_model_weights(model, load_weights(store, device))
+    return model.to(int_to_device(device) if isinstance(device, int) else device)
@@ -0,0 +1,110 @@
+import os
+import sys
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+pytest.importorskip("Maestro.pipeline")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "Maestro", "server"))
+from app import create_app  # noqa: E402
+from Maestro.pipeline import QueryBudget  # noqa: E402
+from Maestro.utils import TENSOR_CONTENT_TYPE, metrics  # noqa: E402
+
+PROXY = "10.0.0.1"
+
+
+class FakePipeline:
+    device = "cpu"
+    tokenizer = None
+
+    def __init__(self, budget) -> None:
+        self.scenario = SimpleNamespace(query_budget=budget)
+        self.calls = 0
+        examples = [(torch.full((2, 2), float(i)), i % 2) for i in range(3)]
+        self.training_data = SimpleNamespace(get_write_data=lambda: examples)
+
+    def get_fingerprint(self):
+        return "fake"
+
+    def get_batch_output(self, batch_input, labels):
+        self.calls += 1
+        return torch.as_tensor(batch_input) * 2
+
+
+class FakeRegistry(dict):
+    @contextmanager
+    def using(self, name):
+        yield self[name]
+
+
+def _client(budget, **kwargs):
+    pipeline = FakePipeline(budget)
+    app = create_app(FakeRegistry(app=pipeline), trusted_proxies=[PROXY], **kwargs)
+    return app.test_client(), pipeline
+
+
+def _query(client, attacker=None, address="127.0.0.1"):
+    headers = {"X-Maestro-Attacker": attacker} if attacker else {}
+    return client.post(
+        "/get_batch_output",
+        json={"Application_Name": "app", "data": [[1.0, 2.0]], "labels": [0]},
+        headers=headers,
+        environ_base={"REMOTE_ADDR": address},
+    )
+
+
+def test_budget_is_kept_per_address():
+    client, _ = _client(QueryBudget(forward_queries=1))
+    assert _query(client).status_code == 200
+    assert _query(client).status_code == 429
+    # a made up attacker name does not open a new budget
+    assert _query(client, attacker="someone-else").status_code == 429
+    assert _query(client, address="127.0.0.2").status_code == 200
+
+
+def test_attacker_header_is_trusted_from_proxies():
+    client, _ = _client(QueryBudget(forward_queries=1))
+    assert _query(client, attacker="alice", address=PROXY).status_code == 200
+    assert _query(client, attacker="alice", address=PROXY).status_code == 429
+    assert _query(client, attacker="bob", address=PROXY).status_code == 200
+
+
+def test_cached_responses_are_charged():
+    client, pipeline = _client(QueryBudget(forward_queries=2), cache_bytes=1 << 20)
+    first, second = _query(client), _query(client)
+    assert second.get_json() == first.get_json()
+    assert pipeline.calls == 1
+    assert _query(client).status_code == 429
+
+
+def test_queries_larger_than_burst_are_rejected():
+    client, _ = _client(QueryBudget(rate=1, burst=2))
+    response = client.post(
+        "/score_candidates",
+        json={
+            "Application_Name": "app",
+            "data": [[101, 5, 102]],
+            "labels": [0],
+            "candidates": [[1], [2], [3]],
+        },
+    )
+    assert response.status_code == 400
+
+
+@pytest.mark.parametrize("accept", ["application/x-ndjson", TENSOR_CONTENT_TYPE])
+def test_streamed_response_bytes_are_recorded(accept):
+    client, _ = _client(QueryBudget())
+    metrics.reset()
+    response = client.post(
+        "/get_data",
+        json={"Application_Name": "app", "data_type": "train"},
+        headers={"Accept": accept},
+    )
+    body = response.get_data()
+    assert len(body) > 0
+    response.close()
+    recorded = metrics.snapshot()["values"]["response_bytes:/get_data"]
+    assert recorded["count"] == 1
+    assert recorded["total"] == len(body)
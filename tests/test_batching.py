@@ -0,0 +1,160 @@
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+import pytest
+import torch
+import torch.nn.functional as F
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "Maestro", "server"))
+from batching import MicroBatcher  # noqa: E402
+
+
+class RecordingForward:
+    """ doubles the inputs and records every batch it is called with """
+
+    def __init__(self, block=False) -> None:
+        self.calls = []
+        self.release = threading.Event()
+        if not block:
+            self.release.set()
+
+    def __call__(self, batch_input, labels, tenant):
+        self.calls.append((np.array(batch_input), labels, tenant))
+        self.release.wait()
+        return torch.as_tensor(batch_input) * 2
+
+
+def _submit(batcher, batch_input, labels=None, tenant=None):
+    result = {}
+
+    def run():
+        try:
+            result["outputs"] = batcher.get_batch_output(batch_input, labels, tenant)
+        except Exception as e:
+            result["error"] = e
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread, result
+
+
+def _wait_for_queued(batcher, count):
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        with batcher._condition:
+            if sum(len(queue) for queue in batcher._queues.values()) == count:
+                return
+        time.sleep(0.001)
+    raise AssertionError("requests were not queued")
+
+
+def test_single_request():
+    forward = RecordingForward()
+    batcher = MicroBatcher(forward, max_wait=0.001)
+    x = np.ones((2, 3), dtype=np.float32)
+    outputs = batcher.get_batch_output(x, None)
+    np.testing.assert_array_equal(outputs.numpy(), x * 2)
+    assert len(forward.calls) == 1
+
+
+def test_large_request_skips_the_queue():
+    forward = RecordingForward()
+    batcher = MicroBatcher(forward, max_batch_size=2)
+    x = np.ones((4, 3), dtype=np.float32)
+    batcher.get_batch_output(x, None, tenant="a")
+    assert forward.calls[0][0].shape == (4, 3)
+    assert forward.calls[0][2] == "a"
+
+
+def test_concurrent_requests_are_merged_and_scattered():
+    forward = RecordingForward()
+    batcher = MicroBatcher(forward, max_batch_size=64, max_wait=0.5)
+    inputs = [np.full((i + 1, 2), i, dtype=np.float32) for i in range(3)]
+    submitted = [_submit(batcher, x) for x in inputs]
+    for thread, _ in submitted:
+        thread.join(5)
+    assert len(forward.calls) == 1
+    assert forward.calls[0][0].shape == (6, 2)
+    for x, (_, result) in zip(inputs, submitted):
+        np.testing.assert_array_equal(result["outputs"].numpy(), x * 2)
+
+
+def test_different_shapes_are_not_merged():
+    forward = RecordingForward()
+    batcher = MicroBatcher(forward, max_wait=0.5)
+    submitted = [
+        _submit(batcher, np.zeros((1, 2), dtype=np.float32)),
+        _submit(batcher, np.zeros((1, 3), dtype=np.float32)),
+    ]
+    for thread, result in submitted:
+        thread.join(5)
+        assert "error" not in result
+    assert sorted(call[0].shape for call in forward.calls) == [(1, 2), (1, 3)]
+
+
+def test_token_ids_are_padded_and_loss_recomputed():
+    calls = []
+
+    def forward(batch_input, labels, tenant):
+        calls.append(np.array(batch_input))
+        logits = torch.as_tensor(batch_input, dtype=torch.float32)[:, :2]
+        labels = torch.as_tensor(labels)
+        return F.cross_entropy(logits, labels), logits
+
+    batcher = MicroBatcher(forward, pad_token_id=0, max_wait=0.5)
+    short = np.array([[101, 5, 102]], dtype=np.int64)
+    long = np.array([[101, 7, 8, 102], [101, 9, 10, 102]], dtype=np.int64)
+    submitted = [_submit(batcher, short, [1]), _submit(batcher, long, [0, 1])]
+    for thread, _ in submitted:
+        thread.join(5)
+    assert len(calls) == 1
+    np.testing.assert_array_equal(calls[0][0], [101, 5, 102, 0])
+    for x, labels, (_, result) in zip([short, long], [[1], [0, 1]], submitted):
+        loss, logits = result["outputs"]
+        expected = torch.as_tensor(x[:, :2], dtype=torch.float32)
+        torch.testing.assert_close(logits, expected)
+        torch.testing.assert_close(loss, F.cross_entropy(expected, torch.as_tensor(labels)))
+
+
+def test_errors_reach_every_caller():
+    def forward(batch_input, labels, tenant):
+        raise ValueError("broken model")
+
+    batcher = MicroBatcher(forward, max_wait=0.5)
+    submitted = [_submit(batcher, np.zeros((1, 2), dtype=np.float32)) for _ in range(2)]
+    for thread, result in submitted:
+        thread.join(5)
+        assert isinstance(result["error"], ValueError)
+
+
+def test_tenants_share_batches_round_robin():
+    forward = RecordingForward(block=True)
+    batcher = MicroBatcher(forward, max_batch_size=2, max_wait=0.001)
+    # occupies the worker while the other requests queue up
+    submitted = [_submit(batcher, np.full((1, 1), -1, dtype=np.float32), tenant="a")]
+    while not forward.calls:
+        time.sleep(0.001)
+    for i in range(3):
+        submitted.append(_submit(batcher, np.full((1, 1), i, dtype=np.float32), tenant="a"))
+        _wait_for_queued(batcher, i + 1)
+    submitted.append(_submit(batcher, np.full((1, 1), 10, dtype=np.float32), tenant="b"))
+    _wait_for_queued(batcher, 4)
+    forward.release.set()
+    for thread, result in submitted:
+        thread.join(5)
+        assert "error" not in result
+    # a's backlog does not keep b out of the next batch
+    assert forward.calls[1][0].ravel().tolist() == [0, 10]
+    assert forward.calls[1][2] == "a"
+    assert [call[0].ravel().tolist() for call in forward.calls[2:]] == [[1, 2]]
+
+
+@pytest.mark.parametrize("labels", [None, ["not", "numeric"]])
+def test_non_numeric_labels_pass_through(labels):
+    forward = RecordingForward()
+    batcher = MicroBatcher(forward, max_wait=0.001)
+    batcher.get_batch_output(np.zeros((2, 2), dtype=np.float32), labels)
+    assert forward.calls[0][1] == labels
@@ -0,0 +1,106 @@
+import importlib.util
+import os
+
+import numpy as np
+import pytest
+import torch
+
+pytest.importorskip("transformers")
+
+
+def _load_bucketing():
+    # by path: Maestro.pipeline's __init__ pulls in the whole pipeline stack
+    path = os.path.join(os.path.dirname(__file__), "..", "Maestro", "pipeline", "bucketing.py")
+    spec = importlib.util.spec_from_file_location("bucketing", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+bucketing = _load_bucketing()
+
+
+def _example(length, max_length=16):
+    input_ids = torch.zeros(max_length, dtype=torch.long)
+    input_ids[:length] = torch.arange(1, length + 1)
+    return {
+        "input_ids": input_ids,
+        "attention_mask": (input_ids != 0).long(),
+        "labels": torch.tensor(length % 2),
+    }
+
+
+def test_round_up():
+    assert bucketing.round_up(5, 8) == 8
+    assert bucketing.round_up(16, 8) == 16
+    assert bucketing.round_up(5, 0) == 5
+
+
+def test_sequence_lengths():
+    examples = [_example(3), _example(7)]
+    assert bucketing.sequence_lengths(examples).tolist() == [3, 7]
+
+
+def test_sampler_yields_every_example_once():
+    lengths = np.random.RandomState(0).randint(1, 100, size=103)
+    sampler = bucketing.LengthBucketSampler(lengths, batch_size=8, bucket_size_multiplier=4)
+    batches = list(sampler)
+    assert len(batches) == len(sampler) == 13
+    assert sorted(index for batch in batches for index in batch) == list(range(103))
+
+
+def test_sampler_groups_similar_lengths():
+    lengths = np.random.RandomState(0).randint(1, 100, size=400)
+    sampler = bucketing.LengthBucketSampler(lengths, batch_size=8, bucket_size_multiplier=50)
+    padded = sum(len(batch) * lengths[batch].max() for batch in sampler)
+    # a single pool: every batch is a run of the sorted lengths
+    assert padded < 1.1 * lengths.sum()
+
+
+def test_sampler_shuffles_every_epoch_and_is_seeded():
+    lengths = np.arange(64)
+    sampler = bucketing.LengthBucketSampler(lengths, batch_size=4, bucket_size_multiplier=2)
+    first, second = list(sampler), list(sampler)
+    assert first != second
+    again = bucketing.LengthBucketSampler(lengths, batch_size=4, bucket_size_multiplier=2)
+    assert list(again) == first
+
+
+def test_sampler_without_shuffle_is_sorted():
+    lengths = [5, 1, 4, 2, 3]
+    sampler = bucketing.LengthBucketSampler(lengths, batch_size=2, shuffle=False)
+    assert list(sampler) == [[1, 3], [4, 2], [0]]
+
+
+def test_sampler_drop_last():
+    sampler = bucketing.LengthBucketSampler(np.arange(10), batch_size=4, drop_last=True)
+    batches = list(sampler)
+    assert len(batches) == len(sampler) == 2
+    assert all(len(batch) == 4 for batch in batches)
+
+
+def test_dynamic_padding_collator_trims_to_the_longest_example():
+    batch = bucketing.dynamic_padding_collator([_example(3), _example(5)], pad_to_multiple_of=4)
+    assert batch["input_ids"].shape == (2, 8)
+    assert batch["attention_mask"].shape == (2, 8)
+    assert batch["input_ids"][1, :5].tolist() == [1, 2, 3, 4, 5]
+    assert batch["labels"].tolist() == [1, 1]
+
+
+def test_dynamic_padding_collator_never_grows_the_batch():
+    batch = bucketing.dynamic_padding_collator([_example(15)], pad_to_multiple_of=8)
+    assert batch["input_ids"].shape == (1, 16)
+
+
+def test_trainer_keeps_the_order_of_evaluation_and_prediction(tmp_path):
+    from transformers import TrainingArguments
+
+    examples = [_example(length) for length in (9, 2, 14, 5, 1, 11, 3)]
+    trainer = bucketing.BucketedTrainer(
+        model=torch.nn.Linear(1, 1),
+        args=TrainingArguments(output_dir=str(tmp_path), per_device_eval_batch_size=2),
+        data_collator=bucketing.dynamic_padding_collator,
+    )
+    for loader in (trainer.get_eval_dataloader(examples), trainer.get_test_dataloader(examples)):
+        lengths = [int(length) for batch in loader for length in batch["attention_mask"].sum(1)]
+        assert lengths == [9, 2, 14, 5, 1, 11, 3]
@@ -0,0 +1,177 @@
+import os
+import pickle
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "Maestro", "server"))
+import budgets  # noqa: E402
+from budgets import BudgetLedger, QueryBudgetExceeded, SharedBudgetLedger, TokenBucket  # noqa: E402
+
+
+class Budget:
+    """ the parts of pipeline.QueryBudget the ledger uses """
+
+    def __init__(self, forward_queries=None, gradient_queries=None, examples=None, rate=None, burst=None):
+        self.forward_queries = forward_queries
+        self.gradient_queries = gradient_queries
+        self.examples = examples
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+
+    def limits(self):
+        return {
+            "forward_queries": self.forward_queries,
+            "gradient_queries": self.gradient_queries,
+            "examples": self.examples,
+        }
+
+
+class Clock:
+    def __init__(self) -> None:
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(budgets.time, "monotonic", clock)
+    return clock
+
+
+def test_token_bucket_starts_full(clock):
+    bucket = TokenBucket(rate=2, burst=4)
+    assert bucket.wait_time(4) == 0
+    bucket.take(4)
+    assert bucket.wait_time(1) == pytest.approx(0.5)
+
+
+def test_token_bucket_refills_up_to_burst(clock):
+    bucket = TokenBucket(rate=2, burst=4)
+    bucket.take(4)
+    clock.now += 1
+    assert bucket.wait_time(2) == 0
+    clock.now += 100
+    assert bucket.wait_time(4) == 0
+    assert bucket.tokens == 4
+
+
+def test_token_bucket_charges_the_full_cost(clock):
+    bucket = TokenBucket(rate=1, burst=4)
+    bucket.take(3)
+    assert bucket.wait_time(3) == pytest.approx(2)
+    # more than the bucket holds is never available
+    assert bucket.wait_time(5) == float("inf")
+
+
+def test_ledger_charges_and_reports():
+    ledger = BudgetLedger()
+    budget = Budget(forward_queries=3, examples=10)
+    status = ledger.charge("alice", "app", budget, forward_queries=2, examples=4)
+    assert status["forward_queries"] == {"used": 2, "limit": 3, "remaining": 1}
+    assert status["examples"] == {"used": 4, "limit": 10, "remaining": 6}
+    assert status["gradient_queries"] == {"used": 0, "limit": None, "remaining": None}
+    assert ledger.status("alice", "app", budget) == status
+
+
+def test_ledger_refuses_without_charging():
+    ledger = BudgetLedger()
+    budget = Budget(forward_queries=3)
+    ledger.charge("alice", "app", budget, forward_queries=2)
+    with pytest.raises(QueryBudgetExceeded) as error:
+        ledger.charge("alice", "app", budget, forward_queries=2)
+    assert error.value.retry_after is None
+    assert error.value.status["forward_queries"]["used"] == 2
+    # what is left can still be spent
+    ledger.charge("alice", "app", budget, forward_queries=1)
+
+
+def test_ledger_keeps_attackers_and_applications_apart():
+    ledger = BudgetLedger()
+    budget = Budget(forward_queries=1)
+    ledger.charge("alice", "app", budget, forward_queries=1)
+    ledger.charge("bob", "app", budget, forward_queries=1)
+    ledger.charge("alice", "other", budget, forward_queries=1)
+    with pytest.raises(QueryBudgetExceeded):
+        ledger.charge("alice", "app", budget, forward_queries=1)
+
+
+def test_ledger_without_budget_only_counts():
+    ledger = BudgetLedger()
+    status = ledger.charge("alice", "app", None, forward_queries=1000)
+    assert status["forward_queries"] == {"used": 1000, "limit": None, "remaining": None}
+
+
+def test_ledger_rate_limit(clock):
+    ledger = BudgetLedger()
+    budget = Budget(rate=1, burst=2)
+    ledger.charge("alice", "app", budget, forward_queries=1, gradient_queries=1)
+    with pytest.raises(QueryBudgetExceeded) as error:
+        ledger.charge("alice", "app", budget, forward_queries=1)
+    assert error.value.retry_after == pytest.approx(1)
+    assert ledger.status("alice", "app", budget)["forward_queries"]["used"] == 1
+    clock.now += 1
+    ledger.charge("alice", "app", budget, forward_queries=1)
+
+
+def test_ledger_rate_limit_charges_every_model_call(clock):
+    ledger = BudgetLedger()
+    budget = Budget(rate=1, burst=10)
+    ledger.charge("alice", "app", budget, gradient_queries=10)
+    with pytest.raises(QueryBudgetExceeded) as error:
+        ledger.charge("alice", "app", budget, gradient_queries=1)
+    assert error.value.retry_after == pytest.approx(1)
+
+
+def test_ledger_rejects_queries_larger_than_burst(clock):
+    ledger = BudgetLedger()
+    budget = Budget(rate=1, burst=10)
+    with pytest.raises(ValueError):
+        ledger.charge("alice", "app", budget, gradient_queries=100)
+    assert ledger.status("alice", "app", budget)["gradient_queries"]["used"] == 0
+    ledger.charge("alice", "app", budget, gradient_queries=10)
+
+
+def test_ledger_reset():
+    ledger = BudgetLedger()
+    budget = Budget(forward_queries=1)
+    ledger.charge("alice", "app", budget, forward_queries=1)
+    ledger.charge("bob", "app", budget, forward_queries=1)
+    ledger.reset("alice")
+    ledger.charge("alice", "app", budget, forward_queries=1)
+    with pytest.raises(QueryBudgetExceeded):
+        ledger.charge("bob", "app", budget, forward_queries=1)
+    ledger.reset()
+    assert ledger.status("bob", "app", budget)["forward_queries"]["used"] == 0
+
+
+def test_budget_exceeded_pickles():
+    error = pickle.loads(pickle.dumps(QueryBudgetExceeded("over", {"examples": {}}, 1.5)))
+    assert str(error) == "over"
+    assert error.status == {"examples": {}}
+    assert error.retry_after == 1.5
+
+
+def test_shared_ledger_is_shared_across_processes():
+    ledger = SharedBudgetLedger()
+    try:
+        budget = Budget(forward_queries=3)
+        ledger.charge("alice", "app", budget, forward_queries=1)
+        pid = os.fork()
+        if pid == 0:
+            try:
+                ledger.charge("alice", "app", budget, forward_queries=1)
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+        assert ledger.status("alice", "app", budget)["forward_queries"]["used"] == 2
+        ledger.charge("alice", "app", budget, forward_queries=1)
+        with pytest.raises(QueryBudgetExceeded):
+            ledger.charge("alice", "app", budget, forward_queries=1)
+        ledger.reset()
+        assert ledger.status("alice", "app", budget)["forward_queries"]["used"] == 0
+    finally:
+        ledger.shutdown()
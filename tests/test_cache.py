@@ -0,0 +1,81 @@
+import numpy as np
+
+from Maestro.utils.cache import ResponseCache, cache_key
+from Maestro.utils.tracing import metrics
+
+
+def test_cache_key_is_stable():
+    x = np.arange(4, dtype=np.float32)
+    assert cache_key("app", x, None) == cache_key("app", x.copy(), None)
+
+
+def test_cache_key_tells_parts_apart():
+    x = np.arange(4, dtype=np.float32)
+    keys = {
+        cache_key("app", x),
+        cache_key("app", x.astype(np.float64)),
+        cache_key("app", x.reshape(2, 2)),
+        cache_key("app", x, None),
+        cache_key(b"app", x),
+        cache_key("other", x),
+    }
+    assert len(keys) == 6
+    # parts are length prefixed, moving bytes between them changes the key
+    assert cache_key("ab", "c") != cache_key("a", "bc")
+
+
+def test_get_put_and_stats():
+    cache = ResponseCache(max_bytes=100)
+    assert cache.get("a") is None
+    cache.put("a", b"value", size=5)
+    assert cache.get("a") == b"value"
+    assert cache.stats() == {"entries": 1, "bytes": 5, "max_bytes": 100, "hits": 1, "misses": 1}
+
+
+def test_evicts_least_recently_used():
+    cache = ResponseCache(max_bytes=10)
+    cache.put("a", "a", size=4)
+    cache.put("b", "b", size=4)
+    # a is now the most recently used
+    cache.get("a")
+    cache.put("c", "c", size=4)
+    assert cache.get("b") is None
+    assert cache.get("a") == "a"
+    assert cache.get("c") == "c"
+    assert cache.stats()["bytes"] == 8
+
+
+def test_replacing_an_entry_updates_its_size():
+    cache = ResponseCache(max_bytes=10)
+    cache.put("a", "small", size=2)
+    cache.put("a", "large", size=8)
+    assert cache.stats()["bytes"] == 8
+    assert cache.get("a") == "large"
+
+
+def test_values_larger_than_the_cache_are_not_cached():
+    cache = ResponseCache(max_bytes=10)
+    cache.put("a", "a", size=4)
+    cache.put("huge", "huge", size=11)
+    assert cache.get("huge") is None
+    assert cache.get("a") == "a"
+
+
+def test_clear():
+    cache = ResponseCache(max_bytes=10)
+    cache.put("a", "a", size=4)
+    cache.clear()
+    assert cache.get("a") is None
+    assert cache.stats()["bytes"] == 0
+
+
+def test_named_cache_counts_in_metrics():
+    metrics.reset()
+    cache = ResponseCache(max_bytes=10, name="test_cache")
+    cache.get("a")
+    cache.put("a", "a", size=1)
+    cache.get("a")
+    cache.get("a")
+    counters = metrics.snapshot()["counters"]
+    assert counters["test_cache_misses"] == 1
+    assert counters["test_cache_hits"] == 2
@@ -0,0 +1,279 @@
+import importlib.util
+import os
+
+import numpy as np
+import torch
+
+from Maestro.utils.token_cache import TokenizedDataset
+
+
+def _load_checkpoint_module():
+    # by path: Maestro.pipeline's __init__ pulls in the whole pipeline stack
+    path = os.path.join(os.path.dirname(__file__), "..", "Maestro", "pipeline", "checkpoint.py")
+    spec = importlib.util.spec_from_file_location("checkpoint", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+checkpoint = _load_checkpoint_module()
+CheckpointManifest = checkpoint.CheckpointManifest
+
+
+class Examples:
+    """ a dataset only readable example by example """
+
+    def __init__(self, examples, split="train") -> None:
+        self.examples = examples
+        self.split = split
+
+    def __len__(self):
+        return len(self.examples)
+
+    def __getitem__(self, index):
+        return self.examples[index]
+
+
+class ArrayDataset(Examples):
+    """ torchvision style: the whole split in data/targets """
+
+    def __init__(self, data, targets) -> None:
+        super(ArrayDataset, self).__init__(None)
+        self.data = data
+        self.targets = targets
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, index):
+        raise AssertionError("bulk arrays are hashed without reading examples")
+
+
+class Wrapper(Examples):
+    """ textattack style wrapper of a huggingface dataset """
+
+    def __init__(self, fingerprint, size) -> None:
+        super(Wrapper, self).__init__(None)
+        self._dataset = type("Dataset", (), {"_fingerprint": fingerprint})()
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+
+class ImageFolder(Examples):
+    """ torchvision style: (path, class) of every image file under root """
+
+    def __init__(self, root) -> None:
+        super(ImageFolder, self).__init__(None)
+        self.root = root
+        self.samples = []
+        for family in sorted(os.listdir(root)):
+            for name in sorted(os.listdir(os.path.join(root, family))):
+                self.samples.append((os.path.join(root, family, name), int(family)))
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getitem__(self, index):
+        raise AssertionError("image files are hashed without reading them")
+
+
+class Subset(Examples):
+    def __init__(self, dataset, indices) -> None:
+        super(Subset, self).__init__(None)
+        self.dataset = dataset
+        self.indices = indices
+
+    def __len__(self):
+        return len(self.indices)
+
+
+def _image_folder(root):
+    for family in range(2):
+        os.makedirs(os.path.join(root, str(family)))
+        for image in range(3):
+            with open(os.path.join(root, str(family), "{}.png".format(image)), "wb") as f:
+                f.write(bytes([family, image]))
+    return root
+
+
+def _examples():
+    return [{"input_ids": torch.tensor([101, i, 102]), "label": i % 2} for i in range(4)]
+
+
+def test_data_hash_reads_the_content():
+    examples = _examples()
+    reference = checkpoint.data_hash(Examples(examples))
+    assert checkpoint.data_hash(Examples(_examples())) == reference
+    examples[2]["input_ids"][1] = 7
+    assert checkpoint.data_hash(Examples(examples)) != reference
+    assert checkpoint.data_hash(Examples(_examples(), split="test")) != reference
+
+
+def test_data_hash_includes_types_and_shapes():
+    as_int = Examples([{"x": np.zeros(4, dtype=np.int32)}])
+    as_float = Examples([{"x": np.zeros(4, dtype=np.float32)}])
+    reshaped = Examples([{"x": np.zeros((2, 2), dtype=np.int32)}])
+    hashes = {checkpoint.data_hash(dataset) for dataset in (as_int, as_float, reshaped)}
+    assert len(hashes) == 3
+
+
+def test_data_hash_of_tokenized_columns(tmp_path):
+    dataset = TokenizedDataset.write(str(tmp_path / "split"), _examples())
+    changed = _examples()
+    changed[0]["label"] = 1
+    other = TokenizedDataset.write(str(tmp_path / "other"), changed)
+    assert checkpoint.data_hash(dataset) != checkpoint.data_hash(other)
+    reopened = TokenizedDataset(str(tmp_path / "split"))
+    assert checkpoint.data_hash(dataset) == checkpoint.data_hash(reopened)
+
+
+def test_data_hash_of_bulk_arrays():
+    data = np.arange(24, dtype=np.uint8).reshape(2, 3, 4)
+    reference = checkpoint.data_hash(ArrayDataset(data, torch.tensor([0, 1])))
+    assert checkpoint.data_hash(ArrayDataset(data.copy(), torch.tensor([0, 1]))) == reference
+    assert checkpoint.data_hash(ArrayDataset(data, torch.tensor([1, 1]))) != reference
+
+
+def test_data_hash_of_huggingface_fingerprints():
+    reference = checkpoint.data_hash(Wrapper("abc", 10))
+    assert checkpoint.data_hash(Wrapper("abc", 10)) == reference
+    assert checkpoint.data_hash(Wrapper("abd", 10)) != reference
+
+
+def test_data_hash_of_image_files(tmp_path):
+    root = _image_folder(str(tmp_path / "images"))
+    reference = checkpoint.data_hash(ImageFolder(root))
+    # the same files moved elsewhere
+    os.rename(root, str(tmp_path / "moved"))
+    root = str(tmp_path / "moved")
+    assert checkpoint.data_hash(ImageFolder(root)) == reference
+    with open(os.path.join(root, "1", "2.png"), "wb") as f:
+        f.write(b"retaken")
+    assert checkpoint.data_hash(ImageFolder(root)) != reference
+
+
+def test_data_hash_of_image_file_subsets(tmp_path):
+    dataset = ImageFolder(_image_folder(str(tmp_path / "images")))
+    reference = checkpoint.data_hash(Subset(dataset, [0, 2, 4]))
+    assert checkpoint.data_hash(Subset(dataset, [0, 2, 4])) == reference
+    assert checkpoint.data_hash(Subset(dataset, [0, 2, 5])) != reference
+
+
+def test_data_hash_covers_every_split():
+    train, test = Examples(_examples()), Examples(_examples(), split="test")
+    assert checkpoint.data_hash(train, test) != checkpoint.data_hash(train)
+    assert checkpoint.data_hash(train, test) != checkpoint.data_hash(test, train)
+
+
+def test_weight_files(tmp_path):
+    weights = tmp_path / "model.pt"
+    weights.write_bytes(b"weights")
+    assert checkpoint.weight_files(str(weights)) == [str(weights)]
+    pretrained = tmp_path / "pretrained"
+    pretrained.mkdir()
+    (pretrained / "config.json").write_text("{}")
+    # a config without weights is not a checkpoint
+    assert checkpoint.weight_files(str(pretrained)) == []
+    (pretrained / "pytorch_model.bin").write_bytes(b"weights")
+    assert [os.path.basename(name) for name in checkpoint.weight_files(str(pretrained))] == [
+        "config.json",
+        "pytorch_model.bin",
+    ]
+    assert checkpoint.weight_files(str(tmp_path / "missing")) == []
+
+
+def test_weights_hash(tmp_path):
+    weights = tmp_path / "model.pt"
+    assert checkpoint.weights_hash(str(weights)) is None
+    weights.write_bytes(b"weights")
+    reference = checkpoint.weights_hash(str(weights))
+    assert checkpoint.weights_hash(str(weights)) == reference
+    weights.write_bytes(b"retrained")
+    assert checkpoint.weights_hash(str(weights)) != reference
+
+
+def test_latest_trainer_checkpoint(tmp_path):
+    assert checkpoint.latest_trainer_checkpoint(str(tmp_path)) is None
+    for step in (500, 1500, 1000):
+        (tmp_path / "checkpoint-{}".format(step)).mkdir()
+    (tmp_path / "checkpoint-2000.tmp").mkdir()
+    latest = checkpoint.latest_trainer_checkpoint(str(tmp_path))
+    assert latest == str(tmp_path / "checkpoint-1500")
+
+
+def _manifest(**hyperparameters):
+    hyperparameters = hyperparameters or {"epochs": 3, "learning_rate": 5e-5}
+    return CheckpointManifest("bert-base-uncased", "sst2", hyperparameters, data_hash="abc")
+
+
+def test_manifest_paths(tmp_path):
+    assert CheckpointManifest.path(str(tmp_path)) == str(tmp_path / "maestro_manifest.json")
+    assert CheckpointManifest.path(str(tmp_path / "model.pt")) == str(
+        tmp_path / "model.pt.manifest.json"
+    )
+
+
+def test_manifest_round_trip(tmp_path):
+    weights = tmp_path / "model.pt"
+    assert CheckpointManifest.load(str(weights)) is None
+    manifest = _manifest(layers=(1, 2))
+    manifest.save(str(weights))
+    loaded = CheckpointManifest.load(str(weights))
+    assert vars(loaded) == dict(vars(manifest), hyperparameters={"layers": [1, 2]})
+    assert loaded.same_training(manifest)
+
+
+def test_same_training():
+    manifest = _manifest()
+    assert manifest.same_training(_manifest())
+    assert not manifest.same_training(_manifest(epochs=4))
+    other_data = _manifest()
+    other_data.data_hash = "abd"
+    assert not manifest.same_training(other_data)
+
+
+def test_action_trains_without_weights(tmp_path):
+    assert _manifest().action(str(tmp_path / "model.pt")) == checkpoint.TRAIN
+
+
+def test_action_adopts_unversioned_weights(tmp_path):
+    weights = tmp_path / "model.pt"
+    weights.write_bytes(b"weights")
+    assert _manifest().action(str(weights)) == checkpoint.REUSE
+    assert CheckpointManifest.load(str(weights)).weights_hash == checkpoint.weights_hash(
+        str(weights)
+    )
+
+
+def test_action_reuses_recorded_weights(tmp_path):
+    weights = tmp_path / "model.pt"
+    weights.write_bytes(b"weights")
+    _manifest().record_weights(str(weights))
+    assert _manifest().action(str(weights)) == checkpoint.REUSE
+    # touched but unchanged weights are still reused
+    os.utime(str(weights), ns=(0, 0))
+    assert _manifest().action(str(weights)) == checkpoint.REUSE
+    assert CheckpointManifest.load(str(weights)).weights_stat == [len(b"weights"), 0]
+
+
+def test_action_retrains_other_configurations_and_changed_weights(tmp_path):
+    weights = tmp_path / "model.pt"
+    weights.write_bytes(b"weights")
+    _manifest().record_weights(str(weights))
+    assert _manifest(epochs=10).action(str(weights)) == checkpoint.TRAIN
+    weights.write_bytes(b"tampered")
+    assert _manifest().action(str(weights)) == checkpoint.TRAIN
+
+
+def test_action_resumes_interrupted_runs(tmp_path):
+    weights = tmp_path / "model.pt"
+    output_dir = tmp_path / "output"
+    output_dir.mkdir()
+    # saved when training started, weights are recorded once it finishes
+    _manifest().save(str(weights))
+    assert _manifest().action(str(weights), str(output_dir)) == checkpoint.TRAIN
+    (output_dir / "checkpoint-100").mkdir()
+    assert _manifest().action(str(weights), str(output_dir)) == checkpoint.RESUME
+    assert _manifest(epochs=10).action(str(weights), str(output_dir)) == checkpoint.TRAIN
@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+import torch
+
+from Maestro.constraints import Epsilon, Flipped
+
+
+def _batches():
+    rng = np.random.RandomState(0)
+    original = rng.rand(4, 3, 5, 5).astype(np.float32)
+    perturbed = original + rng.uniform(-0.1, 0.1, original.shape).astype(np.float32)
+    return original, perturbed
+
+
+@pytest.mark.parametrize("distance,order", [("l1", np.inf), ("linf", np.inf), ("l2", 2)])
+def test_epsilon_distances_match_per_example_norms(distance, order):
+    original, perturbed = _batches()
+    expected = [np.linalg.norm((p - o).ravel(), ord=order) for o, p in zip(original, perturbed)]
+    constraint = Epsilon(0.1, distance)
+    np.testing.assert_allclose(constraint.distances(original, perturbed), expected, rtol=1e-5)
+    np.testing.assert_allclose(
+        constraint.distances(torch.as_tensor(original), torch.as_tensor(perturbed)).numpy(),
+        expected,
+        rtol=1e-5,
+    )
+
+
+def test_epsilon_default_bounds_every_pixel():
+    constraint = Epsilon(0.1)
+    assert constraint.distance == "l1"
+    original = np.zeros((2, 100), dtype=np.float32)
+    # many small changes stay within the ball, one large one does not
+    perturbed = np.full((2, 100), 0.05, dtype=np.float32)
+    perturbed[1, 0] = -0.2
+    assert constraint.violations(original, perturbed).tolist() == [False, True]
+
+
+def test_epsilon_violations():
+    original = np.zeros((3, 4), dtype=np.float32)
+    perturbed = original.copy()
+    perturbed[1, 0] = 0.5
+    perturbed[2, 0] = 0.1
+    constraint = Epsilon(0.1)
+    assert constraint.violations(original, perturbed).tolist() == [False, True, False]
+    violations, distances = constraint.check(original, perturbed)
+    assert violations.tolist() == [False, True, False]
+    np.testing.assert_allclose(distances, [0, 0.5, 0.1])
+    assert constraint.violate(original, perturbed)
+    assert not constraint.violate(original, original)
+
+
+def test_epsilon_mixes_arrays_and_tensors():
+    original, perturbed = _batches()
+    constraint = Epsilon(0.05, "l2")
+    expected = constraint.violations(original, perturbed)
+    mixed = constraint.violations(original, torch.as_tensor(perturbed))
+    assert isinstance(mixed, torch.Tensor)
+    assert mixed.tolist() == expected.tolist()
+
+
+def test_epsilon_single_example_is_a_batch_of_one():
+    assert Epsilon(0.1).violations(np.zeros(5), np.full(5, 0.2)).tolist() == [True]
+
+
+def test_epsilon_unknown_distance():
+    with pytest.raises(ValueError):
+        Epsilon(0.1, "l3")
+
+
+def test_flipped_counts_flips_per_example():
+    original = np.array([[101, 5, 6, 102], [101, 7, 8, 102]])
+    perturbed = np.array([[101, 9, 6, 102], [101, 1, 2, 102]])
+    constraint = Flipped("word", 1)
+    assert constraint.distances(original, perturbed).tolist() == [1, 2]
+    violations, distances = constraint.check(torch.as_tensor(original), perturbed)
+    assert violations.tolist() == [False, True]
+    assert distances.tolist() == [1, 2]
+    assert constraint.violate(original, perturbed)
+    assert not Flipped("word", 2).violate(original, perturbed)
@@ -0,0 +1,157 @@
+import importlib.util
+import os
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from Maestro.constraints import Epsilon
+
+
+def _load_evaluator_module(name):
+    # by path: Maestro.evaluator's __init__ pulls in the sklearn based evaluators
+    path = os.path.join(os.path.dirname(__file__), "..", "Maestro", "evaluator", name + ".py")
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+Evaluator = _load_evaluator_module("Evaluator").Evaluator
+runner = _load_evaluator_module("EvaluationRunner")
+
+
+class ShufflingLoader:
+    """ a dataloader yielding its batches in a new order every epoch """
+
+    def __init__(self, batches) -> None:
+        self.batches = batches
+        self.epoch = 0
+
+    def __iter__(self):
+        self.epoch += 1
+        return iter(np.random.RandomState(self.epoch).permutation(self.batches).tolist())
+
+
+class Attacker:
+    """ perturbs every example by step, flipping those of an odd batch """
+
+    def __init__(self, step) -> None:
+        self.step = step
+
+
+class BatchEvaluator(Evaluator):
+    def evaluate_batch(self, batch):
+        self.vm.query()
+        original = np.zeros((2, 3), dtype=np.float32)
+        perturbed = original + self.attacker.step
+        violations, distances = self.constraint.check(original, perturbed)
+        return {
+            "examples": 2,
+            "flipped": 2 * (batch % 2),
+            "violations": int(violations.sum()),
+            "distances": distances,
+        }
+
+
+class VirtualModel:
+    """ counts the queries in flight, each query takes a while """
+
+    def __init__(self, latency=0.0) -> None:
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.most_in_flight = 0
+
+    def query(self):
+        with self.lock:
+            self.in_flight += 1
+            self.most_in_flight = max(self.most_in_flight, self.in_flight)
+        time.sleep(self.latency)
+        with self.lock:
+            self.in_flight -= 1
+
+
+def test_constraint_grid():
+    grid = runner.constraint_grid(Epsilon, epsilon=[0.1, 0.2], distance=["l1", "l2"])
+    assert [runner.constraint_params(c) for c in grid] == [
+        {"epsilon": 0.1, "distance": "l1"},
+        {"epsilon": 0.1, "distance": "l2"},
+        {"epsilon": 0.2, "distance": "l1"},
+        {"epsilon": 0.2, "distance": "l2"},
+    ]
+    assert runner.constraint_params(3) == {"constraint": 3}
+
+
+def test_aggregate():
+    results = [
+        {"examples": 2, "flipped": 1, "violations": 0, "distances": np.array([0.1, 0.2])},
+        {"examples": 3, "flipped": 3, "violations": 2, "distances": np.array([0.4, 0.0, 0.3])},
+    ]
+    aggregated = Evaluator.aggregate(results)
+    assert aggregated["examples"] == 5
+    assert aggregated["flip_rate"] == pytest.approx(0.8)
+    assert aggregated["constraint_violations"] == 2
+    assert aggregated["mean_distance"] == pytest.approx(0.2)
+    assert aggregated["max_distance"] == pytest.approx(0.4)
+
+
+def test_aggregate_without_examples_or_distances():
+    assert Evaluator.aggregate([]) == {
+        "examples": 0,
+        "flip_rate": 0.0,
+        "constraint_violations": 0,
+    }
+    empty = {"examples": 0, "flipped": 0, "violations": 0, "distances": np.zeros(0)}
+    aggregated = Evaluator.aggregate([empty])
+    assert aggregated["mean_distance"] == aggregated["max_distance"] == 0.0
+
+
+def test_run_sweeps_every_attacker_and_constraint():
+    loader = ShufflingLoader([0, 1, 2, 3])
+    evaluation = runner.EvaluationRunner(BatchEvaluator, loader, VirtualModel(), workers=4)
+    attackers = {"small": Attacker(0.05), "large": Attacker(0.15)}
+    table = evaluation.run(attackers, runner.constraint_grid(Epsilon, epsilon=[0.1, 0.2]))
+    assert [(row["attacker"], row["epsilon"]) for row in table] == [
+        ("small", 0.1),
+        ("small", 0.2),
+        ("large", 0.1),
+        ("large", 0.2),
+    ]
+    assert [row["constraint_violations"] for row in table] == [0, 0, 8, 0]
+    for row in table:
+        assert row["examples"] == 8
+        assert row["flip_rate"] == pytest.approx(0.5)
+        assert row["seconds"] >= 0
+    # the dataloader is read once, every evaluation attacks the same batches
+    assert loader.epoch == 1
+
+
+def test_run_names_a_single_attacker_after_its_module():
+    attacker = Attacker(0.0)
+    attacker.__name__ = "Submission"
+    evaluation = runner.EvaluationRunner(BatchEvaluator, [0, 1], VirtualModel(), workers=1)
+    (row,) = evaluation.run(attacker, [Epsilon(0.1)])
+    assert row["attacker"] == "Submission"
+    assert row["examples"] == 4
+
+
+def test_run_dispatches_jobs_concurrently():
+    vm = VirtualModel(latency=0.05)
+    evaluation = runner.EvaluationRunner(BatchEvaluator, list(range(8)), vm, workers=4)
+    evaluation.run(Attacker(0.0), [Epsilon(0.1), Epsilon(0.2)])
+    assert vm.most_in_flight == 4
+
+
+def test_format_table():
+    table = [
+        {"attacker": "a", "epsilon": 0.1, "flip_rate": 0.5},
+        {"attacker": "bb", "epsilon": 0.25, "examples": 8},
+    ]
+    assert runner.format_table(table).split("\n") == [
+        "attacker  epsilon  flip_rate  examples",
+        "a         0.1000   0.5000             ",
+        "bb        0.2500              8       ",
+    ]
+    assert runner.format_table([]) == ""
@@ -0,0 +1,120 @@
+import numpy as np
+import pytest
+
+from Maestro.attacker_helper import HotFlipCandidateSearch
+
+VOCAB, DIM = 23, 6
+
+
+def _problem(batch_size=3, length=5, seed=0):
+    rng = np.random.RandomState(seed)
+    embedding = rng.randn(VOCAB, DIM).astype(np.float32)
+    grad = rng.randn(batch_size, length, DIM).astype(np.float32)
+    input_ids = rng.randint(0, VOCAB, size=(batch_size, length))
+    return embedding, grad, input_ids
+
+
+def _reference(embedding, grad, input_ids=None, excluded_ids=(), excluded_positions=None):
+    """ every (position, token) score, computed without chunking """
+    scores = np.einsum("btd,vd->btv", grad, embedding)
+    if input_ids is not None:
+        scores -= np.einsum("btd,btd->bt", grad, embedding[input_ids])[:, :, None]
+        np.put_along_axis(scores, input_ids[:, :, None], -np.inf, axis=2)
+    scores[:, :, list(excluded_ids)] = -np.inf
+    if excluded_positions is not None:
+        scores[excluded_positions] = -np.inf
+    return scores
+
+
+def _check_topk(scores, ids, reference, k):
+    assert scores.shape == ids.shape == reference.shape[:2] + (k,)
+    expected = -np.sort(-reference, axis=2)[:, :, :k]
+    np.testing.assert_allclose(scores, expected, rtol=1e-5)
+    finite = np.isfinite(scores)
+    chosen = np.take_along_axis(reference, ids, axis=2)
+    np.testing.assert_allclose(chosen[finite], scores[finite], rtol=1e-5)
+
+
+@pytest.mark.parametrize("chunk_size", [4, 7, 8192])
+def test_topk_matches_brute_force(chunk_size):
+    embedding, grad, _ = _problem()
+    search = HotFlipCandidateSearch(embedding, chunk_size=chunk_size)
+    scores, ids = search.topk(grad, num_candidates=5)
+    _check_topk(scores, ids, _reference(embedding, grad), 5)
+
+
+def test_topk_lowering_the_loss():
+    embedding, grad, _ = _problem()
+    search = HotFlipCandidateSearch(embedding, chunk_size=4)
+    scores, ids = search.topk(grad, num_candidates=3, increase_loss=False)
+    _check_topk(scores, ids, _reference(embedding, -grad), 3)
+
+
+def test_topk_excludes_ids():
+    embedding, grad, _ = _problem()
+    search = HotFlipCandidateSearch(embedding, chunk_size=4, excluded_ids=[0, 5])
+    scores, ids = search.topk(grad, num_candidates=4, excluded_ids=[9, 22])
+    assert not np.isin(ids, [0, 5, 9, 22]).any()
+    _check_topk(scores, ids, _reference(embedding, grad, excluded_ids=[0, 5, 9, 22]), 4)
+    # per call exclusions do not stick
+    _, ids = search.topk(grad, num_candidates=VOCAB - 2)
+    assert np.isin(ids, [9, 22]).any()
+
+
+def test_topk_scores_the_change_from_the_current_token():
+    embedding, grad, input_ids = _problem()
+    search = HotFlipCandidateSearch(embedding, chunk_size=4)
+    scores, ids = search.topk(grad, num_candidates=3, input_ids=input_ids)
+    # replacing a token with itself is never proposed
+    assert not (ids == input_ids[:, :, None]).any()
+    _check_topk(scores, ids, _reference(embedding, grad, input_ids), 3)
+
+
+def test_topk_excludes_positions():
+    embedding, grad, input_ids = _problem()
+    search = HotFlipCandidateSearch(embedding, chunk_size=4)
+    mask = np.zeros(input_ids.shape, dtype=bool)
+    mask[0, 1] = mask[2, 4] = True
+    scores, ids = search.topk(grad, 2, input_ids=input_ids, excluded_positions=mask)
+    assert np.isneginf(scores[mask]).all()
+    _check_topk(scores, ids, _reference(embedding, grad, input_ids, excluded_positions=mask), 2)
+    # a list of positions applies to the whole batch
+    scores, _ = search.topk(grad, 2, input_ids=input_ids, excluded_positions=[0, 3])
+    assert np.isneginf(scores[:, [0, 3]]).all()
+    assert np.isfinite(scores[:, [1, 2, 4]]).all()
+
+
+def test_topk_of_a_single_input():
+    embedding, grad, input_ids = _problem(batch_size=1)
+    search = HotFlipCandidateSearch(embedding, chunk_size=4)
+    scores, ids = search.topk(grad[0], num_candidates=2, input_ids=input_ids[0])
+    assert scores.shape == ids.shape == (5, 2)
+    batched_scores, batched_ids = search.topk(grad, num_candidates=2, input_ids=input_ids)
+    np.testing.assert_array_equal(ids, batched_ids[0])
+    np.testing.assert_allclose(scores, batched_scores[0])
+
+
+def test_best_flip_is_the_best_over_all_positions():
+    embedding, grad, input_ids = _problem()
+    search = HotFlipCandidateSearch(embedding, chunk_size=4, excluded_ids=[0])
+    excluded = [1]
+    positions, ids, scores = search.best_flip(grad, input_ids, excluded_positions=excluded)
+    reference = _reference(embedding, grad, input_ids, [0])
+    reference[:, excluded] = -np.inf
+    flat = reference.reshape(len(input_ids), -1).argmax(axis=1)
+    np.testing.assert_array_equal(positions, flat // VOCAB)
+    np.testing.assert_array_equal(ids, flat % VOCAB)
+    np.testing.assert_allclose(scores, reference.reshape(len(input_ids), -1).max(axis=1))
+
+
+def test_best_flip_without_any_allowed_flip():
+    embedding, grad, input_ids = _problem()
+    search = HotFlipCandidateSearch(embedding)
+    mask = np.zeros(input_ids.shape, dtype=bool)
+    mask[1] = True
+    positions, ids, scores = search.best_flip(grad, input_ids, excluded_positions=mask)
+    # no bogus flip for the fully excluded example, the others are unaffected
+    assert positions[1] == ids[1] == -1
+    assert np.isneginf(scores[1])
+    assert (positions[[0, 2]] >= 0).all() and (ids[[0, 2]] >= 0).all()
+    assert np.isfinite(scores[[0, 2]]).all()
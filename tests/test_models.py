@@ -0,0 +1,139 @@
+import os
+import sys
+import threading
+import time
+
+import pytest
+import torch.nn as nn
+
+pytest.importorskip("Maestro.pipeline")
+pytest.importorskip("transformers")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "Maestro", "server"))
+import models  # noqa: E402
+from models import ApplicationRegistry, model_memory  # noqa: E402
+
+
+class FakePipeline:
+    device = "cpu"
+
+    def __init__(self, group) -> None:
+        self.group = group
+        # 4 * 100 float32 weights, 4 biases
+        self.model = nn.Linear(100, 4)
+
+
+class Loaders:
+    """ application loaders counting their loads, a group can be held up """
+
+    def __init__(self) -> None:
+        self.loads = {}
+        self.release = {}
+
+    def loader(self, group):
+        self.release[group] = threading.Event()
+        self.release[group].set()
+
+        def load():
+            self.release[group].wait()
+            self.loads[group] = self.loads.get(group, 0) + 1
+            return FakePipeline(group)
+
+        return load
+
+
+@pytest.fixture
+def loaders(monkeypatch):
+    loaders = Loaders()
+    monkeypatch.setattr(
+        models,
+        "APPLICATION_LOADERS",
+        {
+            "Attack": ("Text", loaders.loader("Text")),
+            "Alias": ("Text", loaders.loader("Text")),
+            "Vision": ("Vision", loaders.loader("Vision")),
+            "Malware": ("Malware", loaders.loader("Malware")),
+        },
+    )
+    return loaders
+
+
+def test_unknown_application(loaders):
+    with pytest.raises(KeyError):
+        ApplicationRegistry(["Speech"])
+
+
+def test_loads_lazily_and_once(loaders):
+    registry = ApplicationRegistry(["Vision"])
+    assert loaders.loads == {}
+    pipeline = registry["Vision"]
+    assert registry["Vision"] is pipeline
+    with registry.using("Vision") as used:
+        assert used is pipeline
+    assert loaders.loads == {"Vision": 1}
+
+
+def test_alias_groups_share_a_pipeline(loaders):
+    registry = ApplicationRegistry(["Attack"])
+    # every application of a selected group is served, other groups are not
+    assert sorted(registry) == ["Alias", "Attack"]
+    assert "Vision" not in registry
+    assert registry["Alias"] is registry["Attack"]
+    assert loaders.loads == {"Text": 1}
+
+
+def test_least_recently_used_groups_are_evicted(loaders):
+    budget = model_memory(nn.Linear(100, 4)) * 2
+    registry = ApplicationRegistry(["Attack", "Vision", "Malware"], memory_budget=budget)
+    registry["Attack"]
+    registry["Vision"]
+    registry["Attack"]
+    registry["Malware"]
+    # Vision was the least recently used
+    assert loaders.loads == {"Text": 1, "Vision": 1, "Malware": 1}
+    registry["Attack"]
+    registry["Vision"]
+    assert loaders.loads == {"Text": 1, "Vision": 2, "Malware": 1}
+
+
+def test_pipelines_in_use_are_not_evicted(loaders):
+    budget = model_memory(nn.Linear(100, 4))
+    registry = ApplicationRegistry(["Attack", "Vision"], memory_budget=budget)
+    with registry.using("Attack") as pipeline:
+        registry["Vision"]
+        assert registry["Attack"] is pipeline
+    assert loaders.loads == {"Text": 1, "Vision": 1}
+
+
+def test_loading_does_not_hold_up_other_groups(loaders):
+    registry = ApplicationRegistry(["Attack", "Vision"])
+    registry["Vision"]
+    loaders.release["Text"].clear()
+    loading = threading.Thread(target=registry.__getitem__, args=("Attack",))
+    loading.start()
+    try:
+        started = time.monotonic()
+        with registry.using("Vision"):
+            pass
+        assert time.monotonic() - started < 0.1
+    finally:
+        loaders.release["Text"].set()
+        loading.join(5)
+    assert loaders.loads == {"Text": 1, "Vision": 1}
+
+
+def test_concurrent_requests_load_a_group_once(loaders):
+    registry = ApplicationRegistry(["Attack"])
+    loaders.release["Text"].clear()
+    pipelines = []
+    threads = [
+        threading.Thread(target=lambda name=name: pipelines.append(registry[name]))
+        for name in ("Attack", "Alias", "Attack")
+    ]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.05)
+    loaders.release["Text"].set()
+    for thread in threads:
+        thread.join(5)
+    assert loaders.loads == {"Text": 1}
+    assert len(pipelines) == 3 and all(pipeline is pipelines[0] for pipeline in pipelines)
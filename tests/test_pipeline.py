@@ -0,0 +1,151 @@
+import numpy as np
+import pytest
+import torch
+import torch.nn as nn
+
+pytest.importorskip("Maestro.pipeline")
+pytest.importorskip("transformers")
+from Maestro.pipeline.pipeline import (  # noqa: E402
+    AttackerAccess,
+    IterativeAttackRecipe,
+    Pipeline,
+    Scenario,
+    VisionPipeline,
+)
+
+PAD, CLS, SEP = 0, 101, 102
+
+
+class Tokenizer:
+    """ the ids and vocabulary size _encode_batch reads from a BERT tokenizer """
+
+    pad_token_id, cls_token_id, sep_token_id = PAD, CLS, SEP
+    model_input_names = ["input_ids", "token_type_ids", "attention_mask"]
+
+    def __len__(self):
+        return 1000
+
+
+def _scenario():
+    scenario = Scenario()
+    scenario.attacker_access = AttackerAccess(
+        output_access_level={"output": True, "gradient": True}
+    )
+    return scenario
+
+
+def _text_pipeline(tokenizer=None, **kwargs):
+    return Pipeline(
+        _scenario(), [], [], [], nn.Linear(4, 2), None, "cpu", tokenizer or Tokenizer(), **kwargs
+    )
+
+
+def _row(length, padding=0):
+    return [CLS] + list(range(1, length - 1)) + [SEP] + [PAD] * padding
+
+
+def test_encode_batch_pads_to_a_multiple_of_8():
+    inputs = _text_pipeline()._encode_batch([_row(3, padding=20), _row(5)])
+    assert sorted(inputs) == ["attention_mask", "input_ids", "token_type_ids"]
+    assert inputs["input_ids"].shape == (2, 8)
+    # the ids are used as they are, the trailing padding is dropped
+    assert inputs["input_ids"][0].tolist() == _row(3, padding=5)
+    assert inputs["input_ids"][1].tolist() == _row(5, padding=3)
+    assert inputs["attention_mask"].sum(1).tolist() == [3, 5]
+    assert inputs["token_type_ids"].abs().sum() == 0
+
+
+def test_encode_batch_keeps_full_multiples():
+    inputs = _text_pipeline()._encode_batch([_row(16), _row(2)])
+    assert inputs["input_ids"].shape == (2, 16)
+    inputs = _text_pipeline(pad_to_multiple_of=0)._encode_batch([_row(5)])
+    assert inputs["input_ids"].shape == (1, 5)
+
+
+def test_encode_batch_never_pads_past_max_length():
+    pipeline = _text_pipeline(max_length=12)
+    assert pipeline._encode_batch([_row(10)])["input_ids"].shape == (1, 12)
+    # positions reserved for inserted tokens
+    assert pipeline._encode_batch([_row(3)], reserve=6)["input_ids"].shape == (1, 6)
+
+
+def test_encode_batch_truncates_before_sep():
+    inputs = _text_pipeline(max_length=8)._encode_batch([_row(20)])
+    assert inputs["input_ids"][0].tolist() == [CLS, 1, 2, 3, 4, 5, 6, SEP]
+
+
+def test_encode_batch_without_token_type_ids():
+    tokenizer = Tokenizer()
+    tokenizer.model_input_names = ["input_ids", "attention_mask"]
+    assert "token_type_ids" not in _text_pipeline(tokenizer)._encode_batch([_row(3)])
+
+
+@pytest.mark.parametrize(
+    "row",
+    [
+        [CLS, -1, SEP],
+        [CLS, 1000, SEP],
+        [5, 6, SEP],
+        [CLS, 5, 6, PAD],
+        [PAD, PAD],
+        [],
+    ],
+)
+def test_encode_batch_rejects_invalid_rows(row):
+    with pytest.raises(ValueError):
+        _text_pipeline()._encode_batch([_row(4), np.array(row, dtype=np.int64)])
+
+
+def _vision_pipeline():
+    torch.manual_seed(0)
+    model = nn.Sequential(nn.Flatten(), nn.Linear(12, 3), nn.LogSoftmax(dim=1))
+    return VisionPipeline(_scenario(), [], [], [], model, None, "cpu", None)
+
+
+def _images():
+    return np.random.RandomState(0).rand(4, 1, 3, 4).astype(np.float32)
+
+
+def _attack(recipe, labels=None):
+    steps = list(_vision_pipeline().run_iterative_attack(_images(), labels, recipe))
+    return steps[:-1], steps[-1]
+
+
+@pytest.mark.parametrize("random_start", [False, True])
+def test_linf_attack_stays_in_the_ball(random_start):
+    recipe = IterativeAttackRecipe(
+        epsilon=0.05, step_size=0.02, steps=6, random_start=random_start
+    )
+    progress, done = _attack(recipe, labels=[0, 1, 2, 0])
+    assert [step["step"] for step in progress] == [1, 2, 3, 4, 5, 6]
+    assert done["done"] and done["violations"] == 0
+    delta = done["adversarial"].numpy() - _images()
+    assert np.abs(delta).max() <= 0.05 + 1e-6
+    assert done["max_distance"] == pytest.approx(np.abs(delta).reshape(4, -1).max())
+    assert done["adversarial"].min() >= 0 and done["adversarial"].max() <= 1
+
+
+def test_l2_attack_is_projected_onto_the_ball():
+    # steps much larger than the ball, every one of them is projected back
+    recipe = IterativeAttackRecipe(
+        epsilon=0.1, step_size=1.0, steps=3, norm="l2", clip_min=-10, clip_max=10
+    )
+    _, done = _attack(recipe)
+    assert done["violations"] == 0
+    norms = np.linalg.norm((done["adversarial"].numpy() - _images()).reshape(4, -1), axis=1)
+    np.testing.assert_allclose(norms, 0.1, rtol=1e-4)
+    assert done["max_distance"] == pytest.approx(0.1, rel=1e-4)
+
+
+def test_attack_increases_the_loss():
+    progress, _ = _attack(IterativeAttackRecipe(epsilon=0.5, step_size=0.05, steps=5))
+    losses = [step["loss"] for step in progress]
+    assert losses == sorted(losses) and losses[-1] > losses[0]
+
+
+def test_attack_reports_every_few_steps():
+    progress, _ = _attack(IterativeAttackRecipe(steps=5, report_every=2))
+    assert [step["step"] for step in progress] == [2, 4, 5]
+    progress, done = _attack(IterativeAttackRecipe(steps=0))
+    assert progress == [] and done["violations"] == 0
+    np.testing.assert_array_equal(done["adversarial"].numpy(), _images())
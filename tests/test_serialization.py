@@ -0,0 +1,95 @@
+import numpy as np
+import pytest
+import torch
+
+from Maestro.utils.serialization import decode_tensors, encode_tensors
+
+
+def test_single_array_round_trip():
+    x = np.arange(12, dtype=np.float32).reshape(3, 4)
+    decoded = decode_tensors(encode_tensors(x))
+    assert isinstance(decoded, np.ndarray)
+    assert decoded.dtype == np.float32
+    np.testing.assert_array_equal(decoded, x)
+
+
+def test_sequence_round_trip():
+    loss = torch.tensor(0.25)
+    logits = torch.randn(2, 3)
+    decoded = decode_tensors(encode_tensors((loss, logits)))
+    assert isinstance(decoded, list) and len(decoded) == 2
+    # a scalar loss stays 0-d
+    assert decoded[0].shape == ()
+    assert decoded[0] == pytest.approx(0.25)
+    np.testing.assert_array_equal(decoded[1], logits.numpy())
+
+
+@pytest.mark.parametrize("dtype", ["float16", "float32", "float64", "int32", "int64", "uint8", "bool"])
+def test_dtypes(dtype):
+    x = (np.arange(6) % 2).astype(dtype).reshape(2, 3)
+    decoded = decode_tensors(encode_tensors(x))
+    assert decoded.dtype == np.dtype(dtype)
+    np.testing.assert_array_equal(decoded, x)
+
+
+def test_dtype_only_downcasts_floats():
+    decoded = decode_tensors(
+        encode_tensors([np.ones(3, dtype=np.float64), np.ones(3, dtype=np.int64)], dtype="float16")
+    )
+    assert decoded[0].dtype == np.float16
+    assert decoded[1].dtype == np.int64
+
+
+def test_empty_and_non_contiguous():
+    empty = np.zeros((0, 5), dtype=np.float32)
+    assert decode_tensors(encode_tensors(empty)).shape == (0, 5)
+    transposed = np.arange(6, dtype=np.int64).reshape(2, 3).T
+    np.testing.assert_array_equal(decode_tensors(encode_tensors(transposed)), transposed)
+
+
+def test_decode_is_a_view():
+    payload = bytearray(encode_tensors(np.zeros(4, dtype=np.float32)))
+    decoded = decode_tensors(payload)
+    payload[-4:] = np.float32(1).tobytes()
+    assert decoded[-1] == 1
+
+
+def test_unsupported_dtype():
+    with pytest.raises(TypeError):
+        encode_tensors(np.zeros(2, dtype=np.complex64))
+
+
+def test_invalid_payload():
+    with pytest.raises(ValueError):
+        decode_tensors(b"JSON" + encode_tensors(np.zeros(1))[4:])
+    with pytest.raises(ValueError):
+        decode_tensors(encode_tensors(np.zeros(1)) + b"\0")
+
+
+def test_unknown_dtype_code():
+    payload = bytearray(encode_tensors(np.zeros(2, dtype=np.float32)))
+    payload[8] = 200
+    with pytest.raises(ValueError):
+        decode_tensors(payload)
+
+
+@pytest.mark.parametrize("length", [0, 3, 8, 9, 12, 20])
+def test_truncated_payload(length):
+    payload = encode_tensors([np.zeros((2, 3), dtype=np.float32), np.arange(2)])
+    with pytest.raises(ValueError):
+        decode_tensors(payload[:length])
+
+
+def test_shape_larger_than_payload():
+    payload = bytearray(encode_tensors(np.zeros(2, dtype=np.float32)))
+    # the one dimension, claiming 2 ** 62 elements
+    payload[10:18] = (1 << 62).to_bytes(8, "little")
+    with pytest.raises(ValueError):
+        decode_tensors(payload)
+
+
+def test_single_tensor_payload_without_tensors():
+    payload = bytearray(encode_tensors([]))
+    payload[5] = 0
+    with pytest.raises(ValueError):
+        decode_tensors(payload)
@@ -0,0 +1,42 @@
+import os
+import sys
+
+import flask
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "Maestro", "server"))
+import serving  # noqa: E402
+from serving import _RespawnBackoff  # noqa: E402
+
+
+def test_backoff_doubles_for_workers_exiting_right_away():
+    backoff = _RespawnBackoff(min_uptime=10, base_delay=0.5, max_delay=3, max_failures=10)
+    assert [backoff.exited(1) for _ in range(5)] == [0.5, 1, 2, 3, 3]
+
+
+def test_backoff_resets_after_a_long_running_worker():
+    backoff = _RespawnBackoff(min_uptime=10, base_delay=0.5, max_failures=3)
+    backoff.exited(1)
+    backoff.exited(1)
+    assert backoff.exited(60) == 0
+    assert backoff.exited(1) == 0.5
+
+
+def test_backoff_gives_up_after_rapid_failures():
+    backoff = _RespawnBackoff(min_uptime=10, max_failures=3)
+    backoff.exited(1)
+    backoff.exited(1)
+    with pytest.raises(RuntimeError):
+        backoff.exited(1)
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="prefork needs os.fork")
+def test_prefork_stops_replacing_workers_crashing_at_startup(monkeypatch):
+    def crash(workers):
+        raise RuntimeError("worker failed to start")
+
+    monkeypatch.setattr(serving, "_init_worker", crash)
+    backoff = _RespawnBackoff(base_delay=0.01, max_failures=4)
+    with pytest.raises(RuntimeError, match="giving up"):
+        serving._serve_prefork(flask.Flask(__name__), "127.0.0.1", 0, 2, backoff)
+    assert backoff.failures == 4
@@ -0,0 +1,107 @@
+import os
+
+import numpy as np
+import torch
+
+from Maestro.utils.token_cache import (
+    TokenizedDataset,
+    cached_trainable_data,
+    dataset_identity,
+    tokenized_cache_key,
+)
+
+
+class Tokenizer:
+    def __init__(self, vocab) -> None:
+        self.vocab = vocab
+        self.name_or_path = "test-tokenizer"
+
+    def get_vocab(self):
+        return dict(self.vocab)
+
+
+class Split:
+    """ a dataset split with the get_trainable_data of Maestro's datasets """
+
+    def __init__(self, sentences, name="test", split="train") -> None:
+        self.sentences = sentences
+        self.name = name
+        self.split = split
+        self.tokenized = 0
+
+    def __len__(self):
+        return len(self.sentences)
+
+    def get_trainable_data(self, tokenizer, max_length):
+        self.tokenized += 1
+        examples = []
+        for i, sentence in enumerate(self.sentences):
+            ids = [tokenizer.vocab[word] for word in sentence.split()][:max_length]
+            input_ids = torch.zeros(max_length, dtype=torch.long)
+            input_ids[: len(ids)] = torch.tensor(ids)
+            attention_mask = (input_ids != 0).long()
+            examples.append({"input_ids": input_ids, "attention_mask": attention_mask, "labels": i % 2})
+        return examples
+
+
+VOCAB = {"a": 1, "b": 2, "c": 3}
+
+
+def test_write_and_reopen(tmp_path):
+    examples = Split(["a b", "c", "a b c"]).get_trainable_data(Tokenizer(VOCAB), 4)
+    path = str(tmp_path / "split")
+    dataset = TokenizedDataset.write(path, examples, {"note": "test"})
+    assert len(dataset) == 3
+    assert not os.path.exists("{}.{}.tmp".format(path, os.getpid()))
+    reopened = TokenizedDataset(path)
+    assert reopened.manifest["metadata"] == {"note": "test"}
+    assert sorted(reopened.columns) == ["attention_mask", "input_ids", "labels"]
+    for index, example in enumerate(examples):
+        row = reopened[index]
+        assert torch.equal(row["input_ids"], example["input_ids"])
+        assert torch.equal(row["attention_mask"], example["attention_mask"])
+        assert int(row["labels"]) == example["labels"]
+
+
+def test_rows_are_writable_copies(tmp_path):
+    examples = [{"input_ids": np.arange(3)}]
+    dataset = TokenizedDataset.write(str(tmp_path / "split"), examples)
+    row = dataset[0]["input_ids"]
+    row += 1
+    assert dataset[0]["input_ids"].tolist() == [0, 1, 2]
+
+
+def test_writing_an_existing_split_keeps_it(tmp_path):
+    path = str(tmp_path / "split")
+    TokenizedDataset.write(path, [{"input_ids": np.zeros(2)}])
+    dataset = TokenizedDataset.write(path, [{"input_ids": np.ones(2)}])
+    assert dataset[0]["input_ids"].tolist() == [0, 0]
+
+
+def test_cache_key_depends_on_split_tokenizer_and_length():
+    split = Split(["a b"])
+    tokenizer = Tokenizer(VOCAB)
+    key = tokenized_cache_key(split, tokenizer, 8)
+    assert key == tokenized_cache_key(Split(["a b"]), Tokenizer(VOCAB), 8)
+    assert key != tokenized_cache_key(Split(["a b"], split="test"), tokenizer, 8)
+    assert key != tokenized_cache_key(Split(["a b", "c"]), tokenizer, 8)
+    assert key != tokenized_cache_key(split, Tokenizer(dict(VOCAB, d=4)), 8)
+    assert key != tokenized_cache_key(split, tokenizer, 16)
+
+
+def test_dataset_identity():
+    identity = dataset_identity(Split(["a", "b"]))
+    assert identity == {"class": "Split", "examples": 2, "name": "test", "split": "train"}
+
+
+def test_cached_trainable_data_tokenizes_once(tmp_path):
+    split = Split(["a b", "c a"])
+    tokenizer = Tokenizer(VOCAB)
+    first = cached_trainable_data(split, tokenizer, 4, cache_dir=str(tmp_path))
+    second = cached_trainable_data(split, tokenizer, 4, cache_dir=str(tmp_path))
+    assert split.tokenized == 1
+    assert first.path == second.path
+    assert second[1]["input_ids"].tolist() == [3, 1, 0, 0]
+    assert second.manifest["metadata"]["max_length"] == 4
+    cached_trainable_data(split, tokenizer, 8, cache_dir=str(tmp_path))
+    assert split.tokenized == 2
@@ -0,0 +1,108 @@
+import json
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from Maestro.utils.tracing import Metrics
+
+
+def test_timer_records_latencies():
+    metrics = Metrics()
+    for _ in range(3):
+        with metrics.timer("forward"):
+            time.sleep(0.01)
+    summary = metrics.snapshot()["latency_seconds"]["forward"]
+    assert summary["count"] == 3
+    assert 0.03 <= summary["total"] < 1
+    assert summary["mean"] == pytest.approx(summary["total"] / 3)
+    assert summary["p50"] <= summary["max"]
+
+
+def test_timer_records_failed_blocks():
+    metrics = Metrics()
+    with pytest.raises(RuntimeError):
+        with metrics.timer("decode"):
+            raise RuntimeError()
+    assert metrics.snapshot()["latency_seconds"]["decode"]["count"] == 1
+
+
+def test_percentiles_of_observed_values():
+    metrics = Metrics()
+    for value in range(1, 101):
+        metrics.observe("batch_size", value)
+    summary = metrics.snapshot()["values"]["batch_size"]
+    assert summary["count"] == 100
+    assert summary["total"] == 5050
+    assert summary["max"] == 100
+    for percentile in (50, 95, 99):
+        expected = np.percentile(np.arange(1, 101), percentile)
+        assert summary["p{}".format(percentile)] == pytest.approx(expected)
+
+
+def test_percentiles_of_the_recent_window():
+    metrics = Metrics()
+    for _ in range(2000):
+        metrics.observe("bytes", 1000)
+    for _ in range(1024):
+        metrics.observe("bytes", 1)
+    summary = metrics.snapshot()["values"]["bytes"]
+    # count, total and max cover every value, the percentiles the last 1024
+    assert summary["count"] == 3024
+    assert summary["max"] == 1000
+    assert summary["p99"] == 1
+
+
+def test_counters_are_thread_safe():
+    metrics = Metrics()
+
+    def count():
+        for _ in range(1000):
+            metrics.increment("cache_hits")
+
+    threads = [threading.Thread(target=count) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    metrics.increment("cache_hits", 5)
+    assert metrics.snapshot()["counters"] == {"cache_hits": 8005}
+
+
+def test_snapshot_is_json_and_reset_clears_it():
+    metrics = Metrics()
+    assert metrics.snapshot()["latency_seconds"] == {}
+    metrics.record("route:/get_batch_output", 0.5)
+    metrics.observe("response_bytes:/get_batch_output", 100)
+    metrics.increment("cache_misses")
+    snapshot = json.loads(json.dumps(metrics.snapshot()))
+    assert set(snapshot) == {"uptime_seconds", "latency_seconds", "values", "counters"}
+    assert snapshot["latency_seconds"]["route:/get_batch_output"]["max"] == 0.5
+    assert snapshot["values"]["response_bytes:/get_batch_output"]["p50"] == 100
+    assert snapshot["counters"] == {"cache_misses": 1}
+    metrics.reset()
+    snapshot = metrics.snapshot()
+    assert snapshot["latency_seconds"] == snapshot["values"] == snapshot["counters"] == {}
+
+
+def test_trace_file(tmp_path):
+    path = str(tmp_path / "trace.json")
+    metrics = Metrics()
+    metrics.observe("batch_size", 4)
+    metrics.open_trace(path)
+    with metrics.timer("forward", application="Attack"):
+        pass
+    metrics.record("backward", 0.25, start=10.0)
+    # reopened traces are appended to
+    Metrics().open_trace(path)
+    Metrics().record("untraced", 1.0)
+    with open(path) as f:
+        text = f.read()
+    assert text.startswith("[\n")
+    # a trace viewer accepts the array without its closing bracket
+    events = json.loads(text.rstrip().rstrip(",") + "]")
+    assert [event["name"] for event in events] == ["forward", "backward"]
+    forward, backward = events
+    assert forward["ph"] == "X" and forward["args"] == {"application": "Attack"}
+    assert backward["ts"] == 10000000 and backward["dur"] == 250000
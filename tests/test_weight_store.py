@@ -0,0 +1,148 @@
+import glob
+import json
+import os
+
+import pytest
+import torch
+import torch.nn as nn
+
+from Maestro.utils import weight_store
+
+
+@pytest.fixture(params=["raw", "safetensors"])
+def store_format(request, monkeypatch):
+    if request.param == "raw":
+        monkeypatch.setattr(weight_store, "safetensors", None)
+    elif weight_store.safetensors is None:
+        pytest.skip("safetensors is not installed")
+    return request.param
+
+
+def _state_dict():
+    return {
+        "weight": torch.randn(3, 5),
+        "half": torch.randn(7).half(),
+        "steps": torch.tensor(4, dtype=torch.int64),
+        "mask": torch.tensor([True, False, True]),
+        "bf16": torch.randn(2, 3).bfloat16(),
+    }
+
+
+def _versions(path):
+    names = glob.glob(path + ".*")
+    return sorted(name for name in names if weight_store._VERSION_PATTERN.search(name))
+
+
+def test_round_trip(tmp_path, store_format):
+    state_dict = _state_dict()
+    path = str(tmp_path / "model.weights")
+    weight_store.save_weights(state_dict, path)
+    assert weight_store.has_weights(path)
+    loaded = weight_store.load_weights(path)
+    assert sorted(loaded) == sorted(state_dict)
+    for name, tensor in state_dict.items():
+        assert loaded[name].dtype == tensor.dtype
+        assert torch.equal(loaded[name], tensor)
+
+
+def test_raw_store_works_without_tensor_view_dtype(tmp_path, monkeypatch):
+    # torch < 1.8 only has Tensor.view(shape)
+    view = torch.Tensor.view
+
+    def view_shape(self, *shape):
+        if any(isinstance(size, torch.dtype) for size in shape):
+            raise TypeError("view(dtype) is not supported")
+        return view(self, *shape)
+
+    monkeypatch.setattr(weight_store, "safetensors", None)
+    monkeypatch.setattr(torch.Tensor, "view", view_shape)
+    state_dict = _state_dict()
+    path = str(tmp_path / "model.weights")
+    weight_store.save_weights(state_dict, path)
+    loaded = weight_store.load_weights(path)
+    for name, tensor in state_dict.items():
+        assert torch.equal(loaded[name], tensor)
+
+
+def test_raw_store_is_aligned(tmp_path, monkeypatch):
+    monkeypatch.setattr(weight_store, "safetensors", None)
+    path = str(tmp_path / "model.weights")
+    weight_store.save_weights(_state_dict(), path)
+    with open(os.path.join(path, weight_store.INDEX_FILE)) as f:
+        index = json.load(f)
+    assert all(entry["offset"] % weight_store.ALIGNMENT == 0 for entry in index.values())
+
+
+def test_saves_swap_versions(tmp_path, store_format):
+    path = str(tmp_path / "model.weights")
+    for value in range(4):
+        weight_store.save_weights({"weight": torch.full((2,), float(value))}, path)
+        assert weight_store.load_weights(path)["weight"].tolist() == [value, value]
+    assert os.path.islink(path)
+    # the current version and the previous one, for readers that resolved it
+    versions = _versions(path)
+    assert len(versions) == 2
+    assert os.path.realpath(path) in [os.path.realpath(name) for name in versions]
+
+
+def test_store_written_before_versioning_is_replaced(tmp_path, monkeypatch):
+    monkeypatch.setattr(weight_store, "safetensors", None)
+    path = str(tmp_path / "model.weights")
+    weight_store.save_weights({"weight": torch.zeros(2)}, path)
+    legacy = os.path.realpath(path)
+    os.unlink(path)
+    os.rename(legacy, path)
+    weight_store.save_weights({"weight": torch.ones(2)}, path)
+    assert os.path.islink(path)
+    assert weight_store.load_weights(path)["weight"].tolist() == [1, 1]
+    assert len(_versions(path)) == 2
+
+
+def test_skip_init_and_load_model_weights(tmp_path):
+    reference = nn.Linear(4, 2)
+    path = str(tmp_path / "model.weights")
+    weight_store.save_weights(reference, path)
+    model = weight_store.skip_init(nn.Linear, 4, 2)
+    weight_store.load_model_weights(model, weight_store.load_weights(path))
+    x = torch.randn(3, 4)
+    assert torch.equal(model(x), reference(x))
+
+
+class Scaled(nn.Linear):
+    def __init__(self, *args) -> None:
+        super(Scaled, self).__init__(*args)
+        # not in the state_dict, so never loaded
+        self.register_buffer("scale", torch.ones(1), persistent=False)
+
+
+def test_load_model_weights_rejects_weights_left_on_meta():
+    if not weight_store._assign_supported():
+        pytest.skip("modules are only built on the meta device on torch >= 2.1")
+    model = weight_store.skip_init(Scaled, 4, 2)
+    with pytest.raises(ValueError):
+        weight_store.load_model_weights(model, nn.Linear(4, 2).state_dict())
+
+
+def test_weight_store_path(tmp_path):
+    assert weight_store.weight_store_path(str(tmp_path)) == str(tmp_path / "maestro.weights")
+    assert weight_store.weight_store_path(str(tmp_path / "model.pt")) == str(
+        tmp_path / "model.pt.weights"
+    )
+
+
+def test_load_checkpoint_converts_once_and_after_changes(tmp_path):
+    checkpoint = str(tmp_path / "model.pt")
+    reference = nn.Linear(4, 2)
+    torch.save(reference.state_dict(), checkpoint)
+    model = weight_store.load_checkpoint(nn.Linear(4, 2), checkpoint)
+    assert torch.equal(model.weight, reference.weight)
+    store = os.path.realpath(weight_store.weight_store_path(checkpoint))
+    weight_store.load_checkpoint(nn.Linear(4, 2), checkpoint)
+    assert os.path.realpath(weight_store.weight_store_path(checkpoint)) == store
+
+    retrained = nn.Linear(4, 2)
+    torch.save(retrained.state_dict(), checkpoint)
+    later = os.path.getmtime(weight_store.weight_store_path(checkpoint)) + 10
+    os.utime(checkpoint, (later, later))
+    model = weight_store.load_checkpoint(nn.Linear(4, 2), checkpoint)
+    assert torch.equal(model.weight, retrained.weight)